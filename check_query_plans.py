@@ -0,0 +1,101 @@
+"""EXPLAIN the API's hot queries and report any that still scan a whole table.
+
+Usage:
+    python check_query_plans.py [--min-rows 1000]
+
+Exits with status 1 when a query plan contains a full table scan (access
+type ALL) over more than --min-rows estimated rows, so it can run in CI or
+after ``python migrate.py``.
+"""
+import argparse
+import asyncio
+import sys
+
+import aiomysql
+
+from components.database import get_db_connection
+
+SAMPLE_USER_ID = '1'
+SAMPLE_PRODUCT_ID = '1'
+
+HOT_QUERIES = {
+    'user demographics': (
+        "SELECT user_id, age, gender, location FROM users WHERE user_id = %s",
+        (SAMPLE_USER_ID,),
+    ),
+    'user demo details': (
+        "SELECT u.age, u.gender, u.location, b.brand FROM users u "
+        "JOIN brands b ON b.user_id = u.user_id WHERE u.user_id = %s",
+        (SAMPLE_USER_ID,),
+    ),
+    'product by product_id': (
+        "SELECT * FROM products WHERE product_id = %s",
+        (SAMPLE_PRODUCT_ID,),
+    ),
+    'user events joined to products': (
+        "SELECT e.event_type, p.product_name FROM events e "
+        "JOIN products p ON p.id = e.product_id WHERE e.user_id = %s",
+        (SAMPLE_USER_ID,),
+    ),
+    'known positives': (
+        "SELECT e.product_id FROM events e WHERE e.user_id = %s",
+        (SAMPLE_USER_ID,),
+    ),
+    'events in date range': (
+        "SELECT e.event_type, e.event_time FROM events e "
+        "WHERE e.event_time >= %s AND e.event_time < %s",
+        ('2024-01-01', '2024-02-01'),
+    ),
+    'monthly conversion rates': (
+        "SELECT DATE_FORMAT(event_time, '%%Y-%%m') AS month, SUM(event_type = 'purchase') "
+        "FROM events GROUP BY month",
+        (),
+    ),
+    'monthly sales': (
+        "SELECT YEAR(order_date), MONTH(order_date), SUM(amount) FROM sales "
+        "GROUP BY YEAR(order_date), MONTH(order_date)",
+        (),
+    ),
+    'category sales': (
+        "SELECT product_category, SUM(amount) FROM sales GROUP BY product_category",
+        (),
+    ),
+}
+
+
+async def explain(cur, query, params):
+    await cur.execute("EXPLAIN " + query, params)
+    return await cur.fetchall()
+
+
+async def check(min_rows: int) -> int:
+    problems = 0
+    async with get_db_connection() as conn:
+        async with conn.cursor(aiomysql.DictCursor) as cur:
+            for name, (query, params) in HOT_QUERIES.items():
+                plan = await explain(cur, query, params)
+                print(f"== {name}")
+                for step in plan:
+                    full_scan = step['type'] == 'ALL' and (step['rows'] or 0) > min_rows
+                    marker = 'FULL SCAN' if full_scan else 'ok'
+                    print(f"   {step['table']}: type={step['type']} key={step['key']} "
+                          f"rows={step['rows']} partitions={step.get('partitions')} [{marker}]")
+                    problems += full_scan
+    return problems
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Check query plans of the API's hot queries")
+    parser.add_argument('--min-rows', type=int, default=1000,
+                        help="ignore full scans of tables estimated below this many rows")
+    args = parser.parse_args()
+
+    problems = asyncio.run(check(args.min_rows))
+    if problems:
+        print(f"{problems} full table scan(s) found")
+        sys.exit(1)
+    print("No full table scans found")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,241 @@
+"""Local columnar extract of the events ⋈ users ⋈ products join.
+
+Events are appended incrementally (``events.id`` watermark) into Arrow IPC
+files partitioned by UTC event day:
+
+    <ANALYTICS_STORE_DIR>/event_date=YYYY-MM-DD/part-<first id>-<last id>.arrow
+    <ANALYTICS_STORE_DIR>/_watermark.json
+
+Readers open the files memory-mapped through ``pyarrow.dataset`` and push
+date/column filters down to the scan, so heavy analytics reads never touch
+MySQL. Refresh the extract from cron:
+
+    python -m components.analytics_store sync
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+from collections import defaultdict
+from datetime import date
+
+import aiomysql
+
+from .database import get_db_connection
+
+logger = logging.getLogger(__name__)
+
+ANALYTICS_STORE_DIR = os.getenv("ANALYTICS_STORE_DIR", "analytics-store")
+# Routines only read the extract when enabled; it lags MySQL by the sync interval
+ANALYTICS_STORE_ENABLED = os.getenv("ANALYTICS_STORE_ENABLED", "false").lower() == "true"
+SYNC_BATCH_SIZE = int(os.getenv("ANALYTICS_SYNC_BATCH_SIZE", "50000"))
+ROWS_PER_FILE = int(os.getenv("ANALYTICS_ROWS_PER_FILE", "500000"))
+
+EXTRACT_QUERY = """
+    SELECT
+        e.id AS event_id,
+        e.user_id,
+        e.event_type,
+        e.uri,
+        e.event_time,
+        p.id AS product_id,
+        p.product_name,
+        p.product_category AS category_code,
+        p.product_Brand AS brand,
+        p.department,
+        u.id AS user_pk,
+        u.age,
+        u.gender,
+        u.location
+    FROM events e
+    LEFT JOIN users u ON u.user_id = e.user_id
+    LEFT JOIN products p ON p.id = e.product_id
+    WHERE e.id > %s
+    ORDER BY e.id
+"""
+
+
+def _pyarrow():
+    import pyarrow
+    import pyarrow.dataset  # noqa: F401
+    import pyarrow.fs  # noqa: F401
+    return pyarrow
+
+
+def extract_schema():
+    pa = _pyarrow()
+    return pa.schema([
+        ('event_id', pa.int64()),
+        ('user_id', pa.string()),
+        ('event_type', pa.string()),
+        ('uri', pa.string()),
+        ('event_time', pa.timestamp('us', tz='UTC')),
+        ('product_id', pa.int64()),
+        ('product_name', pa.string()),
+        ('category_code', pa.string()),
+        ('brand', pa.string()),
+        ('department', pa.string()),
+        ('user_pk', pa.int64()),
+        ('age', pa.int32()),
+        ('gender', pa.string()),
+        ('location', pa.string()),
+    ])
+
+
+class AnalyticsStore:
+    def __init__(self, root: str = ANALYTICS_STORE_DIR):
+        self.root = root
+        self.watermark_path = os.path.join(root, '_watermark.json')
+
+    # --- Watermark ---
+
+    def watermark(self) -> int:
+        try:
+            with open(self.watermark_path) as f:
+                return int(json.load(f)['last_event_id'])
+        except FileNotFoundError:
+            return 0
+
+    def _save_watermark(self, last_event_id: int):
+        tmp_path = self.watermark_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({'last_event_id': last_event_id}, f)
+        os.replace(tmp_path, self.watermark_path)
+
+    def has_data(self) -> bool:
+        return self.watermark() > 0
+
+    # --- Writing ---
+
+    def _part_files(self):
+        if not os.path.isdir(self.root):
+            return
+        for partition in os.listdir(self.root):
+            directory = os.path.join(self.root, partition)
+            if not partition.startswith('event_date=') or not os.path.isdir(directory):
+                continue
+            for name in os.listdir(directory):
+                if name.startswith('part-') and name.endswith('.arrow'):
+                    yield os.path.join(directory, name), int(name.split('-')[1])
+
+    def _remove_orphans(self, watermark: int):
+        # Files written by a sync that died before advancing the watermark
+        for path, first_id in list(self._part_files()):
+            if first_id > watermark:
+                os.remove(path)
+
+    def _write_part(self, day: date, rows: list):
+        pa = _pyarrow()
+        directory = os.path.join(self.root, f"event_date={day.isoformat()}")
+        os.makedirs(directory, exist_ok=True)
+        name = f"part-{rows[0]['event_id']:012d}-{rows[-1]['event_id']:012d}.arrow"
+        path = os.path.join(directory, name)
+        schema = extract_schema()
+        batch = pa.RecordBatch.from_pylist(rows, schema=schema)
+        tmp_path = os.path.join(directory, f".{name}.tmp")  # hidden from readers until renamed
+        # Uncompressed IPC files so readers can memory-map them
+        with pa.OSFile(tmp_path, 'wb') as sink:
+            with pa.ipc.new_file(sink, schema) as writer:
+                writer.write_batch(batch)
+        os.replace(tmp_path, path)
+
+    async def sync(self, batch_size: int = SYNC_BATCH_SIZE, rows_per_file: int = ROWS_PER_FILE) -> int:
+        """Append events newer than the watermark; returns the number of rows added."""
+        os.makedirs(self.root, exist_ok=True)
+        watermark = self.watermark()
+        self._remove_orphans(watermark)
+
+        buffers = defaultdict(list)
+        last_event_id = watermark
+        added = 0
+        async with get_db_connection(time_zone='+00:00') as conn:
+            async with conn.cursor(aiomysql.SSDictCursor) as cur:
+                await cur.execute(EXTRACT_QUERY, (watermark,))
+                while True:
+                    rows = await cur.fetchmany(batch_size)
+                    if not rows:
+                        break
+                    for row in rows:
+                        buffers[row['event_time'].date()].append(row)
+                    last_event_id = rows[-1]['event_id']
+                    added += len(rows)
+                    for day in [day for day, buffered in buffers.items() if len(buffered) >= rows_per_file]:
+                        self._write_part(day, buffers.pop(day))
+
+        for day, buffered in buffers.items():
+            self._write_part(day, buffered)
+        if last_event_id != watermark:
+            self._save_watermark(last_event_id)
+        logger.info(f"Analytics store synced {added} events up to id {last_event_id}")
+        return added
+
+    # --- Reading ---
+
+    def dataset(self):
+        pa = _pyarrow()
+        partitioning = pa.dataset.partitioning(pa.schema([('event_date', pa.string())]), flavor='hive')
+        return pa.dataset.dataset(
+            self.root,
+            format='ipc',
+            partitioning=partitioning,
+            filesystem=pa.fs.LocalFileSystem(use_mmap=True),
+            exclude_invalid_files=True,
+            ignore_prefixes=['_', '.'],
+        )
+
+    def _filter(self, start_date: date = None, end_date: date = None, filter=None):
+        pa = _pyarrow()
+        expression = filter
+        # event_date partitions are ISO strings, so range pruning is a string compare
+        if start_date:
+            condition = pa.dataset.field('event_date') >= start_date.isoformat()
+            expression = condition if expression is None else expression & condition
+        if end_date:
+            condition = pa.dataset.field('event_date') <= end_date.isoformat()
+            expression = condition if expression is None else expression & condition
+        return expression
+
+    def scan(self, columns=None, start_date: date = None, end_date: date = None, filter=None):
+        """Read the extract as a pyarrow Table, pruning partitions by UTC day."""
+        return self.dataset().to_table(columns=columns, filter=self._filter(start_date, end_date, filter))
+
+    def scan_batches(self, columns=None, start_date: date = None, end_date: date = None, filter=None,
+                     batch_size: int = SYNC_BATCH_SIZE):
+        return self.dataset().to_batches(columns=columns, filter=self._filter(start_date, end_date, filter),
+                                         batch_size=batch_size)
+
+    def to_pandas(self, columns=None, start_date: date = None, end_date: date = None, filter=None):
+        return self.scan(columns, start_date, end_date, filter).to_pandas()
+
+
+analytics_store = AnalyticsStore()
+
+
+def store_available() -> bool:
+    return ANALYTICS_STORE_ENABLED and analytics_store.has_data()
+
+
+def read_product_events():
+    """Events that resolve to a product: the input of the recommender preprocessing."""
+    pa = _pyarrow()
+    return analytics_store.scan(
+        columns=['user_id', 'event_type', 'uri', 'product_id'],
+        filter=pa.dataset.field('product_id').is_valid(),
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Maintain the local columnar analytics extract")
+    parser.add_argument('command', choices=['sync', 'status'])
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    if args.command == 'sync':
+        asyncio.run(analytics_store.sync())
+    else:
+        print(f"root={analytics_store.root} last_event_id={analytics_store.watermark()}")
+
+
+if __name__ == "__main__":
+    main()
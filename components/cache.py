@@ -0,0 +1,392 @@
+"""Async caching shared by the components.
+
+    AsyncLRUCache   process-local LRU + TTL, for values that should never leave
+                    the worker (numpy arrays, encoders)
+    Cache           one named namespace on the configured backend, with tags,
+                    coalesced loads and hit/miss metrics
+    single_flight   decorator coalescing concurrent identical calls
+
+CACHE_BACKEND selects where ``Cache`` entries live: ``memory`` (default; one
+LRU per worker, CACHE_MAX_ENTRIES) or ``redis`` (any Redis-compatible server at
+CACHE_REDIS_URL, shared by every worker; needs the redis package). Values are
+pickled into redis, so only point it at a server you trust.
+"""
+import asyncio
+import functools
+import inspect
+import logging
+import math
+import os
+import pickle
+import time
+from collections import OrderedDict, defaultdict
+
+from fastapi import APIRouter, Depends
+from pydantic import BaseModel
+
+from .model_registry import require_admin_token
+
+logger = logging.getLogger(__name__)
+
+CACHE_BACKEND = os.getenv("CACHE_BACKEND", "memory")
+CACHE_REDIS_URL = os.getenv("CACHE_REDIS_URL", "redis://localhost:6379/0")
+CACHE_MAX_ENTRIES = int(os.getenv("CACHE_MAX_ENTRIES", "100000"))
+
+router = APIRouter(dependencies=[Depends(require_admin_token)])
+
+_MISSING = object()
+
+
+async def coalesce(inflight: dict, key, loader):
+    """Run `loader` once for concurrent callers of the same key.
+
+    Returns (value, owner). Only the caller that ran the load is the owner, and
+    only while the key was not invalidated meanwhile: the one that may cache it.
+    Every waiter receives the load's result (or exception).
+    """
+    future = inflight.get(key)
+    if future is not None:
+        # shield: a cancelled waiter must not cancel the shared load
+        return await asyncio.shield(future), False
+
+    future = asyncio.get_running_loop().create_future()
+    inflight[key] = future
+    try:
+        value = await loader()
+    except BaseException as exc:
+        if inflight.get(key) is future:
+            del inflight[key]
+        if isinstance(exc, asyncio.CancelledError):
+            future.cancel()
+        else:
+            future.set_exception(exc)
+            future.exception()  # mark retrieved when nobody else is waiting
+        raise
+
+    owner = inflight.get(key) is future
+    if owner:
+        del inflight[key]
+    future.set_result(value)
+    return value, owner
+
+
+class AsyncLRUCache:
+    """Size-bounded LRU cache with a per-entry TTL, for use from async code.
+
+    ``get_or_load`` coalesces concurrent misses for the same key onto a single
+    loader call; every waiter receives that call's result (or exception).
+    """
+
+    def __init__(self, maxsize: int = 10000, ttl: float = 300):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._inflight = {}
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        # Unlike get, does not count as a use
+        entry = self._entries.get(key)
+        return entry is not None and entry[0] >= time.monotonic()
+
+    def get(self, key, default=None):
+        entry = self._entries.get(key)
+        if entry is None:
+            return default
+        expires_at, value = entry
+        if expires_at < time.monotonic():
+            del self._entries[key]
+            return default
+        self._entries.move_to_end(key)
+        return value
+
+    def set(self, key, value, ttl: float = None):
+        ttl = self.ttl if ttl is None else ttl
+        if ttl <= 0:
+            return
+        self._entries[key] = (time.monotonic() + ttl, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def delete(self, key):
+        self._entries.pop(key, None)
+        # A load already in flight may have read the old data; do not let it populate the cache
+        self._inflight.pop(key, None)
+
+    def clear(self):
+        self._entries.clear()
+        self._inflight.clear()
+
+    async def get_or_load(self, key, loader):
+        value = self.get(key, _MISSING)
+        if value is not _MISSING:
+            return value
+        value, owner = await coalesce(self._inflight, key, loader)
+        if owner:
+            self.set(key, value)
+        return value
+
+
+# --- Backends ---
+
+class MemoryBackend:
+    """Per-worker backend: one LRU for every namespace, plus a tag -> keys index."""
+
+    def __init__(self, maxsize: int = CACHE_MAX_ENTRIES):
+        self.entries = AsyncLRUCache(maxsize=maxsize, ttl=math.inf)
+        self.tags = defaultdict(set)
+        self._tagged = 0
+
+    async def get(self, key):
+        return self.entries.get(key, _MISSING)
+
+    async def set(self, key, value, ttl: float, tags=()):
+        self.entries.set(key, value, ttl)
+        for tag in tags:
+            self.tags[tag].add(key)
+        self._tagged += len(tags)
+        if self._tagged > 2 * self.entries.maxsize:
+            self._prune_tags()
+
+    def _prune_tags(self):
+        # Keys evicted by the LRU or expired stay in the index until pruned here
+        for tag in list(self.tags):
+            self.tags[tag] = {key for key in self.tags[tag] if key in self.entries}
+            if not self.tags[tag]:
+                del self.tags[tag]
+        self._tagged = sum(len(keys) for keys in self.tags.values())
+
+    async def delete(self, key):
+        self.entries.delete(key)
+
+    async def invalidate_tag(self, tag) -> int:
+        keys = self.tags.pop(tag, set())
+        for key in keys:
+            self.entries.delete(key)
+        return len(keys)
+
+
+class RedisBackend:
+    """Backend on a Redis-compatible server, shared by every worker; tags are sets of keys."""
+
+    def __init__(self, url: str = CACHE_REDIS_URL):
+        import redis.asyncio as redis
+        self.client = redis.from_url(url)
+
+    async def get(self, key):
+        data = await self.client.get(key)
+        return _MISSING if data is None else pickle.loads(data)
+
+    async def set(self, key, value, ttl: float, tags=()):
+        if ttl <= 0:
+            return
+        expiry = None if math.isinf(ttl) else max(1, int(ttl * 1000))
+        async with self.client.pipeline(transaction=False) as pipe:
+            pipe.set(key, pickle.dumps(value), px=expiry)
+            for tag in tags:
+                pipe.sadd(f"tag:{tag}", key)
+                # Entries of a namespace share a TTL, so the newest member expires last
+                if expiry is not None:
+                    pipe.pexpire(f"tag:{tag}", expiry)
+            await pipe.execute()
+
+    async def delete(self, key):
+        await self.client.delete(key)
+
+    async def invalidate_tag(self, tag) -> int:
+        keys = await self.client.smembers(f"tag:{tag}")
+        await self.client.delete(*keys, f"tag:{tag}")
+        return len(keys)
+
+
+_backend = None
+
+
+def get_backend():
+    global _backend
+    if _backend is None:
+        if CACHE_BACKEND == 'redis':
+            try:
+                _backend = RedisBackend(CACHE_REDIS_URL)
+            except ImportError:
+                logger.warning("CACHE_BACKEND=redis but the redis package is not installed; caching in memory")
+                _backend = MemoryBackend()
+        else:
+            _backend = MemoryBackend()
+    return _backend
+
+
+# --- Namespaces ---
+
+caches = {}
+
+
+class Cache:
+    """A namespace of the shared backend: keys and tags are stored as '<namespace>:<key>'.
+
+    ``get_or_load`` coalesces concurrent misses in this worker onto one load.
+    Backend failures are logged and treated as misses, so an unreachable cache
+    server slows requests down instead of failing them.
+    """
+
+    def __init__(self, namespace: str, ttl: float = 300, backend=None):
+        self.namespace = namespace
+        self.ttl = ttl
+        self._backend = backend
+        self._inflight = {}
+        # tag -> keys with a load in flight, so invalidating a tag only stops those loads
+        self._inflight_tags = defaultdict(set)
+        self.metrics = {'hits': 0, 'misses': 0, 'loads': 0, 'load_errors': 0, 'coalesced': 0,
+                        'invalidations': 0, 'backend_errors': 0}
+        caches[namespace] = self
+
+    @property
+    def backend(self):
+        return self._backend or get_backend()
+
+    def _key(self, key) -> str:
+        return f"{self.namespace}:{key}"
+
+    async def get(self, key, default=None):
+        try:
+            value = await self.backend.get(self._key(key))
+        except Exception:
+            self.metrics['backend_errors'] += 1
+            logger.exception(f"Cache get failed in {self.namespace}")
+            value = _MISSING
+        self.metrics['hits' if value is not _MISSING else 'misses'] += 1
+        return default if value is _MISSING else value
+
+    async def set(self, key, value, ttl: float = None, tags=()):
+        try:
+            await self.backend.set(self._key(key), value, self.ttl if ttl is None else ttl,
+                                   [self._key(tag) for tag in tags])
+        except Exception:
+            self.metrics['backend_errors'] += 1
+            logger.exception(f"Cache set failed in {self.namespace}")
+
+    async def delete(self, key):
+        # A load already in flight may have read the old data; do not let it populate the cache
+        self._inflight.pop(key, None)
+        self.metrics['invalidations'] += 1
+        try:
+            await self.backend.delete(self._key(key))
+        except Exception:
+            self.metrics['backend_errors'] += 1
+            logger.exception(f"Cache delete failed in {self.namespace}")
+
+    async def invalidate_tag(self, tag):
+        for key in self._inflight_tags.pop(tag, ()):
+            self._inflight.pop(key, None)
+        self.metrics['invalidations'] += 1
+        try:
+            await self.backend.invalidate_tag(self._key(tag))
+        except Exception:
+            self.metrics['backend_errors'] += 1
+            logger.exception(f"Cache invalidation failed in {self.namespace}")
+
+    async def get_or_load(self, key, loader, ttl: float = None, tags=()):
+        ttl = self.ttl if ttl is None else ttl
+        if ttl > 0:
+            value = await self.get(key, _MISSING)
+            if value is not _MISSING:
+                return value
+        return await self.refresh(key, loader, ttl, tags)
+
+    async def refresh(self, key, loader, ttl: float = None, tags=()):
+        """Load `key` whatever is cached, e.g. to revalidate a stale entry; coalesced with other loads."""
+        ttl = self.ttl if ttl is None else ttl
+
+        async def load():
+            self.metrics['loads'] += 1
+            try:
+                return await loader()
+            except Exception:
+                self.metrics['load_errors'] += 1
+                raise
+
+        if key in self._inflight:
+            self.metrics['coalesced'] += 1
+        for tag in tags:
+            self._inflight_tags[tag].add(key)
+        try:
+            value, owner = await coalesce(self._inflight, key, load)
+        finally:
+            if key not in self._inflight:
+                self._untrack(key, tags)
+        if owner and ttl > 0:
+            await self.set(key, value, ttl, tags)
+        return value
+
+    def _untrack(self, key, tags):
+        for tag in tags:
+            keys = self._inflight_tags.get(tag)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._inflight_tags[tag]
+
+    def stats(self) -> dict:
+        lookups = self.metrics['hits'] + self.metrics['misses']
+        return {**self.metrics, 'ttl': self.ttl,
+                'hit_ratio': round(self.metrics['hits'] / lookups, 4) if lookups else None}
+
+
+def _freeze(value):
+    """A hashable stand-in for a call argument."""
+    if isinstance(value, BaseModel):
+        return type(value), _freeze(value.dict())
+    if isinstance(value, dict):
+        return tuple(sorted((key, _freeze(item)) for key, item in value.items()))
+    if isinstance(value, (list, tuple, set)):
+        return tuple(_freeze(item) for item in value)
+    return value
+
+
+def single_flight(ttl: float = 0, maxsize: int = 1024, key=None, namespace: str = None):
+    """Coalesce concurrent calls of an async function that have equal arguments.
+
+    While a call is in flight, identical calls await its result instead of
+    running again; with `ttl` > 0 the result is also served for that many
+    seconds afterwards, from a `namespace` of the shared backend when one is
+    given, else from a local LRU of `maxsize`. `key(*args, **kwargs)` overrides
+    the default key, the bound arguments. Usable on route functions below the
+    router decorator: the wrapper keeps the signature FastAPI reads its
+    parameters from.
+    """
+    def decorator(func):
+        if namespace is None:
+            cache = AsyncLRUCache(maxsize=maxsize, ttl=ttl)
+            load = cache.get_or_load
+        else:
+            # A namespace may be shared with other functions, so each call passes its own ttl
+            cache = caches.get(namespace) or Cache(namespace, ttl)
+            load = functools.partial(cache.get_or_load, ttl=ttl)
+        signature = inspect.signature(func)
+
+        def call_key(args, kwargs):
+            if key is not None:
+                call = key(*args, **kwargs)
+            else:
+                bound = signature.bind(*args, **kwargs)
+                bound.apply_defaults()
+                call = _freeze(bound.arguments)
+            # Functions sharing a namespace are told apart by name
+            return call if namespace is None else f"{func.__name__}{call!r}"
+
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            return await load(call_key(args, kwargs), lambda: func(*args, **kwargs))
+
+        wrapper.cache = cache
+        return wrapper
+    return decorator
+
+
+@router.get("/")
+async def cache_stats():
+    return {'backend': type(get_backend()).__name__,
+            'namespaces': {namespace: cache.stats() for namespace, cache in caches.items()}}
@@ -0,0 +1,227 @@
+"""Precomputed cold-start recommendations per demographic segment.
+
+New users collapse into a small number of (gender, age group, location)
+segments, and their cold-start scores depend only on that segment.
+The rebuild job scores every observed segment once per model version and
+keeps the top items per segment in memory and on disk
+(<COLD_START_SEGMENT_DIR>/<model version>.json); unseen combinations are
+scored on demand and cached. Segment rankings are shared, so they carry no
+per-user signal: each keeps COLD_START_SEGMENT_CANDIDATES items, and a user is
+served the first COLD_START_SEGMENT_TOP_N of them they have not seen.
+
+    python -m components.cold_start_segments     # rebuild for the current model
+"""
+import asyncio
+import json
+import logging
+import os
+import time
+
+import numpy as np
+
+from .cache import AsyncLRUCache
+from .database import get_db_connection
+from .product_metadata import ProductMetadata, gender_department
+from .reranking import reranker
+from .user_features import encode_users, profile_key
+
+logger = logging.getLogger(__name__)
+
+SEGMENT_DIR = os.getenv("COLD_START_SEGMENT_DIR", "recommendation-model/segments")
+# Matches the "top 20 then filter by department" of the per-request path
+SEGMENT_TOP_N = int(os.getenv("COLD_START_SEGMENT_TOP_N", "20"))
+# Kept per segment so SEGMENT_TOP_N remain once a user's seen products are removed
+SEGMENT_CANDIDATES = int(os.getenv("COLD_START_SEGMENT_CANDIDATES", "100"))
+ON_DEMAND_SEGMENTS = int(os.getenv("COLD_START_ON_DEMAND_SEGMENTS", "10000"))
+
+OBSERVED_SEGMENTS_QUERY = """
+    SELECT u.id, u.age, u.gender, u.location, b.brand
+    FROM users u
+    JOIN brands b ON b.user_id = u.user_id
+"""
+
+
+def segment_key(demo_rows) -> str:
+    """Segment id for a user's (age, gender, location, brand) rows; brands do not affect it.
+
+    Users with the same key get the same encoded feature row, hence the same scores.
+    """
+    gender, group, location = profile_key(demo_rows)
+    return "|".join([str(gender), group, str(location)])
+
+
+def _representations(features, embeddings, biases):
+    # Same as LightFM.get_*_representations: fewer feature columns than embeddings
+    # are fine, more mean the features were not built with the model's vocabulary
+    # and LightFM.predict refuses them the same way
+    features = features.tocsr().astype(np.float32)
+    n = features.shape[1]
+    if n > embeddings.shape[0]:
+        raise ValueError(f"The feature matrix specifies more features than there are estimated "
+                         f"feature embeddings: {embeddings.shape[0]} vs {n}.")
+    return features @ biases[:n], features @ embeddings[:n]
+
+
+class SegmentRecommender:
+    def __init__(self, segment_dir: str = SEGMENT_DIR, top_n: int = SEGMENT_TOP_N,
+                 candidates: int = SEGMENT_CANDIDATES):
+        self.segment_dir = segment_dir
+        self.top_n = top_n
+        self.candidates = max(candidates, top_n)
+        self.version = None
+        self.built_at = None
+        self.segments = {}
+        self.known_user_ids = set()
+        self.on_demand = AsyncLRUCache(maxsize=ON_DEMAND_SEGMENTS, ttl=float('inf'))
+        # Scoring state kept after an in-process rebuild, for on-demand scoring
+        self._scoring = None
+
+    def ready_for(self, version: str) -> bool:
+        return self.version == version
+
+    def is_cold_start(self, user_id) -> bool:
+        try:
+            return int(user_id) not in self.known_user_ids
+        except ValueError:
+            return True
+
+    # --- Serving ---
+
+    def lookup(self, demo_rows):
+        key = segment_key(demo_rows)
+        recommendations = self.segments.get(key)
+        if recommendations is None:
+            recommendations = self.on_demand.get(key)
+        return recommendations
+
+    def for_user(self, recommendations: list, seen_ids) -> list:
+        """The first top_n items of a segment ranking the user has not seen; None when too few remain."""
+        seen = {int(product_id) for product_id in seen_ids}
+        unseen = [item for item in recommendations if item['id'] not in seen]
+        # A ranking shorter than `candidates` already holds every servable item
+        if len(unseen) < self.top_n and len(recommendations) >= self.candidates:
+            return None
+        return unseen[:self.top_n]
+
+    def remember(self, demo_rows, recommendations):
+        self.on_demand.set(segment_key(demo_rows), recommendations)
+
+    def score(self, demo_rows):
+        """Score an unseen segment from the in-memory state, if a rebuild ran in this process."""
+        if self._scoring is None:
+            return None
+        recommendations = self._score_features([demo_rows])[0]
+        self.remember(demo_rows, recommendations)
+        return recommendations
+
+    def _score_features(self, segment_rows: list):
+        model, item_biases, item_embeddings, metadata = self._scoring
+        features = encode_users(segment_rows)
+        _, user_embeddings = _representations(features, model.user_embeddings, model.user_biases)
+        # User biases do not change a user's ranking, so they are left out
+        scores = user_embeddings @ item_embeddings.T + item_biases
+
+        # Each segment ranks only its department, so it gets a full top_n
+        available = {}
+        results = []
+        for rows, row_scores in zip(segment_rows, scores):
+            department = gender_department(rows[0][1])
+            if department not in available:
+                available[department] = metadata.available(department)
+            # No purchases or promotions: segments are shared and outlive both
+            results.append(metadata.hydrate(reranker.rerank(row_scores, metadata, self.candidates, available[department])))
+        return results
+
+    # --- Building ---
+
+    async def observed_segments(self):
+        async with get_db_connection() as conn:
+            async with conn.cursor() as cur:
+                await cur.execute(OBSERVED_SEGMENTS_QUERY)
+                rows = await cur.fetchall()
+
+        users = {}
+        for user_pk, age, gender, location, brand in rows:
+            users.setdefault(user_pk, []).append((age, gender, location, brand))
+        # One representative user per segment
+        segments = {}
+        for demo_rows in users.values():
+            segments.setdefault(segment_key(demo_rows), demo_rows)
+        return list(segments.values())
+
+    async def rebuild(self, model, version, dataset, item_features, metadata: ProductMetadata, batch_size: int = 512):
+        """Score every observed segment; `metadata` is ordered by internal item index and stock-aware."""
+        started = time.monotonic()
+        item_biases, item_embeddings = await asyncio.to_thread(
+            _representations, item_features, model.item_embeddings, model.item_biases)
+        self._scoring = (model, item_biases, item_embeddings, metadata)
+
+        segment_rows = await self.observed_segments()
+        segments = {}
+        for start in range(0, len(segment_rows), batch_size):
+            batch = segment_rows[start:start + batch_size]
+            # Scored in a worker thread, one batch at a time, so requests keep being served
+            for rows, recommendations in zip(batch, await asyncio.to_thread(self._score_features, batch)):
+                segments[segment_key(rows)] = recommendations
+
+        self.segments = segments
+        self.known_user_ids = {int(user_id) for user_id in dataset.mapping()[0]}
+        self.version = version
+        self.built_at = time.time()
+        self.on_demand.clear()
+        await asyncio.to_thread(self.save)
+        logger.info(f"Scored {len(segments)} cold-start segments for model {version} "
+                    f"in {time.monotonic() - started:.1f}s")
+
+    # --- Persistence ---
+
+    def path_for(self, version: str) -> str:
+        return os.path.join(self.segment_dir, f"{version}.json")
+
+    def save(self):
+        os.makedirs(self.segment_dir, exist_ok=True)
+        path = self.path_for(self.version)
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({
+                'version': self.version,
+                'built_at': self.built_at,
+                'top_n': self.top_n,
+                'candidates': self.candidates,
+                'known_user_ids': sorted(self.known_user_ids),
+                'segments': self.segments,
+            }, f)
+        os.replace(tmp_path, path)
+
+    def load(self, version: str) -> bool:
+        try:
+            with open(self.path_for(version)) as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return False
+        if data.get('candidates') != self.candidates:
+            logger.info(f"Cold-start segments for model {version} keep {data.get('candidates', data['top_n'])} items "
+                        f"per segment, not {self.candidates}; ignored until the next rebuild")
+            return False
+        self.version = data['version']
+        self.built_at = data['built_at']
+        self.segments = data['segments']
+        self.known_user_ids = set(data['known_user_ids'])
+        self.on_demand.clear()
+        self._scoring = None
+        logger.info(f"Loaded {len(self.segments)} cold-start segments for model {version}")
+        return True
+
+
+segment_recommender = SegmentRecommender()
+
+
+def main():
+    from .cold_start_solution import rebuild_segments
+
+    logging.basicConfig(level=logging.INFO)
+    asyncio.run(rebuild_segments())
+
+
+if __name__ == "__main__":
+    main()
@@ -1,11 +1,20 @@
-from fastapi import HTTPException, APIRouter
-import joblib
+from fastapi import HTTPException, APIRouter, BackgroundTasks
 import numpy as np
 import pandas as pd
-from scipy.sparse import csr_matrix
 from typing import List
-from lightfm.data import Dataset
 from .database import get_db_connection
+from .analytics_store import read_product_events, store_available
+from .user_profiles import profile_service
+from .recommendation_cache import recommendation_cache
+from .cold_start_segments import segment_recommender
+from .model_registry import model_registry
+from . import user_features as user_feature_encoding
+from . import matrix_builder
+from .product_metadata import ProductMetadata, fetch_out_of_stock, gender_department
+from .reranking import reranker, promoted_mask
+from .seen_items import seen_items
+from .trending import trending
+import asyncio
 import logging
 
 router = APIRouter()
@@ -14,17 +23,15 @@ router = APIRouter()
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-# Load model
-model = joblib.load('recommendation-model/recommendation_hybrid_model.pkl')
+# The model comes from the registry and is hot-swapped when a new version is activated
+def on_model_swap(loaded):
+    # Cold-start users are encoded with the vocabulary the model was trained on
+    if not user_feature_encoding.load_version_vocabulary(loaded.path, loaded.model):
+        user_feature_encoding.clear_encoder()
+    # Serve precomputed segments from a previous rebuild of this model version, if any
+    segment_recommender.load(loaded.version)
 
-# Define the feature indices and total number of features
-feature_indices = {
-    'gender_male': 0,
-    'age_25': 1,
-    'location_Daegu': 2,
-    'brand_Perry_Ellis': 3
-}
-num_features = 100  # Ensure this matches your model's feature setup
+model_registry.on_swap('recommender', on_model_swap)
 
 # Preprocessing
 event_type_weights = {
@@ -44,63 +51,47 @@ async def get_user_data():
             return await cur.fetchall()
 
 async def get_product_data():
-    product_query = "SELECT id, product_category, product_Brand, department, product_name FROM products"
+    product_query = """
+        SELECT id, product_category, product_Brand, department, product_name, selling_price, max_margin
+        FROM products
+    """
     async with get_db_connection() as conn:
         async with conn.cursor() as cur:
             await cur.execute(product_query)
             return await cur.fetchall()
 
 async def get_event_data():
+    if store_available():
+        events = await asyncio.to_thread(read_product_events)
+        return list(zip(*(events.column(name).to_pylist() for name in events.column_names)))
+
     event_query = """
-        SELECT e.user_id, e.event_type, e.uri, 
-        CAST(SUBSTRING_INDEX(e.uri, '/', -1) AS UNSIGNED) AS product_id
+        SELECT e.user_id, e.event_type, e.uri, e.product_id
         FROM events e
-        JOIN products p ON p.id = CAST(SUBSTRING_INDEX(e.uri, '/', -1) AS UNSIGNED)
+        JOIN products p ON p.id = e.product_id
     """
     async with get_db_connection() as conn:
         async with conn.cursor() as cur:
             await cur.execute(event_query)
             return await cur.fetchall()
 
-async def get_user_demo_details(user_id: str):
-    user_query = """
-        SELECT u.age, u.gender, u.location, b.brand
-        FROM users u
-        JOIN brands b ON b.user_id = u.user_id
-        WHERE u.user_id = %s
-    """
+async def get_out_of_stock():
     async with get_db_connection() as conn:
-        async with conn.cursor() as cur:
-            await cur.execute(user_query, (user_id,))
-            return await cur.fetchall()
+        return await fetch_out_of_stock(conn)
 
-def create_feature_vector(user_demo_details):
-    feature_vector = [0] * num_features
-    for detail in user_demo_details:
-        age, gender, location, brand = detail
-        age_feature = f'age_{age}'
-        gender_feature = f'gender_{gender.lower()}'
-        location_feature = f'location_{location}'
-        brand_feature = f'brand_{brand}'
-        
-        if age_feature in feature_indices:
-            feature_vector[feature_indices[age_feature]] = 1
-        if gender_feature in feature_indices:
-            feature_vector[feature_indices[gender_feature]] = 1
-        if location_feature in feature_indices:
-            feature_vector[feature_indices[location_feature]] = 1
-        if brand_feature in feature_indices:
-            feature_vector[feature_indices[brand_feature]] = 1
-
-    return csr_matrix([feature_vector])
+async def get_user_demo_details(user_id: str):
+    profile = await profile_service.get(user_id)
+    return profile.demo_rows() if profile else []
 
 async def preprocess_data():
     user_data = await get_user_data()
     product_data = await get_product_data()
     event_data = await get_event_data()
+    out_of_stock = await get_out_of_stock()
 
     users_df = pd.DataFrame(user_data, columns=['id', 'age', 'gender', 'location'])
-    products_df = pd.DataFrame(product_data, columns=['id', 'product_category', 'product_Brand', 'department', 'product_name'])
+    products_df = pd.DataFrame(product_data, columns=['id', 'product_category', 'product_Brand', 'department', 'product_name',
+                                                      'selling_price', 'max_margin'])
     events_df = pd.DataFrame(event_data, columns=['user_id', 'event_type', 'uri', 'product_id'])
 
     events_df['event_weight'] = events_df['event_type'].map(event_type_weights)
@@ -110,61 +101,90 @@ async def preprocess_data():
 
     filtered_events = events_df[events_df['user_id'].isin(users_df['id']) & events_df['product_id'].isin(products_df['id'])]
 
-    users_df['age_group'] = pd.cut(users_df['age'], bins=[0, 18, 25, 35, 45, 55, 65, 100], labels=['0-18', '19-25', '26-35', '36-45', '46-55', '56-65', '65+'])
+    user_tokens = matrix_builder.user_feature_tokens(users_df)
+    item_tokens = matrix_builder.join_tokens(products_df, ['product_category', 'product_Brand', 'department'])
+
+    dataset = matrix_builder.fit_dataset(users_df['id'], products_df['id'], user_tokens, item_tokens)
 
-    dataset = Dataset()
-    dataset.fit(
-        users=(x for x in users_df['id']),
-        items=(x for x in products_df['id']),
-        user_features=(f"{row['gender']}_{row['age_group']}_{row['location']}" for index, row in users_df.iterrows()),
-        item_features=(f"{row['product_category']}_{row['product_Brand']}_{row['department']}" for index, row in products_df.iterrows())
-    )
+    (interactions_matrix, weights_matrix) = matrix_builder.build_interactions(
+        dataset, filtered_events['user_id'], filtered_events['product_id'], filtered_events['event_weight'])
 
-    (interactions_matrix, weights_matrix) = dataset.build_interactions(
-        (row['user_id'], row['product_id'], row['event_weight'])
-        for index, row in filtered_events.iterrows()
-    )
+    user_features = matrix_builder.build_user_features(dataset, users_df['id'], user_tokens)
+    item_features = matrix_builder.build_item_features(dataset, products_df['id'], item_tokens)
+    metadata = ProductMetadata.from_frame(list(dataset.mapping()[2]), products_df, out_of_stock)
 
-    user_features = dataset.build_user_features(
-        (row['id'], [f"{row['gender']}_{row['age_group']}_{row['location']}"])
-        for index, row in users_df.iterrows()
-    )
+    # Without a vocabulary artifact, encode cold-start users with this dataset's mapping
+    if user_feature_encoding.encoder is None:
+        loaded = await model_registry.get_async('recommender')
+        user_feature_encoding.set_encoder(user_feature_encoding.UserFeatureEncoder.from_dataset(dataset), loaded.model)
 
-    item_features = dataset.build_item_features(
-        (row['id'], [f"{row['product_category']}_{row['product_Brand']}_{row['department']}"])
-        for index, row in products_df.iterrows()
-    )
+    return dataset, user_features, item_features, interactions_matrix, weights_matrix, products_df, metadata
 
-    return dataset, user_features, item_features, interactions_matrix, weights_matrix, products_df
+async def rebuild_segments():
+    dataset, user_features, item_features, interactions_matrix, weights_matrix, products_df, metadata = await preprocess_data()
+    loaded = await model_registry.get_async('recommender')
+    await segment_recommender.rebuild(loaded.model, loaded.version, dataset, item_features, metadata)
+
+@router.post("/segments/rebuild", status_code=202)
+async def rebuild_segments_route(background_tasks: BackgroundTasks):
+    background_tasks.add_task(rebuild_segments)
+    loaded = await model_registry.get_async('recommender')
+    return {"message": "Segment rebuild started", "model_version": loaded.version}
 
 @router.get("/recommend/{user_id}", response_model=List[dict])
 async def recommend_products(user_id: str):
-    dataset, user_features, item_features, interactions_matrix, weights_matrix, products_df = await preprocess_data()
-    
-    user_demo_details = await get_user_demo_details(user_id)
+    # Pin one model version for the whole request; a hot-swap only affects later requests
+    loaded = await model_registry.get_async('recommender')
+    # Results are cached per user and model version
+    return await recommendation_cache.get('cold_start', user_id, loaded.version,
+                                          lambda: compute_recommendations(user_id, loaded))
+
+async def compute_recommendations(user_id: str, loaded):
+    profile = await profile_service.get(user_id)
+    user_demo_details = profile.demo_rows() if profile else []
     if not user_demo_details:
         raise HTTPException(status_code=404, detail="User not found")
 
-    user_features_csr = create_feature_vector(user_demo_details)
+    model = loaded.model
+
+    # New users are served from the precomputed segment table, scored on demand if unseen
+    cold_start = segment_recommender.ready_for(loaded.version) and segment_recommender.is_cold_start(user_id)
+    if cold_start:
+        recommendations = segment_recommender.lookup(user_demo_details)
+        if recommendations is None:
+            recommendations = segment_recommender.score(user_demo_details)
+        if recommendations is not None:
+            # Segment rankings are shared: the user's seen products are removed per request
+            served = segment_recommender.for_user(recommendations, await seen_items.get(user_id))
+            if served is not None:
+                return served
+
+    dataset, user_features, item_features, interactions_matrix, weights_matrix, products_df, metadata = await preprocess_data()
+
+    user_features_csr = profile.feature_vector
     
     user_mapping = dataset.mapping()[0]
-    item_mapping = dataset.mapping()[2]
 
     if int(user_id) in user_mapping:
         user_index = user_mapping[int(user_id)]
         user_predictions = model.predict(user_index, np.arange(item_features.shape[0]), user_features=user_features, item_features=item_features)
         logger.info(f"Existing user {user_id} found. Predictions calculated.")
+        cold_start = False
     else:
         user_predictions = model.predict(0, np.arange(item_features.shape[0]), user_features=user_features_csr, item_features=item_features)
         logger.info(f"New user {user_id}. Cold start predictions calculated.")
 
-    top_items_indices = np.argsort(-user_predictions)[:20]
-    top_item_ids = [item_mapping[i] for i in top_items_indices]
-
-    # Filter products based on user's gender
-    user_gender = 'men' if user_demo_details[0][1].lower() == 'm' else 'women'
-    filtered_top_item_ids = [id for id in top_item_ids if products_df.loc[products_df['id'] == id, 'department'].values[0].lower() == user_gender]
-
-    top_items_details = [{'id': id, 'product_name': products_df.loc[products_df['id'] == id, 'product_name'].values[0]} for id in filtered_top_item_ids]
-
+    # Only in-stock products of the user's gender's department are ranked, so the top 20 are all servable;
+    # business rules then re-rank them
+    available = metadata.available(gender_department(user_demo_details[0][1]))
+    top = reranker.rerank(user_predictions, metadata, 20, available,
+                          exclude_ids=await seen_items.get(user_id), promoted=await promoted_mask(metadata),
+                          trending=trending.signal(metadata))
+    top_items_details = metadata.hydrate(top)
+
+    if cold_start:
+        # Segments are shared by all their users and outlive promotions and trending, so only the
+        # ranking without this user's seen products, promotions or trending is remembered
+        segment_top = reranker.rerank(user_predictions, metadata, segment_recommender.candidates, available)
+        segment_recommender.remember(user_demo_details, metadata.hydrate(segment_top))
     return top_items_details
@@ -1,17 +1,62 @@
-from fastapi import APIRouter, Depends
+from fastapi import APIRouter, Depends, HTTPException
+from fastapi.responses import StreamingResponse
 import aiomysql
-from typing import List
+import asyncio
+import os
+from typing import List, Optional
+from datetime import date, datetime, time, timedelta
 import pytz
 
 from models import UserProductPreference, Product
 
 # Assuming DB_CONFIG and get_db_connection() are defined in your database module
 from .database import get_db_connection
+from .analytics_store import analytics_store
+from .export_formats import MEDIA_TYPES, encode_rows, load_pyarrow, validate_export
+from .product_sampler import product_sampler, fetch_products_by_ids
 
 router = APIRouter()
 
+# Time zone used to interpret start/end dates when the caller does not pass one
+DEFAULT_TIMEZONE = os.getenv("DEFAULT_TIMEZONE", "UTC")
+EXPORT_BATCH_SIZE = int(os.getenv("EXPORT_BATCH_SIZE", "5000"))
 
-async def fetch_combined_data(start_date: str = None, end_date: str = None):
+COMBINED_DATA_COLUMNS = ['product_name', 'category_code', 'brand', 'age', 'gender', 'location', 'event_type', 'event_time']
+
+
+def combined_data_schema():
+    pa = load_pyarrow()
+    return pa.schema([
+        ('product_name', pa.string()),
+        ('category_code', pa.string()),
+        ('brand', pa.string()),
+        ('age', pa.int32()),
+        ('gender', pa.string()),
+        ('location', pa.string()),
+        ('event_type', pa.string()),
+        ('event_time', pa.timestamp('us', tz='UTC')),
+    ])
+
+
+def to_utc_range(start_date: Optional[date], end_date: Optional[date], timezone_name: str):
+    """Convert local calendar days [start_date, end_date] to a half-open UTC range."""
+    try:
+        timezone = pytz.timezone(timezone_name)
+    except pytz.UnknownTimeZoneError:
+        raise HTTPException(status_code=400, detail=f"Unknown time zone '{timezone_name}'")
+
+    def local_midnight_utc(day: date) -> datetime:
+        # Naive UTC, matching the session time zone set before querying
+        return timezone.localize(datetime.combine(day, time.min)).astimezone(pytz.UTC).replace(tzinfo=None)
+
+    start = local_midnight_utc(start_date) if start_date else None
+    end = local_midnight_utc(end_date + timedelta(days=1)) if end_date else None
+    return start, end
+
+
+async def stream_combined_data(start_date: Optional[date] = None, end_date: Optional[date] = None,
+                               timezone: str = DEFAULT_TIMEZONE, batch_size: int = EXPORT_BATCH_SIZE):
+    """Yield batches of joined event/user/product rows from a server-side cursor."""
     query = """
         SELECT 
             p.product_name, 
@@ -24,71 +69,119 @@ async def fetch_combined_data(start_date: str = None, end_date: str = None):
             e.event_time
         FROM events e
         JOIN users u ON e.user_id = u.user_id
-        JOIN products p ON e.product_id = p.product_id
+        JOIN products p ON p.id = e.product_id
     """
 
+    conditions = []
     query_params = []
-    if start_date and end_date:
-        # Convert start_date and end_date to proper format
-        start_date = start_date + "T00:00:00"
-        end_date = end_date + "T23:59:59"
-
-        # Convert start_date and end_date to the appropriate time zone
-        timezone = pytz.timezone('Your_Time_Zone')  # Replace 'Your_Time_Zone' with the appropriate time zone
-        start_date = timezone.localize(datetime.fromisoformat(start_date)).astimezone(pytz.UTC)
-        end_date = timezone.localize(datetime.fromisoformat(end_date)).astimezone(pytz.UTC)
-
-        # Add condition for date range filtering
-        query += " WHERE e.event_time BETWEEN %s AND %s"
-        query_params.extend([start_date, end_date])
-
-    async with await get_db_connection() as conn:
-        async with conn.cursor(aiomysql.DictCursor) as cur:
+    start, end = to_utc_range(start_date, end_date, timezone)
+    if start:
+        conditions.append("e.event_time >= %s")
+        query_params.append(start)
+    if end:
+        conditions.append("e.event_time < %s")
+        query_params.append(end)
+    if conditions:
+        query += " WHERE " + " AND ".join(conditions)
+
+    # Compare and return event_time in UTC regardless of the server default
+    async with get_db_connection(time_zone='+00:00') as conn:
+        cur = await conn.cursor(aiomysql.SSDictCursor)
+        try:
             await cur.execute(query, query_params)
-            result = await cur.fetchall()
+            while True:
+                rows = await cur.fetchmany(batch_size)
+                if not rows:
+                    break
+                yield rows
+        except BaseException:
+            # Abandoned mid-stream (client disconnect): drop the connection
+            # instead of draining the remaining rows from the server.
+            conn.close()
+            raise
+        await cur.close()
+
+
+async def stream_combined_data_from_store(start_date: Optional[date] = None, end_date: Optional[date] = None,
+                                          timezone: str = DEFAULT_TIMEZONE, batch_size: int = EXPORT_BATCH_SIZE):
+    """Same rows as stream_combined_data, read from the local columnar extract."""
+    pa = load_pyarrow()
+    import pyarrow.dataset as ds
+
+    # Inner-join semantics: only events that matched both a user and a product
+    condition = ds.field('user_pk').is_valid() & ds.field('product_id').is_valid()
+    start, end = to_utc_range(start_date, end_date, timezone)
+    if start:
+        condition &= ds.field('event_time') >= pa.scalar(start, type=pa.timestamp('us', tz='UTC'))
+    if end:
+        condition &= ds.field('event_time') < pa.scalar(end, type=pa.timestamp('us', tz='UTC'))
+
+    batches = analytics_store.scan_batches(
+        columns=COMBINED_DATA_COLUMNS,
+        start_date=start.date() if start else None,
+        end_date=(end - timedelta(microseconds=1)).date() if end else None,
+        filter=condition,
+        batch_size=batch_size,
+    )
+    while True:
+        batch = await asyncio.to_thread(next, batches, None)
+        if batch is None:
+            break
+        yield batch.to_pylist()
+
+
+async def fetch_combined_data(start_date: Optional[date] = None, end_date: Optional[date] = None,
+                              timezone: str = DEFAULT_TIMEZONE):
+    result = []
+    async for rows in stream_combined_data(start_date, end_date, timezone):
+        result.extend(rows)
     return result
 
-@router.get("/combined-data/", response_model=List)
-async def combined_data_route():
-    data = await fetch_combined_data()
-    return data
+@router.get("/combined-data/")
+async def combined_data_route(start_date: Optional[date] = None, end_date: Optional[date] = None,
+                              timezone: str = DEFAULT_TIMEZONE, format: str = 'json',
+                              compression: Optional[str] = None, source: str = 'db'):
+    validate_export(format, compression)
+    if source not in ('db', 'store'):
+        raise HTTPException(status_code=400, detail="source must be 'db' or 'store'")
+    if source == 'store' and not analytics_store.has_data():
+        raise HTTPException(status_code=503, detail="Analytics store has not been synced yet")
+    if start_date and end_date and start_date > end_date:
+        raise HTTPException(status_code=400, detail="start_date must not be after end_date")
+    to_utc_range(start_date, end_date, timezone)  # reject bad time zones before streaming starts
+    if format in ('parquet', 'arrow') or source == 'store':
+        load_pyarrow()
+
+    stream = stream_combined_data_from_store if source == 'store' else stream_combined_data
+    body = encode_rows(stream(start_date, end_date, timezone), format,
+                       COMBINED_DATA_COLUMNS, combined_data_schema, compression)
+    headers = {'Content-Disposition': f'attachment; filename="combined-data.{format}"'}
+    if compression == 'gzip' and format not in ('parquet', 'arrow'):
+        headers['Content-Encoding'] = 'gzip'
+    return StreamingResponse(body, media_type=MEDIA_TYPES[format], headers=headers)
 
 @router.post("/user-preference/")
 async def save_user_product_preference(preference: UserProductPreference):
     query = "INSERT INTO user_preferences (user_id, product_id) VALUES (%s, %s)"
-    async with await get_db_connection() as conn:
+    async with get_db_connection() as conn:
         async with conn.cursor() as cur:
             await cur.execute(query, (preference.user_id, preference.product_id))
             await conn.commit()
     return {"message": "User preference saved successfully"}
 
 
-# get a category randomly from the database product table
+# get a category randomly from the in-memory product sampling index
 @router.get("/categories/")
 async def fetch_random_category():
-    query = """
-        SELECT DISTINCT product_category
-        FROM products
-        ORDER BY RAND()
-        LIMIT 1
-    """
-    async with await get_db_connection() as conn:
-        async with conn.cursor(aiomysql.DictCursor) as cur:
-            await cur.execute(query)
-            category = await cur.fetchone()
-            return category['category']
+    await product_sampler.ensure_fresh()
+    category = product_sampler.random_category()
+    if category is None:
+        raise HTTPException(status_code=404, detail="No categories found")
+    return category
 
 @router.get("/products/{category}/", response_model=List[Product])
-async def fetch_random_products_by_category(category: str):
-    query = """
-        SELECT id, name, category, image_url
-        FROM products
-        WHERE category = %s
-        ORDER BY RAND()
-        LIMIT 3
-    """
-    async with await get_db_connection() as conn:
-        async with conn.cursor(aiomysql.DictCursor) as cur:
-            await cur.execute(query, (category,))
-            products = await cur.fetchall()
-            return [Product(**product) for product in products]
+async def fetch_random_products_by_category(category: str, weighted: bool = False):
+    await product_sampler.ensure_fresh()
+    product_ids = product_sampler.sample_products(category, 3, weighted=weighted)
+    products = await fetch_products_by_ids(product_ids)
+    return [Product(**product) for product in products]
@@ -0,0 +1,292 @@
+"""Online click-through rate per product, recommendation source and slot.
+
+Fed by the tracking routes instead of joining the impressions and clicks
+tables:
+
+- an impression is held as pending under (user, product) for
+  CTR_ATTRIBUTION_WINDOW seconds; a click on the same (user, product) within
+  the window is attributed to it, with the impression's source and slot, and
+  consumes it, so repeated clicks do not count twice and clicks without an
+  impression (e.g. ones arriving after the window) are only counted as
+  unattributed;
+- impressions and attributed clicks are exponentially decayed counts
+  (CTR_HALF_LIFE) per product, source, slot and (product, source), each
+  updated and read in O(1);
+- rates are Beta-smoothed towards the overall CTR: CTR_PRIOR_STRENGTH
+  pseudo-impressions at that rate, so rarely shown products are not ranked
+  on a handful of impressions.
+
+Like the trending counters, estimates are per worker and checkpointed to a
+per-worker slot of CTR_CHECKPOINT_PATH every CTR_CHECKPOINT_SECONDS and on
+shutdown.
+
+Attribution joins impressions and clicks inside one worker, so with more than
+one worker the tracking routes must be partitioned by user: route
+/tracking/impression/{user_id}/... and /tracking/click/{user_id}/... to a
+worker chosen by hashing user_id (e.g. nginx ``hash $user_id consistent``
+upstreams, one uvicorn process each). Otherwise a click handled by another
+worker than its impression counts as unattributed and CTR is understated;
+a rising ``unattributed`` / ``clicks`` ratio in GET /ctr/ shows it. Set
+CTR_STICKY_ROUTING=true once routing is partitioned.
+"""
+import asyncio
+import logging
+import os
+import pickle
+import time
+from collections import OrderedDict
+from typing import List, Optional
+
+from fastapi import APIRouter, HTTPException
+from pydantic import BaseModel
+
+from .trending import claim_checkpoint_slot
+
+logger = logging.getLogger(__name__)
+
+CTR_ATTRIBUTION_WINDOW = float(os.getenv("CTR_ATTRIBUTION_WINDOW", "1800"))
+CTR_HALF_LIFE = float(os.getenv("CTR_HALF_LIFE", "604800"))
+CTR_PRIOR_STRENGTH = float(os.getenv("CTR_PRIOR_STRENGTH", "100"))
+# Prior rate until enough impressions were seen to use the overall CTR
+CTR_DEFAULT_RATE = float(os.getenv("CTR_DEFAULT_RATE", "0.02"))
+# Pending impressions kept for attribution; the oldest are dropped beyond it
+CTR_MAX_PENDING = int(os.getenv("CTR_MAX_PENDING", "1000000"))
+CTR_CHECKPOINT_PATH = os.getenv("CTR_CHECKPOINT_PATH", "recommendation-model/ctr.pkl")
+CTR_CHECKPOINT_SECONDS = float(os.getenv("CTR_CHECKPOINT_SECONDS", "300"))
+CTR_BATCH_MAX = int(os.getenv("CTR_BATCH_MAX", "1000"))
+CTR_STICKY_ROUTING = os.getenv("CTR_STICKY_ROUTING", "false").lower() == "true"
+# Accepted impression sources (the recommending routes) and slots; anything else is rejected
+CTR_SOURCES = frozenset(
+    source.strip() for source in os.getenv("CTR_SOURCES", "hybrid,cold_start,recommendations,trending").split(',')
+    if source.strip())
+CTR_MAX_SLOT = int(os.getenv("CTR_MAX_SLOT", "100"))
+# Keys per dimension; the least recently updated are evicted beyond it
+CTR_MAX_ENTRIES = int(os.getenv("CTR_MAX_ENTRIES", "500000"))
+
+DIMENSIONS = ('product', 'source', 'slot', 'product_source')
+UNKNOWN_SOURCE = 'unknown'
+
+router = APIRouter()
+
+
+def validate_source(source: Optional[str], slot: Optional[int] = None):
+    """Raise ValueError for a source or slot outside the accepted ones."""
+    if source is not None and source not in CTR_SOURCES:
+        raise ValueError(f"Unknown source {source!r}; choose from {sorted(CTR_SOURCES)}")
+    if slot is not None and not 0 <= slot <= CTR_MAX_SLOT:
+        raise ValueError(f"slot must be between 0 and {CTR_MAX_SLOT}")
+
+
+class DecayedCounts:
+    """key -> [impressions, clicks, updated_at], decayed by half-life when touched.
+
+    Entries are kept in update order, so the least recently updated one is
+    evicted in O(1) once there are more than max_entries.
+    """
+
+    def __init__(self, half_life: float = CTR_HALF_LIFE, max_entries: int = CTR_MAX_ENTRIES):
+        self.half_life = half_life
+        self.max_entries = max_entries
+        self.entries = {}
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def _decayed(self, entry, now: float):
+        factor = 0.5 ** (max(now - entry[2], 0.0) / self.half_life)
+        return entry[0] * factor, entry[1] * factor
+
+    def add(self, key, impressions: float, clicks: float, now: float):
+        entry = self.entries.pop(key, None)
+        if entry is None:
+            entry = [impressions, clicks, now]
+            if len(self.entries) >= self.max_entries:
+                del self.entries[next(iter(self.entries))]
+        else:
+            decayed_impressions, decayed_clicks = self._decayed(entry, now)
+            entry[0], entry[1], entry[2] = decayed_impressions + impressions, decayed_clicks + clicks, now
+        # Re-inserting moves the key to the most recently updated end
+        self.entries[key] = entry
+
+    def get(self, key, now: float):
+        entry = self.entries.get(key)
+        return (0.0, 0.0) if entry is None else self._decayed(entry, now)
+
+
+class CTREstimator:
+    def __init__(self, window: float = CTR_ATTRIBUTION_WINDOW, half_life: float = CTR_HALF_LIFE,
+                 prior_strength: float = CTR_PRIOR_STRENGTH, max_pending: int = CTR_MAX_PENDING,
+                 checkpoint_path: str = CTR_CHECKPOINT_PATH):
+        self.window = window
+        self.prior_strength = prior_strength
+        self.max_pending = max_pending
+        self.checkpoint_path = checkpoint_path
+        self._worker_checkpoint_path = None
+        self.counts = {dimension: DecayedCounts(half_life) for dimension in DIMENSIONS}
+        self.overall = DecayedCounts(half_life)
+        # (user, product) -> (shown at, source, slot), oldest first
+        self.pending = OrderedDict()
+        self.metrics = {'impressions': 0, 'clicks': 0, 'attributed': 0, 'unattributed': 0, 'expired': 0}
+
+    def _keys(self, product_id: int, source: str, slot: Optional[int]):
+        keys = [('product', product_id), ('source', source), ('product_source', (product_id, source))]
+        if slot is not None:
+            keys.append(('slot', slot))
+        return keys
+
+    def _expire(self, now: float):
+        while self.pending:
+            key, (shown_at, _, _) = next(iter(self.pending.items()))
+            if now - shown_at <= self.window and len(self.pending) <= self.max_pending:
+                break
+            del self.pending[key]
+            self.metrics['expired'] += 1
+
+    def record_impression(self, user_id, product_id, source: str = None, slot: int = None, now: float = None):
+        validate_source(source, slot)
+        now = time.time() if now is None else now
+        product_id, source = int(product_id), source or UNKNOWN_SOURCE
+        key = (str(user_id), product_id)
+        # A repeated impression takes over the pending one, which then went unclicked
+        self.pending.pop(key, None)
+        self.pending[key] = (now, source, slot)
+        self._expire(now)
+        for dimension, dimension_key in self._keys(product_id, source, slot):
+            self.counts[dimension].add(dimension_key, 1.0, 0.0, now)
+        self.overall.add(None, 1.0, 0.0, now)
+        self.metrics['impressions'] += 1
+
+    def record_click(self, user_id, product_id, now: float = None) -> bool:
+        """Attribute a click to the user's pending impression of the product; False when there is none."""
+        now = time.time() if now is None else now
+        product_id = int(product_id)
+        self.metrics['clicks'] += 1
+        shown = self.pending.pop((str(user_id), product_id), None)
+        if shown is None or now - shown[0] > self.window:
+            self.metrics['unattributed'] += 1
+            return False
+        _, source, slot = shown
+        for dimension, dimension_key in self._keys(product_id, source, slot):
+            self.counts[dimension].add(dimension_key, 0.0, 1.0, now)
+        self.overall.add(None, 0.0, 1.0, now)
+        self.metrics['attributed'] += 1
+        return True
+
+    def prior(self, now: float):
+        """(alpha, beta) of the Beta prior: prior_strength impressions at the overall CTR."""
+        impressions, clicks = self.overall.get(None, now)
+        rate = clicks / impressions if impressions >= self.prior_strength else CTR_DEFAULT_RATE
+        return rate * self.prior_strength, (1 - rate) * self.prior_strength
+
+    def estimate(self, dimension: str, key, now: float = None, prior=None) -> dict:
+        now = time.time() if now is None else now
+        alpha, beta = self.prior(now) if prior is None else prior
+        impressions, clicks = self.counts[dimension].get(key, now)
+        return {'impressions': round(impressions, 3), 'clicks': round(clicks, 3),
+                'ctr': round((clicks + alpha) / (impressions + alpha + beta), 6)}
+
+    def estimates(self, dimension: str, keys, now: float = None) -> list:
+        """Estimates for many keys under one prior."""
+        now = time.time() if now is None else now
+        prior = self.prior(now)
+        return [self.estimate(dimension, key, now, prior) for key in keys]
+
+    # --- Checkpoints ---
+
+    @property
+    def worker_checkpoint_path(self) -> str:
+        if self._worker_checkpoint_path is None:
+            self._worker_checkpoint_path = claim_checkpoint_slot(self.checkpoint_path)
+        return self._worker_checkpoint_path
+
+    def state(self) -> dict:
+        # Entries are updated in place, so copy them before the write thread pickles them
+        copy = lambda counts: {key: list(entry) for key, entry in counts.entries.items()}
+        return {'counts': {dimension: copy(counts) for dimension, counts in self.counts.items()},
+                'overall': copy(self.overall), 'saved_at': time.time()}
+
+    def save(self, state: dict = None):
+        state = self.state() if state is None else state
+        path = self.worker_checkpoint_path
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, 'wb') as f:
+            pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, path)
+
+    def load(self) -> bool:
+        if int(os.getenv("WEB_CONCURRENCY", "1")) > 1 and not CTR_STICKY_ROUTING:
+            logger.warning("Several workers without CTR_STICKY_ROUTING: clicks handled by another worker than "
+                           "their impression are unattributed, route tracking requests by user_id")
+        # Pending impressions are not checkpointed: their window is short next to a restart
+        path = self.worker_checkpoint_path
+        if not os.path.exists(path):
+            return False
+        try:
+            with open(path, 'rb') as f:
+                state = pickle.load(f)
+            for dimension, entries in state['counts'].items():
+                self.counts[dimension].entries = entries
+            self.overall.entries = state['overall']
+        except Exception:
+            logger.exception(f"Could not read CTR checkpoint {path}; starting empty")
+            return False
+        logger.info(f"CTR estimates restored for {len(self.counts['product'])} products "
+                    f"from {path}, a checkpoint {time.time() - state['saved_at']:.0f}s old")
+        return True
+
+    async def checkpoint_periodically(self, interval: float = CTR_CHECKPOINT_SECONDS):
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                # Snapshot on the event loop, write in a thread
+                await asyncio.to_thread(self.save, self.state())
+            except Exception:
+                logger.exception("CTR checkpoint failed")
+
+
+ctr_estimator = CTREstimator()
+
+
+class CTRBatch(BaseModel):
+    product_ids: List[int]
+    source: Optional[str] = None
+
+
+@router.get("/")
+async def ctr_overview():
+    """Per-source and per-slot CTR, for dashboards."""
+    now = time.time()
+    prior = ctr_estimator.prior(now)
+    by_dimension = {
+        dimension: {str(key): ctr_estimator.estimate(dimension, key, now, prior)
+                    for key in sorted(ctr_estimator.counts[dimension].entries, key=str)}
+        for dimension in ('source', 'slot')
+    }
+    alpha, beta = prior
+    return {'prior_ctr': alpha / (alpha + beta), 'metrics': ctr_estimator.metrics, **by_dimension}
+
+
+@router.get("/products/{product_id}")
+async def product_ctr(product_id: int, source: Optional[str] = None):
+    try:
+        validate_source(source)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    if source is None:
+        return ctr_estimator.estimate('product', product_id)
+    return ctr_estimator.estimate('product_source', (product_id, source))
+
+
+@router.post("/products/batch")
+async def product_ctr_batch(batch: CTRBatch):
+    if len(batch.product_ids) > CTR_BATCH_MAX:
+        raise HTTPException(status_code=400, detail=f"At most {CTR_BATCH_MAX} product ids per batch")
+    try:
+        validate_source(batch.source)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    if batch.source is None:
+        estimates = ctr_estimator.estimates('product', batch.product_ids)
+    else:
+        estimates = ctr_estimator.estimates('product_source', [(product_id, batch.source) for product_id in batch.product_ids])
+    return [{'product_id': product_id, **estimate} for product_id, estimate in zip(batch.product_ids, estimates)]
@@ -13,11 +13,72 @@ DB_CONFIG = {
     'db': os.getenv("DB_NAME"),
 }
 
+DB_POOL_MIN_SIZE = int(os.getenv("DB_POOL_MIN_SIZE", "2"))
+DB_POOL_MAX_SIZE = int(os.getenv("DB_POOL_MAX_SIZE", "10"))
+# Reconnect idle connections before MySQL's wait_timeout drops them
+DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", "3600"))
+
+# Opened by the application's startup; scripts and CLIs without it connect per call
+pool = None
+
+
+async def init_pool(minsize: int = DB_POOL_MIN_SIZE, maxsize: int = DB_POOL_MAX_SIZE):
+    global pool
+    if pool is None:
+        pool = await aiomysql.create_pool(minsize=minsize, maxsize=maxsize, pool_recycle=DB_POOL_RECYCLE,
+                                          **DB_CONFIG)
+    return pool
+
+
+async def close_pool():
+    global pool
+    if pool is not None:
+        pool.close()
+        await pool.wait_closed()
+        pool = None
+
+
+async def _set_time_zone(conn, time_zone: str) -> str:
+    async with conn.cursor() as cur:
+        await cur.execute("SELECT @@session.time_zone")
+        (previous,) = await cur.fetchone()
+        await cur.execute("SET time_zone = %s", (time_zone,))
+    return previous
+
 
 @asynccontextmanager
-async def get_db_connection():
-    conn = await aiomysql.connect(**DB_CONFIG)
+async def get_db_connection(time_zone: str = None):
+    """A connection, from the pool once the application opened it.
+
+    `time_zone` sets the session time zone for this use only: a pooled
+    connection gets its previous zone back before it is released, so other
+    users' DATE_FORMAT / MONTHNAME results never depend on which connection
+    they draw.
+    """
+    if pool is None:
+        conn = await aiomysql.connect(**DB_CONFIG)
+        try:
+            if time_zone is not None:
+                await _set_time_zone(conn, time_zone)
+            yield conn
+        finally:
+            conn.close()
+        return
+
+    conn = await pool.acquire()
+    previous_time_zone = None
     try:
+        if time_zone is not None:
+            previous_time_zone = await _set_time_zone(conn, time_zone)
         yield conn
     finally:
-        conn.close()
+        try:
+            # Discard uncommitted work and end the read snapshot, as closing the connection did;
+            # the pool would otherwise drop a connection still inside a transaction
+            await conn.rollback()
+            if previous_time_zone is not None:
+                async with conn.cursor() as cur:
+                    await cur.execute("SET time_zone = %s", (previous_time_zone,))
+        except Exception:
+            conn.close()
+        pool.release(conn)
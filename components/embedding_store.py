@@ -0,0 +1,125 @@
+"""Memory-mapped serving copy of the recommender's arrays.
+
+Training exports the LightFM embeddings and biases, the user feature
+vocabulary and the item id order as ``.npy`` files next to the pickled
+model:
+
+    <version>/embeddings/{user,item}_{embeddings,biases}.npy
+    <version>/embeddings/params.json                  LightFM constructor params
+    <version>/embeddings/user_feature_tokens.npy      sorted feature names
+    <version>/embeddings/user_feature_index.npy       their column indices
+    <version>/embeddings/item_ids.npy                 product id per item index
+
+Workers open them with ``np.load(mmap_mode='c')``: every uvicorn worker
+maps the same page-cache copy, and pages are only duplicated if written,
+which serving never does. (LightFM's Cython predict rejects read-only
+buffers, so ``mmap_mode='r'`` cannot be used for the model.) The pickle stays
+the training artifact: it carries the optimizer state that incremental
+training continues from.
+"""
+import json
+import logging
+import os
+
+import numpy as np
+from lightfm import LightFM
+
+logger = logging.getLogger(__name__)
+
+EMBEDDINGS_DIR = 'embeddings'
+MODEL_ARRAYS = ('user_embeddings', 'user_biases', 'item_embeddings', 'item_biases')
+
+
+def export(model: LightFM, mapping, directory: str) -> list:
+    """Write the serving arrays for a trained model; returns the file names written."""
+    os.makedirs(directory, exist_ok=True)
+    written = []
+
+    def save(name, array):
+        np.save(os.path.join(directory, f"{name}.npy"), np.ascontiguousarray(array))
+        written.append(f"{name}.npy")
+
+    for name in MODEL_ARRAYS:
+        save(name, getattr(model, name))
+    with open(os.path.join(directory, 'params.json'), 'w') as f:
+        json.dump({**model.get_params(), 'random_state': None}, f)
+    written.append('params.json')
+
+    _, user_feature_mapping, item_mapping, _ = mapping
+    # Only named features are looked up when encoding users; identity columns are skipped
+    named = sorted((token, index) for token, index in user_feature_mapping.items() if isinstance(token, str))
+    save('user_feature_tokens', np.array([token for token, _ in named], dtype=str))
+    save('user_feature_index', np.array([index for _, index in named], dtype=np.int32))
+    item_ids = list(item_mapping)
+    if all(isinstance(item_id, (int, np.integer)) for item_id in item_ids):
+        save('item_ids', np.array(item_ids, dtype=np.int64))
+    return written
+
+
+def has_store(version_path: str) -> bool:
+    return os.path.exists(os.path.join(version_path, EMBEDDINGS_DIR, 'params.json'))
+
+
+def _load(directory: str, name: str, mmap_mode: str = 'c'):
+    return np.load(os.path.join(directory, f"{name}.npy"), mmap_mode=mmap_mode)
+
+
+def load_model(directory: str) -> LightFM:
+    """A predict-only LightFM whose arrays are shared memory maps.
+
+    The optimizer state is not exported; the gradient and momentum slots
+    alias the embeddings only to satisfy LightFM's initialisation check, so
+    the returned model must not be trained.
+    """
+    with open(os.path.join(directory, 'params.json')) as f:
+        model = LightFM(**json.load(f))
+    for prefix in ('user', 'item'):
+        embeddings = _load(directory, f'{prefix}_embeddings')
+        biases = _load(directory, f'{prefix}_biases')
+        setattr(model, f'{prefix}_embeddings', embeddings)
+        setattr(model, f'{prefix}_biases', biases)
+        setattr(model, f'{prefix}_embedding_gradients', embeddings)
+        setattr(model, f'{prefix}_embedding_momentum', embeddings)
+        setattr(model, f'{prefix}_bias_gradients', biases)
+        setattr(model, f'{prefix}_bias_momentum', biases)
+    return model
+
+
+class MappedVocabulary:
+    """Read-only token -> column mapping over memory-mapped sorted arrays."""
+
+    def __init__(self, tokens: np.ndarray, index: np.ndarray, size: int):
+        self.tokens = tokens
+        self.index = index
+        self.size = size
+
+    def _position(self, token):
+        if not isinstance(token, str) or not len(self.tokens):
+            return None
+        position = int(np.searchsorted(self.tokens, token))
+        if position < len(self.tokens) and self.tokens[position] == token:
+            return position
+        return None
+
+    def __contains__(self, token) -> bool:
+        return self._position(token) is not None
+
+    def __getitem__(self, token) -> int:
+        position = self._position(token)
+        if position is None:
+            raise KeyError(token)
+        return int(self.index[position])
+
+    def __len__(self) -> int:
+        return self.size
+
+
+def load_vocabulary(directory: str) -> MappedVocabulary:
+    # Column count includes the identity features, which are not stored by name
+    size = _load(directory, 'user_embeddings', mmap_mode='r').shape[0]
+    return MappedVocabulary(_load(directory, 'user_feature_tokens', 'r'), _load(directory, 'user_feature_index', 'r'), size)
+
+
+def load_item_ids(directory: str):
+    path = os.path.join(directory, 'item_ids.npy')
+    return np.load(path, mmap_mode='r') if os.path.exists(path) else None
@@ -0,0 +1,160 @@
+import csv
+import io
+import json
+import zlib
+from datetime import date, datetime
+from decimal import Decimal
+
+from fastapi import HTTPException
+
+# Streaming encoders: each takes an async iterator of row batches (lists of
+# dicts) and yields bytes, so large exports never sit in memory as a whole.
+
+MEDIA_TYPES = {
+    'json': 'application/json',
+    'ndjson': 'application/x-ndjson',
+    'csv': 'text/csv',
+    'parquet': 'application/vnd.apache.parquet',
+    'arrow': 'application/vnd.apache.arrow.stream',
+}
+
+TEXT_COMPRESSION = {'gzip'}
+PARQUET_COMPRESSION = {'snappy', 'gzip', 'zstd', 'lz4'}
+ARROW_COMPRESSION = {'zstd', 'lz4'}
+
+
+def load_pyarrow():
+    try:
+        import pyarrow
+        import pyarrow.parquet  # noqa: F401
+    except ImportError:
+        raise HTTPException(status_code=501, detail="Columnar export formats require pyarrow")
+    return pyarrow
+
+
+def validate_export(fmt: str, compression: str = None):
+    if fmt not in MEDIA_TYPES:
+        raise HTTPException(status_code=400, detail=f"Unsupported format '{fmt}', expected one of {sorted(MEDIA_TYPES)}")
+    if compression is None:
+        return
+    if fmt == 'parquet':
+        allowed = PARQUET_COMPRESSION
+    elif fmt == 'arrow':
+        allowed = ARROW_COMPRESSION
+    else:
+        allowed = TEXT_COMPRESSION
+    if compression not in allowed:
+        raise HTTPException(status_code=400, detail=f"Unsupported compression '{compression}' for {fmt}, expected one of {sorted(allowed)}")
+
+
+def _json_default(value):
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    if isinstance(value, Decimal):
+        return float(value)
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+async def encode_ndjson(batches):
+    async for rows in batches:
+        yield "".join(json.dumps(row, default=_json_default) + "\n" for row in rows).encode()
+
+
+async def encode_json(batches):
+    # A single JSON array, written element by element
+    yield b"["
+    first = True
+    async for rows in batches:
+        if not rows:
+            continue
+        chunk = ",".join(json.dumps(row, default=_json_default) for row in rows)
+        yield (chunk if first else "," + chunk).encode()
+        first = False
+    yield b"]"
+
+
+async def encode_csv(batches, columns):
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, fieldnames=columns, extrasaction='ignore')
+    writer.writeheader()
+    async for rows in batches:
+        writer.writerows(rows)
+        yield buffer.getvalue().encode()
+        buffer.seek(0)
+        buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue().encode()
+
+
+class _ChunkSink:
+    """Write-only file object that hands written bytes back to the caller.
+
+    Tracks the absolute position so Parquet footers get correct offsets
+    even though the buffered chunks are drained after every batch.
+    """
+
+    def __init__(self):
+        self.chunks = []
+        self.position = 0
+        self.closed = False
+
+    def write(self, data):
+        data = bytes(data)
+        self.chunks.append(data)
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def drain(self) -> bytes:
+        data = b"".join(self.chunks)
+        self.chunks = []
+        return data
+
+
+async def encode_columnar(batches, schema, fmt: str, compression: str = None):
+    pa = load_pyarrow()
+    sink = _ChunkSink()
+    handle = pa.PythonFile(sink, mode='w')
+    if fmt == 'parquet':
+        writer = pa.parquet.ParquetWriter(handle, schema, compression=compression or 'snappy')
+    else:
+        writer = pa.ipc.new_stream(handle, schema, options=pa.ipc.IpcWriteOptions(compression=compression))
+    try:
+        async for rows in batches:
+            if rows:
+                writer.write_batch(pa.RecordBatch.from_pylist(rows, schema=schema))
+                yield sink.drain()
+    finally:
+        writer.close()
+    yield sink.drain()
+
+
+async def gzip_stream(chunks):
+    compressor = zlib.compressobj(wbits=31)  # gzip container
+    async for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def encode_rows(batches, fmt: str, columns, arrow_schema=None, compression: str = None):
+    """Return an async byte stream for ``batches`` in the requested format."""
+    if fmt in ('parquet', 'arrow'):
+        return encode_columnar(batches, arrow_schema(), fmt, compression)
+
+    if fmt == 'csv':
+        body = encode_csv(batches, columns)
+    elif fmt == 'ndjson':
+        body = encode_ndjson(batches)
+    else:
+        body = encode_json(batches)
+    return gzip_stream(body) if compression == 'gzip' else body
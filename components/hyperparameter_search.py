@@ -0,0 +1,245 @@
+"""Parallel hyperparameter search for the hybrid LightFM recommender.
+
+Builds the training matrices once, places them in shared memory and runs
+trials across a process pool; workers map the shared arrays instead of
+receiving pickled copies. Strategies:
+
+    grid      every combination of SEARCH_GRID
+    random    --trials configurations sampled from SEARCH_SPACE
+    halving   successive halving: --trials random configurations trained for
+              --min-epochs, the best 1/--eta kept and retrained with eta times
+              the epochs, until one remains or --max-epochs is reached
+
+Every trial's precision@k, AUC and train time is logged; the best
+configuration is written as JSON for ``python -m components.training --params``.
+
+Usage:
+    python -m components.hyperparameter_search --strategy halving --trials 27 --workers 4
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import logging
+import math
+import os
+import random
+import time
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+
+import numpy as np
+from lightfm import LightFM
+from lightfm.cross_validation import random_train_test_split
+from scipy.sparse import coo_matrix, csr_matrix
+
+from . import training
+
+logger = logging.getLogger(__name__)
+
+BEST_PARAMS_PATH = os.path.join(training.MODEL_DIR, 'best_params.json')
+
+SEARCH_GRID = {
+    'no_components': [16, 30, 64],
+    'learning_rate': [0.01, 0.03, 0.05],
+    'user_alpha': [1e-5, 1e-4],
+    'item_alpha': [1e-5, 1e-4],
+}
+
+# (low, high, log scale) ranges for random and successive-halving sampling
+SEARCH_SPACE = {
+    'no_components': [8, 16, 30, 48, 64, 96, 128],
+    'learning_rate': (0.005, 0.1, True),
+    'user_alpha': (1e-6, 1e-3, True),
+    'item_alpha': (1e-6, 1e-3, True),
+}
+
+
+def grid_configs(grid: dict = SEARCH_GRID):
+    keys = list(grid)
+    return [dict(zip(keys, values)) for values in itertools.product(*(grid[key] for key in keys))]
+
+
+def sample_config(rng: random.Random, space: dict = SEARCH_SPACE) -> dict:
+    config = {}
+    for key, spec in space.items():
+        if isinstance(spec, list):
+            config[key] = rng.choice(spec)
+        else:
+            low, high, log = spec
+            config[key] = math.exp(rng.uniform(math.log(low), math.log(high))) if log else rng.uniform(low, high)
+    return config
+
+
+# --- Shared matrices ---
+
+def _share(arrays: dict):
+    """Copy arrays into shared memory blocks; returns (blocks, descriptors for workers)."""
+    blocks, descriptors = [], {}
+    for name, array in arrays.items():
+        block = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+        np.ndarray(array.shape, dtype=array.dtype, buffer=block.buf)[...] = array
+        blocks.append(block)
+        descriptors[name] = (block.name, array.dtype.str, array.shape)
+    return blocks, descriptors
+
+
+def share_matrices(train, test, user_features, item_features):
+    arrays, shapes = {}, {}
+    for name, matrix in (('train', train), ('test', test)):
+        matrix = matrix.tocoo()
+        arrays.update({f'{name}.row': matrix.row, f'{name}.col': matrix.col, f'{name}.data': matrix.data})
+        shapes[name] = matrix.shape
+    for name, matrix in (('user_features', user_features), ('item_features', item_features)):
+        matrix = matrix.tocsr()
+        arrays.update({f'{name}.data': matrix.data, f'{name}.indices': matrix.indices, f'{name}.indptr': matrix.indptr})
+        shapes[name] = matrix.shape
+    blocks, descriptors = _share(arrays)
+    return blocks, (descriptors, shapes)
+
+
+# Per worker process: attached blocks (kept referenced) and the rebuilt matrices
+_attached = []
+_matrices = {}
+
+
+def _attach(shared):
+    descriptors, shapes = shared
+    arrays = {}
+    for name, (block_name, dtype, shape) in descriptors.items():
+        block = shared_memory.SharedMemory(name=block_name)
+        _attached.append(block)
+        arrays[name] = np.ndarray(shape, dtype=np.dtype(dtype), buffer=block.buf)
+    for name in ('train', 'test'):
+        _matrices[name] = coo_matrix((arrays[f'{name}.data'], (arrays[f'{name}.row'], arrays[f'{name}.col'])),
+                                     shape=shapes[name])
+    for name in ('user_features', 'item_features'):
+        _matrices[name] = csr_matrix((arrays[f'{name}.data'], arrays[f'{name}.indices'], arrays[f'{name}.indptr']),
+                                     shape=shapes[name])
+
+
+def run_trial(config: dict, epochs: int, k: int, num_threads: int) -> dict:
+    train, test = _matrices['train'], _matrices['test']
+    user_features, item_features = _matrices['user_features'], _matrices['item_features']
+    started = time.monotonic()
+    model = LightFM(**{**training.DEFAULT_PARAMS, **config})
+    model.fit(train, user_features=user_features, item_features=item_features, epochs=epochs,
+              num_threads=num_threads)
+    train_seconds = time.monotonic() - started
+    metrics = training.evaluate(model, train, test, user_features, item_features, k, num_threads)
+    return {'config': config, 'epochs': epochs, 'metrics': metrics, 'train_seconds': round(train_seconds, 2)}
+
+
+# --- Search ---
+
+class SearchRunner:
+    def __init__(self, pool: ProcessPoolExecutor, metric: str, k: int, threads_per_trial: int):
+        self.pool = pool
+        self.metric = metric
+        self.k = k
+        self.threads_per_trial = threads_per_trial
+        self.trials = []
+
+    def score(self, trial: dict) -> float:
+        return trial['metrics'][self.metric]
+
+    def run(self, configs: list, epochs: int) -> list:
+        futures = [self.pool.submit(run_trial, config, epochs, self.k, self.threads_per_trial) for config in configs]
+        results = []
+        for future in futures:
+            trial = future.result()
+            logger.info(f"{trial['config']} x{epochs} epochs: {self.metric} {self.score(trial):.4f}, "
+                        f"test AUC {trial['metrics']['test_auc']:.4f}, {trial['train_seconds']}s")
+            results.append(trial)
+        self.trials.extend(results)
+        return results
+
+    def successive_halving(self, configs: list, min_epochs: int, max_epochs: int, eta: int) -> list:
+        epochs = min_epochs
+        while True:
+            results = self.run(configs, epochs)
+            if len(configs) <= 1 or epochs >= max_epochs:
+                return results
+            results.sort(key=self.score, reverse=True)
+            configs = [trial['config'] for trial in results[:max(1, len(results) // eta)]]
+            epochs = min(epochs * eta, max_epochs)
+
+    def best(self) -> dict:
+        return max(self.trials, key=self.score)
+
+
+async def load_split(source: str):
+    users_df, products_df, events_df = await training.fetch_training_frames(source)
+    events_df = training.clean_events(events_df, users_df, products_df)
+    _, interactions, _, user_features, item_features = training.build_matrices(users_df, products_df, events_df)
+    train, test = random_train_test_split(interactions, test_percentage=training.TEST_PERCENTAGE,
+                                          random_state=np.random.RandomState(training.SPLIT_SEED))
+    return train, test, user_features, item_features
+
+
+def search(train, test, user_features, item_features, strategy: str = 'halving', trials: int = 27,
+           workers: int = None, epochs: int = 20, min_epochs: int = 5, max_epochs: int = 45, eta: int = 3,
+           metric: str = None, k: int = training.PRECISION_K, seed: int = 0) -> dict:
+    workers = workers or os.cpu_count() or 1
+    threads_per_trial = max(1, (os.cpu_count() or 1) // workers)
+    metric = metric or f'test_precision_at_{k}'
+    rng = random.Random(seed)
+
+    blocks, shared = share_matrices(train, test, user_features, item_features)
+    started = time.monotonic()
+    try:
+        with ProcessPoolExecutor(max_workers=workers, initializer=_attach, initargs=(shared,)) as pool:
+            runner = SearchRunner(pool, metric, k, threads_per_trial)
+            if strategy == 'grid':
+                runner.run(grid_configs(), epochs)
+            elif strategy == 'random':
+                runner.run([sample_config(rng) for _ in range(trials)], epochs)
+            else:
+                runner.successive_halving([sample_config(rng) for _ in range(trials)], min_epochs, max_epochs, eta)
+    finally:
+        for block in blocks:
+            block.close()
+            block.unlink()
+
+    best = runner.best()
+    return {
+        'strategy': strategy,
+        'metric': metric,
+        'params': {**training.DEFAULT_PARAMS, **best['config']},
+        'epochs': best['epochs'],
+        'metrics': best['metrics'],
+        'n_trials': len(runner.trials),
+        'search_seconds': round(time.monotonic() - started, 1),
+        'trials': runner.trials,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Search LightFM hyperparameters across a process pool")
+    parser.add_argument('--strategy', choices=['grid', 'random', 'halving'], default='halving')
+    parser.add_argument('--source', choices=['db', 'store'], default='db')
+    parser.add_argument('--trials', type=int, default=27, help="random / halving configurations")
+    parser.add_argument('--workers', type=int, default=None, help="trial processes; defaults to all cores")
+    parser.add_argument('--epochs', type=int, default=20, help="epochs per grid / random trial")
+    parser.add_argument('--min-epochs', type=int, default=5)
+    parser.add_argument('--max-epochs', type=int, default=45)
+    parser.add_argument('--eta', type=int, default=3)
+    parser.add_argument('--metric', default=None, help="metrics key to maximise, default test_precision_at_<k>")
+    parser.add_argument('--k', type=int, default=training.PRECISION_K)
+    parser.add_argument('--output', default=BEST_PARAMS_PATH)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    train, test, user_features, item_features = asyncio.run(load_split(args.source))
+    result = search(train, test, user_features, item_features, args.strategy, args.trials, args.workers,
+                    args.epochs, args.min_epochs, args.max_epochs, args.eta, args.metric, args.k)
+
+    os.makedirs(os.path.dirname(args.output) or '.', exist_ok=True)
+    with open(args.output, 'w') as f:
+        json.dump(result, f, indent=2)
+    logger.info(f"Best of {result['n_trials']} trials ({result['metric']} "
+                f"{result['metrics'][result['metric']]:.4f}): {result['params']}; written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,397 @@
+"""Versioned model registry with atomic hot-swap.
+
+Each registered model has a root directory of immutable versions and a
+pointer file naming the active one:
+
+    <root>/<version>/<artifact>         e.g. recommendation_hybrid_model.pkl
+    <root>/<version>/metadata.json      {"files": {"<artifact>": "<sha256>"}, ...}
+    <root>/CURRENT                      active version
+    <root>/ACTIVATIONS                  "<timestamp> <version>" per activation, for rollback
+
+A new version is loaded and warmed up in a worker thread, then swapped in
+with a single reference assignment: requests already holding the previous
+``ModelVersion`` finish on it. Without a CURRENT pointer the model's legacy
+fixed path is served, as before the registry existed.
+
+    python -m components.model_registry list
+    python -m components.model_registry activate recommender 20240601T000000Z
+    python -m components.model_registry rollback recommender
+
+The CLI only moves the pointer; running workers pick it up through
+``watch`` (MODEL_WATCH_INTERVAL) or the admin endpoints. The admin endpoints
+require the ``X-Admin-Token`` header to match ADMIN_API_TOKEN and are refused
+while it is unset.
+"""
+import argparse
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import secrets
+import threading
+import time
+from datetime import datetime, timezone
+
+import joblib
+from fastapi import APIRouter, Depends, Header, HTTPException
+from pydantic import BaseModel
+
+logger = logging.getLogger(__name__)
+
+RECOMMENDATION_MODEL_DIR = os.getenv("RECOMMENDATION_MODEL_DIR", "recommendation-model")
+MODEL_WATCH_INTERVAL = float(os.getenv("MODEL_WATCH_INTERVAL", "30"))
+METADATA_FILE = 'metadata.json'
+ADMIN_API_TOKEN = os.getenv("ADMIN_API_TOKEN", "")
+
+
+def file_sha256(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _write_atomic(path: str, text: str):
+    tmp_path = os.path.join(os.path.dirname(path), f".{os.path.basename(path)}.tmp")
+    with open(tmp_path, 'w') as f:
+        f.write(text)
+    os.replace(tmp_path, path)
+
+
+def set_pointer(root: str, version: str):
+    """Make `version` the active version under `root` and log the activation."""
+    _write_atomic(os.path.join(root, 'CURRENT'), version + '\n')
+    with open(os.path.join(root, 'ACTIVATIONS'), 'a') as f:
+        f.write(f"{datetime.now(timezone.utc).isoformat()} {version}\n")
+
+
+class ModelVersion:
+    """One loaded, warmed-up model; never mutated after it is swapped in."""
+
+    def __init__(self, name: str, version: str, model, path: str, metadata: dict):
+        self.name = name
+        self.version = version
+        self.model = model
+        self.path = path
+        self.metadata = metadata
+        self.loaded_at = time.time()
+
+    def describe(self) -> dict:
+        return {'name': self.name, 'version': self.version, 'path': self.path, 'loaded_at': self.loaded_at,
+                'metrics': self.metadata.get('metrics')}
+
+
+class RegisteredModel:
+    def __init__(self, name: str, root: str, filename: str, loader, warmup=None, legacy_path: str = None):
+        self.name = name
+        self.root = root
+        self.filename = filename
+        self.loader = loader
+        self.warmup = warmup
+        self.legacy_path = legacy_path
+        self.current = None
+        self.state = 'pending'
+        self.error = None
+        self.callbacks = []
+        self.lock = threading.Lock()
+
+    @property
+    def pointer_path(self) -> str:
+        return os.path.join(self.root, 'CURRENT')
+
+    @property
+    def activations_path(self) -> str:
+        return os.path.join(self.root, 'ACTIVATIONS')
+
+    def pointer(self):
+        try:
+            with open(self.pointer_path) as f:
+                return f.read().strip() or None
+        except FileNotFoundError:
+            return None
+
+    def versions(self) -> list:
+        if not os.path.isdir(self.root):
+            return []
+        return sorted(entry for entry in os.listdir(self.root)
+                      if not entry.startswith('.') and os.path.isdir(os.path.join(self.root, entry)))
+
+    def activations(self) -> list:
+        try:
+            with open(self.activations_path) as f:
+                return [line.split()[1] for line in f if line.strip()]
+        except FileNotFoundError:
+            return []
+
+    def set_pointer(self, version: str):
+        if version not in self.versions():
+            raise ValueError(f"{self.name} has no version {version}")
+        set_pointer(self.root, version)
+
+    def load(self, version: str = None) -> ModelVersion:
+        """Load, verify and warm up a version (default: the pointer, else the legacy path)."""
+        version = version or self.pointer()
+        if version is None:
+            if not self.legacy_path:
+                raise FileNotFoundError(f"{self.name} has no active version")
+            # Pre-registry layout: the fixed file, versioned by its content hash
+            path, metadata = os.path.dirname(self.legacy_path) or '.', {}
+            artifact = self.legacy_path
+            version = file_sha256(artifact)[:16]
+        else:
+            path = os.path.join(self.root, version)
+            with open(os.path.join(path, METADATA_FILE)) as f:
+                metadata = json.load(f)
+            for filename, checksum in metadata.get('files', {}).items():
+                if file_sha256(os.path.join(path, filename)) != checksum:
+                    raise ValueError(f"Checksum mismatch for {self.name} {version}/{filename}")
+            artifact = os.path.join(path, self.filename)
+
+        started = time.monotonic()
+        model = self.loader(artifact)
+        if self.warmup is not None:
+            self.warmup(model)
+        logger.info(f"Loaded {self.name} {version} in {time.monotonic() - started:.2f}s")
+        return ModelVersion(self.name, version, model, path, metadata)
+
+
+class ModelRegistry:
+    def __init__(self):
+        self.models = {}
+        self._swap_lock = asyncio.Lock()
+
+    def register(self, name: str, root: str, filename: str, loader, warmup=None, legacy_path: str = None):
+        self.models[name] = RegisteredModel(name, root, filename, loader, warmup, legacy_path)
+
+    def entry(self, name: str) -> RegisteredModel:
+        try:
+            return self.models[name]
+        except KeyError:
+            raise KeyError(f"Unknown model {name}") from None
+
+    def get(self, name: str) -> ModelVersion:
+        """The active version; loaded in the calling thread on first use.
+
+        Only for worker threads: coroutines use ``get_async``.
+        """
+        entry = self.entry(name)
+        current = entry.current
+        if current is None:
+            with entry.lock:
+                if entry.current is None:
+                    self._swap(entry, entry.load())
+                current = entry.current
+        return current
+
+    async def get_async(self, name: str) -> ModelVersion:
+        """The active version; a first-use load runs in a worker thread."""
+        current = self.entry(name).current
+        if current is None:
+            current = await asyncio.to_thread(self.get, name)
+        return current
+
+    def on_swap(self, name: str, callback):
+        """callback(ModelVersion) runs after every swap, including the first load."""
+        self.entry(name).callbacks.append(callback)
+
+    def _swap(self, entry: RegisteredModel, loaded: ModelVersion):
+        entry.current = loaded
+        entry.state, entry.error = 'loaded', None
+        for callback in entry.callbacks:
+            try:
+                callback(loaded)
+            except Exception:
+                logger.exception(f"on_swap callback failed for {entry.name} {loaded.version}")
+
+    async def activate(self, name: str, version: str = None) -> ModelVersion:
+        """Load `version` (default: the pointer) in the background, then swap it in and point at it."""
+        entry = self.entry(name)
+        async with self._swap_lock:
+            return await asyncio.to_thread(self._activate, entry, version)
+
+    def _activate(self, entry: RegisteredModel, version: str = None) -> ModelVersion:
+        # Under the entry lock so a concurrent first-use get() cannot swap in a stale version afterwards
+        with entry.lock:
+            loaded = entry.load(version)
+            if version is not None and entry.pointer() != version:
+                entry.set_pointer(version)
+            self._swap(entry, loaded)
+        return loaded
+
+    async def rollback(self, name: str) -> ModelVersion:
+        entry = self.entry(name)
+        return await self.activate(name, previous_version(entry))
+
+    async def reload_if_changed(self, name: str):
+        entry = self.entry(name)
+        pointer = entry.pointer()
+        if pointer is not None and (entry.current is None or entry.current.version != pointer):
+            await self.activate(name)
+
+    async def preload(self, names: list = None):
+        """Load the active version of each model off the event loop; failures are recorded, not raised."""
+        for name in names if names is not None else list(self.models):
+            entry = self.entry(name)
+            if entry.current is not None:
+                continue
+            entry.state = 'loading'
+            try:
+                await self.activate(name)
+            except Exception as e:
+                entry.state, entry.error = 'failed', str(e)
+                logger.exception(f"Failed to load {name} at startup")
+
+    def status(self, names: list = None) -> dict:
+        return {name: {'state': self.entry(name).state, 'error': self.entry(name).error}
+                for name in (names if names is not None else self.models)}
+
+    async def watch(self, interval: float = MODEL_WATCH_INTERVAL):
+        """Poll the CURRENT pointers and hot-swap loaded models when one moves."""
+        while True:
+            await asyncio.sleep(interval)
+            for name, entry in self.models.items():
+                if entry.current is None:
+                    continue  # never used in this worker; loads lazily on first get()
+                try:
+                    await self.reload_if_changed(name)
+                except Exception:
+                    logger.exception(f"Failed to hot-swap {name}; keeping {entry.current.version}")
+
+
+def previous_version(entry: RegisteredModel) -> str:
+    current = entry.pointer()
+    for version in reversed(entry.activations()):
+        if version != current and version in entry.versions():
+            return version
+    raise ValueError(f"{entry.name} has no earlier version to roll back to")
+
+
+# --- Registered models ---
+
+def _warm_recommender(model):
+    model.predict(0, [0])
+
+
+def _load_recommender(path: str):
+    from . import embedding_store
+    # Versions exported by training are served from shared memory-mapped arrays
+    version_path = os.path.dirname(path)
+    if embedding_store.has_store(version_path):
+        return embedding_store.load_model(os.path.join(version_path, embedding_store.EMBEDDINGS_DIR))
+    return joblib.load(path)
+
+
+def _load_keras(path: str):
+    from keras.models import load_model
+    return load_model(path)
+
+
+def _warm_keras(model):
+    import numpy as np
+    model.predict(np.zeros((1,) + tuple(model.input_shape[1:]), dtype='float32'), verbose=0)
+
+
+def _warm_promotion(model):
+    import pandas as pd
+    # One synthetic row in the feature layout predict_promotions builds
+    columns = ['cost', 'product_category_encoded', 'product_department_encoded', 'day_of_week', 'week_of_year']
+    model.predict(pd.DataFrame([[0.0, 0, 0, 0, 1]], columns=columns))
+
+
+model_registry = ModelRegistry()
+model_registry.register(
+    'recommender', root=os.path.join(RECOMMENDATION_MODEL_DIR, 'versions'),
+    filename='recommendation_hybrid_model.pkl', loader=_load_recommender, warmup=_warm_recommender,
+    legacy_path=os.path.join(RECOMMENDATION_MODEL_DIR, 'recommendation_hybrid_model.pkl'))
+model_registry.register(
+    'price_optimization', root='price_optimization/versions', filename='price_optimization.h5',
+    loader=_load_keras, warmup=_warm_keras, legacy_path='price_optimization/price_optimization.h5')
+model_registry.register(
+    'promotion', root='components/promotion/versions', filename='Promotion_model.pkl',
+    loader=joblib.load, warmup=_warm_promotion, legacy_path='components/promotion/Promotion_model.pkl')
+
+
+# --- Admin endpoints ---
+
+def require_admin_token(x_admin_token: str = Header(None)):
+    if not ADMIN_API_TOKEN:
+        raise HTTPException(status_code=403, detail="Admin API is disabled; set ADMIN_API_TOKEN")
+    if x_admin_token is None or not secrets.compare_digest(x_admin_token, ADMIN_API_TOKEN):
+        raise HTTPException(status_code=401, detail="Invalid admin token")
+
+
+router = APIRouter(dependencies=[Depends(require_admin_token)])
+
+
+class ActivateRequest(BaseModel):
+    version: str
+
+
+def _entry_or_404(name: str) -> RegisteredModel:
+    try:
+        return model_registry.entry(name)
+    except KeyError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+
+
+@router.get("/")
+async def list_models():
+    return [
+        {'name': name, 'pointer': entry.pointer(), 'state': entry.state,
+         'loaded': entry.current.describe() if entry.current else None}
+        for name, entry in model_registry.models.items()
+    ]
+
+
+@router.get("/{name}/versions")
+async def list_versions(name: str):
+    entry = _entry_or_404(name)
+    return {'pointer': entry.pointer(), 'versions': entry.versions()}
+
+
+@router.post("/{name}/activate")
+async def activate_model(name: str, request: ActivateRequest):
+    _entry_or_404(name)
+    try:
+        loaded = await model_registry.activate(name, request.version)
+    except (ValueError, FileNotFoundError) as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return loaded.describe()
+
+
+@router.post("/{name}/rollback")
+async def rollback_model(name: str):
+    _entry_or_404(name)
+    try:
+        loaded = await model_registry.rollback(name)
+    except (ValueError, FileNotFoundError) as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return loaded.describe()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Inspect and move model registry pointers")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    subparsers.add_parser('list')
+    activate = subparsers.add_parser('activate')
+    activate.add_argument('name')
+    activate.add_argument('version')
+    rollback = subparsers.add_parser('rollback')
+    rollback.add_argument('name')
+    args = parser.parse_args()
+
+    if args.command == 'list':
+        for name, entry in model_registry.models.items():
+            print(f"{name}: current={entry.pointer()} versions={entry.versions()}")
+    elif args.command == 'activate':
+        model_registry.entry(args.name).set_pointer(args.version)
+    else:
+        entry = model_registry.entry(args.name)
+        entry.set_pointer(previous_version(entry))
+        print(f"{args.name}: current={entry.pointer()}")
+
+
+if __name__ == "__main__":
+    main()
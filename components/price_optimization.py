@@ -1,22 +1,30 @@
 import pandas as pd
-from keras.models import load_model
 from fastapi import APIRouter
 from .models import OptimizeInput  # Adjust the import path as necessary
+from .model_registry import model_registry
 from datetime import date, datetime
 import logging
+import os
 
 router = APIRouter()
 
 logger = logging.getLogger(__name__)
 
-with open("price_optimization/price_optimization.h5", "rb") as f:
-    model = load_model("price_optimization/price_optimization.h5") 
+PRICE_DATASET_PATH = os.getenv("PRICE_DATASET_PATH", 'price_optimization/product_price_dataset.csv')
 
-read_data = pd.read_csv('price_optimization/product_price_dataset.csv')
+read_data = None
+
+
+def price_data() -> pd.DataFrame:
+    # Read on first use rather than at import, so startup does not wait on the CSV
+    global read_data
+    if read_data is None:
+        read_data = pd.read_csv(PRICE_DATASET_PATH)
+    return read_data
 
 def get_price_optimization(product: str, product_category: str, cost: float, date: date,maxProfitMargin:float, minProfitMargin:float) -> float:
     
-    data = read_data
+    data = price_data()
     maximum_profit_margin =maxProfitMargin
     minimum_profit_margin =minProfitMargin
     data['Order_Date'] = pd.to_datetime(data['Order_Date'], errors='coerce')
@@ -75,7 +83,7 @@ def get_price_optimization(product: str, product_category: str, cost: float, dat
     sample_df = sample_df.reindex(columns=x.columns, fill_value=0)
     sample_df = pd.get_dummies(sample_df)
     
-    prediction = model.predict(sample_df)
+    prediction = model_registry.get('price_optimization').model.predict(sample_df)
 
    
     return  cost + cost * (maximum_profit_margin +((maximum_profit_margin - minimum_profit_margin )* prediction[0][0] /100))/100
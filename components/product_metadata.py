@@ -0,0 +1,151 @@
+"""Product attributes as NumPy arrays aligned to a dataset's internal item index.
+
+Built next to the LightFM dataset so post-scoring work never searches the
+products DataFrame: department/category/brand are int32 codes into small
+vocabularies, so filters are one vectorized comparison applied to the scores
+before top-k, and names are one UTF-8 buffer plus offsets, so hydrating a
+result is two array reads. Because filtering happens before top-k, a request
+for k items gets k items whenever that many pass the filters.
+"""
+import logging
+import os
+
+import aiomysql
+import numpy as np
+import pandas as pd
+
+logger = logging.getLogger(__name__)
+
+# Hide products whose inventory is sold out (inventory_items); off serves every product
+PRODUCT_STOCK_FILTER = os.getenv("PRODUCT_STOCK_FILTER", "true").lower() == "true"
+
+# A product is out of stock once it has inventory rows and every one of them is sold
+OUT_OF_STOCK_QUERY = """
+    SELECT product_id
+    FROM inventory_items
+    GROUP BY product_id
+    HAVING SUM(sold_at IS NULL) = 0
+"""
+
+CATEGORICAL_COLUMNS = ('department', 'category', 'brand')
+# products table column per attribute, as most queries select them
+DEFAULT_COLUMNS = {'department': 'department', 'category': 'product_category', 'brand': 'product_Brand',
+                   'name': 'product_name', 'selling_price': 'selling_price', 'max_margin': 'max_margin'}
+
+
+async def fetch_out_of_stock(conn) -> set:
+    if not PRODUCT_STOCK_FILTER:
+        return set()
+    try:
+        async with conn.cursor() as cur:
+            await cur.execute(OUT_OF_STOCK_QUERY)
+            return {int(row[0]) for row in await cur.fetchall() if row[0] is not None}
+    except aiomysql.MySQLError as e:
+        logger.warning(f"Stock lookup failed ({e}); treating every product as in stock")
+        return set()
+
+
+def gender_department(gender) -> str:
+    # The department a user's recommendations are restricted to, as the routes always did
+    return 'men' if str(gender).lower() == 'm' else 'women'
+
+
+def top_k(scores: np.ndarray, k: int, mask: np.ndarray = None) -> np.ndarray:
+    """Indices of the k best scores, best first; masked-out and -inf entries are never returned."""
+    if mask is not None:
+        scores = np.where(mask, scores, -np.inf)
+    k = min(k, len(scores))
+    if k <= 0:
+        return np.empty(0, dtype=np.int64)
+    top = np.argpartition(-scores, k - 1)[:k]
+    top = top[np.argsort(-scores[top], kind='stable')]
+    return top[np.isfinite(scores[top])]
+
+
+class ProductMetadata:
+    def __init__(self, item_ids: np.ndarray, codes: dict, vocabularies: dict, name_buffer: np.ndarray,
+                 name_offsets: np.ndarray, in_stock: np.ndarray, margin: np.ndarray = None, known: np.ndarray = None):
+        self.item_ids = item_ids
+        self.codes = codes
+        self.vocabularies = vocabularies
+        self.name_buffer = name_buffer
+        self.name_offsets = name_offsets
+        self.in_stock = in_stock
+        self._order = np.argsort(item_ids, kind='stable')
+        # max_margin / selling_price in [0, 1]; 0 where either is unknown
+        self.margin = np.zeros(len(item_ids), dtype=np.float32) if margin is None else margin
+        # Items with a products row; ones known only from events have no name or attributes to serve
+        self.known = np.ones(len(item_ids), dtype=bool) if known is None else known
+
+    @classmethod
+    def from_frame(cls, item_ids, products_df: pd.DataFrame, out_of_stock=(), columns: dict = None):
+        """Align products_df rows to `item_ids` (internal index order); unknown items get empty attributes."""
+        columns = {**DEFAULT_COLUMNS, **(columns or {})}
+        item_ids = np.asarray(item_ids, dtype=np.int64)
+        details = (products_df.assign(id=products_df['id'].astype(np.int64))
+                   .drop_duplicates('id').set_index('id').reindex(item_ids))
+
+        codes, vocabularies = {}, {}
+        for attribute in CATEGORICAL_COLUMNS:
+            column = columns[attribute]
+            values = details[column] if column in details else pd.Series(np.nan, index=details.index)
+            # Case-insensitive, as the department filter always compared lowercased values
+            attribute_codes, vocabulary = pd.factorize(values.astype('string').str.lower())
+            codes[attribute] = attribute_codes.astype(np.int32)
+            vocabularies[attribute] = np.asarray(vocabulary, dtype=object)
+
+        names = details[columns['name']].fillna('').astype(str).str.encode('utf-8')
+        lengths = names.str.len().to_numpy(dtype=np.int64)
+        name_offsets = np.zeros(len(item_ids) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=name_offsets[1:])
+        name_buffer = np.frombuffer(b''.join(names.tolist()), dtype=np.uint8)
+
+        in_stock = ~np.isin(item_ids, np.fromiter(out_of_stock, dtype=np.int64, count=len(out_of_stock)))
+
+        numeric = lambda column: (pd.to_numeric(details[column], errors='coerce') if column in details
+                                  else pd.Series(np.nan, index=details.index))
+        price = numeric(columns['selling_price'])
+        margin = (numeric(columns['max_margin']) / price.where(price > 0)).clip(0, 1)
+        margin = margin.fillna(0).to_numpy(dtype=np.float32)
+        known = np.isin(item_ids, products_df['id'].to_numpy(dtype=np.int64))
+        return cls(item_ids, codes, vocabularies, name_buffer, name_offsets, in_stock, margin, known)
+
+    def __len__(self) -> int:
+        return len(self.item_ids)
+
+    def indices(self, product_ids, return_found: bool = False):
+        """Item indices of the given product ids; ids not in the index are skipped.
+
+        With `return_found`, also returns the mask of `product_ids` that were found.
+        """
+        product_ids = np.asarray(product_ids, dtype=np.int64)
+        if len(self.item_ids) == 0 or len(product_ids) == 0:
+            found = np.zeros(len(product_ids), dtype=bool)
+            indices = np.empty(0, dtype=np.int64)
+        else:
+            positions = np.minimum(np.searchsorted(self.item_ids, product_ids, sorter=self._order),
+                                   len(self.item_ids) - 1)
+            found = self.item_ids[self._order[positions]] == product_ids
+            indices = self._order[positions[found]]
+        return (indices, found) if return_found else indices
+
+    def code(self, attribute: str, value) -> int:
+        # Missing attributes are coded -1, so a value that never occurs gets -2 and matches nothing
+        matches = np.flatnonzero(self.vocabularies[attribute] == str(value).lower())
+        return int(matches[0]) if len(matches) else -2
+
+    def mask(self, attribute: str, value) -> np.ndarray:
+        return self.codes[attribute] == self.code(attribute, value)
+
+    def available(self, department: str = None) -> np.ndarray:
+        """Items that may be recommended: known products, in stock and, if given, in `department`."""
+        mask = self.in_stock & self.known
+        if department is not None:
+            mask &= self.mask('department', department)
+        return mask
+
+    def name(self, index: int) -> str:
+        return self.name_buffer[self.name_offsets[index]:self.name_offsets[index + 1]].tobytes().decode('utf-8')
+
+    def hydrate(self, indices) -> list:
+        return [{'id': int(self.item_ids[i]), 'product_name': self.name(i)} for i in indices]
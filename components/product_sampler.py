@@ -0,0 +1,129 @@
+import asyncio
+import logging
+import os
+import random
+import time
+
+import aiomysql
+import numpy as np
+
+from .database import get_db_connection
+
+logger = logging.getLogger(__name__)
+
+# Upper bound on how long a snapshot is served when no product change was signalled
+SAMPLER_TTL_SECONDS = int(os.getenv("PRODUCT_SAMPLER_TTL", "300"))
+
+
+class ProductSampler:
+    """In-memory sampling index over the products table.
+
+    Keeps the category list and, per category, an array of product ids (with
+    cumulative popularity weights) so random picks cost O(k) instead of an
+    ORDER BY RAND() sort. Only the chosen rows are then read by primary key.
+    """
+
+    def __init__(self, ttl: int = SAMPLER_TTL_SECONDS):
+        self.ttl = ttl
+        self.categories = []
+        self.products_by_category = {}
+        self.cumulative_weights = {}
+        self.loaded_at = 0.0
+        self.stale = True
+        self._lock = asyncio.Lock()
+
+    def mark_stale(self):
+        # Called by the product write paths; the next draw reloads the index
+        self.stale = True
+
+    def needs_refresh(self) -> bool:
+        return self.stale or time.monotonic() - self.loaded_at > self.ttl
+
+    async def ensure_fresh(self):
+        if not self.needs_refresh():
+            return
+        async with self._lock:
+            if self.needs_refresh():
+                await self.refresh()
+
+    async def refresh(self):
+        self.stale = False
+        async with get_db_connection() as conn:
+            async with conn.cursor() as cur:
+                await cur.execute("SELECT id, product_category FROM products WHERE product_category IS NOT NULL")
+                products = await cur.fetchall()
+                await cur.execute("""
+                    SELECT product_id, COUNT(*)
+                    FROM events
+                    WHERE product_id IS NOT NULL
+                    GROUP BY product_id
+                """)
+                popularity = dict(await cur.fetchall())
+
+        if not products:
+            ids = np.empty(0, dtype=np.int64)
+            categories = np.empty(0, dtype=object)
+        else:
+            ids = np.fromiter((row[0] for row in products), dtype=np.int64, count=len(products))
+            categories = np.array([row[1] for row in products], dtype=object)
+        # Laplace smoothing so products without events can still be drawn
+        weights = np.array([popularity.get(product_id, 0) + 1 for product_id in ids.tolist()], dtype=np.float64)
+
+        order = np.argsort(categories, kind='stable')
+        unique_categories, starts = np.unique(categories[order], return_index=True)
+        groups = np.split(order, starts[1:]) if len(order) else []
+
+        self.categories = unique_categories.tolist()
+        self.products_by_category = {category: ids[group] for category, group in zip(self.categories, groups)}
+        self.cumulative_weights = {category: np.cumsum(weights[group]) for category, group in zip(self.categories, groups)}
+        self.loaded_at = time.monotonic()
+        logger.info(f"Product sampler loaded {len(ids)} products in {len(self.categories)} categories")
+
+    def random_category(self):
+        if not self.categories:
+            return None
+        return random.choice(self.categories)
+
+    def sample_products(self, category: str, k: int, weighted: bool = False):
+        product_ids = self.products_by_category.get(category)
+        if product_ids is None or k <= 0:
+            return []
+
+        n = len(product_ids)
+        k = min(k, n)
+        if not weighted:
+            return [int(product_ids[i]) for i in random.sample(range(n), k)]
+
+        # Popularity-weighted draw without replacement: binary search over the
+        # cumulative weights, re-drawing on collisions (bounded attempts).
+        cumulative = self.cumulative_weights[category]
+        chosen = {}
+        for _ in range(k * 8):
+            if len(chosen) == k:
+                break
+            index = int(np.searchsorted(cumulative, random.random() * cumulative[-1], side='right'))
+            chosen.setdefault(min(index, n - 1), None)
+        # Heavily skewed weights can exhaust the attempts; top up uniformly
+        while len(chosen) < k:
+            chosen.setdefault(random.randrange(n), None)
+        return [int(product_ids[i]) for i in chosen]
+
+
+product_sampler = ProductSampler()
+
+
+async def fetch_products_by_ids(product_ids: list):
+    if not product_ids:
+        return []
+    placeholders = ", ".join(["%s"] * len(product_ids))
+    query = f"""
+        SELECT id, product_name AS name, product_category AS category, NULL AS image_url
+        FROM products
+        WHERE id IN ({placeholders})
+    """
+    async with get_db_connection() as conn:
+        async with conn.cursor(aiomysql.DictCursor) as cur:
+            await cur.execute(query, product_ids)
+            rows = {row['id']: row for row in await cur.fetchall()}
+    # Keep the sampled order; rows deleted since the last refresh are skipped
+    return [rows[product_id] for product_id in product_ids if product_id in rows]
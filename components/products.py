@@ -3,6 +3,8 @@ from typing import List, Optional, Dict, Any
 import aiomysql
 from pydantic import BaseModel, Field 
 from .database import DB_CONFIG, get_db_connection
+from .product_sampler import product_sampler
+from .cache import Cache
 from fastapi import HTTPException
 import httpx  # httpx is used for making asynchronous HTTP requests
 import requests
@@ -10,9 +12,19 @@ import json
 import numpy as np
 from decimal import Decimal
 from datetime import datetime, timedelta
+import os
 
 router = APIRouter()
 
+# Product reads are served from the 'products' namespace; every write drops the whole catalog tag
+PRODUCT_CACHE_TTL = float(os.getenv("PRODUCT_CACHE_TTL", "300"))
+product_cache = Cache('products', ttl=PRODUCT_CACHE_TTL)
+
+
+async def invalidate_products():
+    product_sampler.mark_stale()
+    await product_cache.invalidate_tag('catalog')
+
 
 class ProductBase(BaseModel):
     product_id: str = Field(..., min_length=1) 
@@ -63,6 +75,9 @@ class ProductListResponse(BaseModel):
 
 
 async def get_product_by_id(product_id: int) -> Optional[Product]:
+    return await product_cache.get_or_load(f"id:{product_id}", lambda: _load_product(product_id), tags=('catalog',))
+
+async def _load_product(product_id: int) -> Optional[Product]:
     async with get_db_connection() as conn:
         async with conn.cursor(aiomysql.DictCursor) as cusr:
             await cusr.execute("SELECT * FROM products WHERE product_id = %s", (product_id))
@@ -71,7 +86,7 @@ async def get_product_by_id(product_id: int) -> Optional[Product]:
             return product_dict if product_dict else None
 
 async def create_product(product: ProductCreate) -> Product:
-    async with await get_db_connection() as conn:
+    async with get_db_connection() as conn:
         async with conn.cursor(aiomysql.DictCursor) as cusr:
             await cusr.execute(
                 "INSERT INTO products (product_id, product_name, product_category, product_brand, selling_price, cost, max_margin, min_margin,department) VALUES (%s, %s, %s, %s, %s, %s, %s)",
@@ -79,11 +94,14 @@ async def create_product(product: ProductCreate) -> Product:
             )
             last_row_id = cusr.lastrowid
             await conn.commit()
-            await cusr.close()
-            return await get_product_by_id(last_row_id)
+    await invalidate_products()
+    return await get_product_by_id(last_row_id)
 
 
 async def get_all_products() -> ProductListResponse:
+    return await product_cache.get_or_load('all', _load_all_products, tags=('catalog',))
+
+async def _load_all_products() -> ProductListResponse:
     product_query = "SELECT product_id, product_name, product_category, product_brand, selling_price, cost, max_margin, min_margin, department FROM products LIMIT 1000"
     async with get_db_connection() as conn:
         async with conn.cursor(aiomysql.DictCursor) as cusr:
@@ -94,30 +112,33 @@ async def get_all_products() -> ProductListResponse:
 
 
 async def update_product(product_id: int, product: ProductUpdate) -> Product:
+    # Looked up before taking a connection: a cache miss checks out one of its own
+    current_product = await get_product_by_id(product_id)
+    if not current_product:
+        raise HTTPException(status_code=404, detail="Product not found")
+
+    update_data = product.dict(exclude_unset=True)  # Only update provided fields 
+    update_query = ", ".join([f"{field} = %s" for field in update_data])
     async with get_db_connection() as conn:
         async with conn.cursor(aiomysql.DictCursor) as cusr:
-            current_product = await get_product_by_id(product_id)
-            if not current_product:
-                raise HTTPException(status_code=404, detail="Product not found")
-
-            update_data = product.dict(exclude_unset=True)  # Only update provided fields 
-            update_query = ", ".join([f"{field} = %s" for field in update_data])
-            async with conn.cursor(aiomysql.DictCursor) as cusr:
-                aa = await cusr.execute(
+            await cusr.execute(
                 f"UPDATE products SET {update_query} WHERE product_id = %s",
                 (*update_data.values(), product_id)
-                )
-                await conn.commit()
-                return await get_product_by_id(product_id)  
+            )
+            await conn.commit()
+    await invalidate_products()
+    return await get_product_by_id(product_id)
 
 async def delete_product(product_id: int) -> None:
-    async with await get_db_connection() as conn:
-        current_product = await get_product_by_id(product_id)
-        if not current_product:
-            raise HTTPException(status_code=404, detail="Product not found")
+    current_product = await get_product_by_id(product_id)
+    if not current_product:
+        raise HTTPException(status_code=404, detail="Product not found")
 
-        await conn.cursor(aiomysql.DictCursor).execute("DELETE FROM products WHERE product_id = %s", (product_id))
-        await conn.commit()
+    async with get_db_connection() as conn:
+        async with conn.cursor(aiomysql.DictCursor) as cusr:
+            await cusr.execute("DELETE FROM products WHERE product_id = %s", (product_id))
+            await conn.commit()
+    await invalidate_products()
 
 # --- API Endpoints --- 
 @router.get("/", response_model=List)
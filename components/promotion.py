@@ -2,16 +2,27 @@ import aiomysql
 from fastapi import FastAPI
 from fastapi.responses import JSONResponse
 import pandas as pd
-import joblib
 from sklearn.preprocessing import LabelEncoder
 from contextlib import asynccontextmanager
 from fastapi import APIRouter
 from .database import DB_CONFIG, get_db_connection
+from .model_registry import model_registry
+from .cache import Cache
+import asyncio
+import logging
+import os
+import numpy as np
 
 app = FastAPI()
 
 router = APIRouter()
 
+logger = logging.getLogger(__name__)
+
+# Promotion predictions feed the recommendation re-ranker; they change with inventory, not per request
+PROMOTION_CACHE_TTL = float(os.getenv("PROMOTION_CACHE_TTL", "3600"))
+promotion_cache = Cache('promotions', ttl=PROMOTION_CACHE_TTL)
+
 
 # Fetch data from the database
 async def fetch_data():
@@ -21,12 +32,10 @@ async def fetch_data():
         data = await cursor.fetchall()
         return pd.DataFrame(data)
 
-# Endpoint to predict promotions
-@router.get("/predict-promotions/")
-async def predict_promotions():
-    data = await fetch_data()
-    model = joblib.load('promotion/Promotion_model.pkl')
-    
+def predict_promotional_items(data: pd.DataFrame) -> pd.DataFrame:
+    """The inventory rows the promotion model selects."""
+    model = model_registry.get('promotion').model
+
     # Data preprocessing
     data['created_at'] = pd.to_datetime(data['created_at'], errors='coerce')
     data['sold_at'] = pd.to_datetime(data['sold_at'], errors='coerce')
@@ -42,8 +51,32 @@ async def predict_promotions():
     # Feature selection and prediction
     features = data[['cost', 'product_category_encoded', 'product_department_encoded', 'day_of_week', 'week_of_year']]
     predictions = model.predict(features)
-    promotional_products = data[predictions == True]
+    return data[predictions == True]
+
+
+async def load_promoted_product_ids() -> np.ndarray:
+    try:
+        data = await fetch_data()
+        if data.empty or 'product_id' not in data:
+            return np.empty(0, dtype=np.int64)
+        promotional_products = await asyncio.to_thread(predict_promotional_items, data)
+    except Exception:
+        # Cached like a result, so a missing model or table is not retried on every request
+        logger.exception("Promotion predictions failed; no promotions until the next refresh")
+        return np.empty(0, dtype=np.int64)
+    return pd.to_numeric(promotional_products['product_id'], errors='coerce').dropna().astype(np.int64).unique()
+
+
+async def promoted_product_ids() -> np.ndarray:
+    """products.id of every product with a promoted inventory item; recomputed every PROMOTION_CACHE_TTL."""
+    return await promotion_cache.get_or_load('product_ids', load_promoted_product_ids)
+
+
+# Endpoint to predict promotions
+@router.get("/predict-promotions/")
+async def predict_promotions():
+    data = await fetch_data()
+    promotional_products = await asyncio.to_thread(predict_promotional_items, data)
 
     # Return results as JSON
     return JSONResponse(content=promotional_products.to_dict(orient='records'))
-
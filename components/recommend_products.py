@@ -1,12 +1,20 @@
-import joblib
 import aiomysql
 import numpy as np
 import pandas as pd
 from fastapi import FastAPI, HTTPException, APIRouter
 from typing import List
 from lightfm.data import Dataset
-from scipy.sparse import csr_matrix
 from .database import get_db_connection
+from .analytics_store import read_product_events, store_available
+from .user_profiles import profile_service
+from .recommendation_cache import recommendation_cache
+from .model_registry import model_registry
+from . import matrix_builder
+from .product_metadata import ProductMetadata, fetch_out_of_stock, gender_department
+from .reranking import reranker, promoted_mask
+from .seen_items import seen_items
+from .trending import trending
+import asyncio
 import logging
 
 # Set up logging
@@ -17,28 +25,11 @@ app = FastAPI()
 
 router = APIRouter()
 dataset = Dataset()
-# Load the pre-trained LightFM model
-model = joblib.load('recommendation-model/recommendation_hybrid_model.pkl')
-
-# Define feature indices (update based on your feature setup)
-feature_indices = {
-    'gender_male': 0,
-    'age_25': 1,
-    'location_Daegu': 2,
-    'brand_Perry_Ellis': 3,
-}
-num_features = len(feature_indices)
 
 async def get_user_data(conn, user_id: str):
-    query = """
-        SELECT u.id, u.age, u.gender, u.location, b.brand
-        FROM users u
-        JOIN brands b ON b.user_id = u.user_id
-        WHERE u.user_id = %s
-    """
-    async with conn.cursor(aiomysql.DictCursor) as cur:
-        await cur.execute(query, (user_id,))
-        return await cur.fetchall()
+    # Served from the shared profile cache; conn kept for the call signature
+    profile = await profile_service.get(user_id)
+    return profile.rows() if profile else []
 
 async def get_all_users_data(conn):
     query = """
@@ -57,37 +48,21 @@ async def get_product_data(conn):
         return await cur.fetchall()
 
 async def get_events_data(conn):
+    if store_available():
+        events = await asyncio.to_thread(read_product_events)
+        return events.to_pylist()
+
     query = """
-        SELECT e.user_id, e.event_type, e.uri, 
-        CAST(SUBSTRING_INDEX(e.uri, '/', -1) AS UNSIGNED) AS product_id
+        SELECT e.user_id, e.event_type, e.uri, e.product_id
         FROM events e
-        JOIN products p ON p.id = CAST(SUBSTRING_INDEX(e.uri, '/', -1) AS UNSIGNED)
+        JOIN products p ON p.id = e.product_id
     """
     async with conn.cursor(aiomysql.DictCursor) as cur:
         await cur.execute(query)
         return await cur.fetchall()
 
-def create_feature_vector(user_demo_details):
-    feature_vector = [0] * num_features
-    for detail in user_demo_details:
-        age, gender, location, brand = detail['age'], detail['gender'], detail['location'], detail['brand']
-        age_feature = f'age_{age}'
-        gender_feature = 'gender_male' if gender.lower() == 'm' else 'gender_female'
-        location_feature = f'location_{location}'
-        brand_feature = f'brand_{brand}'
-        
-        if age_feature in feature_indices:
-            feature_vector[feature_indices[age_feature]] = 1
-        if gender_feature in feature_indices:
-            feature_vector[feature_indices[gender_feature]] = 1
-        if location_feature in feature_indices:
-            feature_vector[feature_indices[location_feature]] = 1
-        if brand_feature in feature_indices:
-            feature_vector[feature_indices[brand_feature]] = 1
-
-    return csr_matrix([feature_vector])
-
 def preprocess_data(users_df, products_df, events_df):
+    global dataset
     event_type_weights = {
         'purchase': 3.0,   # High weight as it directly indicates a preference.
         'cart': 2.5,       # Adding to cart is a strong buying signal.
@@ -99,41 +74,33 @@ def preprocess_data(users_df, products_df, events_df):
 
     events_df['event_weight'] = events_df['event_type'].map(event_type_weights)
 
-    events_df['product_id'] = events_df.apply(lambda row: int(row['uri'].split('/')[-1]) if '/product/' in row['uri'] else np.nan, axis=1)
     events_df = events_df.dropna(subset=['product_id', 'user_id'])
     events_df.loc[:, 'user_id'] = events_df['user_id'].astype(int)
     events_df.loc[:, 'product_id'] = events_df['product_id'].astype(int)
 
     filtered_events = events_df[events_df['user_id'].isin(users_df['id']) & events_df['product_id'].isin(products_df['id'])]
 
-    users_df['age_group'] = pd.cut(users_df['age'], bins=[0, 18, 25, 35, 45, 55, 65, 100], labels=['0-18', '19-25', '26-35', '36-45', '46-55', '56-65', '65+'])
-
-    dataset.fit(
-        users=(x for x in users_df['id']),
-        items=(x for x in products_df['id']),
-        user_features=(f"{row['gender']}_{row['age_group']}_{row['location']}" for index, row in users_df.iterrows()),
-        item_features=(f"{row['product_category']}_{row['product_Brand']}_{row['department']}" for index, row in products_df.iterrows())
-    )
+    user_tokens = matrix_builder.user_feature_tokens(users_df)
+    item_tokens = matrix_builder.join_tokens(products_df, ['product_category', 'product_Brand', 'department'])
 
-    (interactions_matrix, weights_matrix) = dataset.build_interactions(
-        (row['user_id'], row['product_id'], row['event_weight'])
-        for index, row in filtered_events.iterrows()
-    )
+    dataset = matrix_builder.fit_dataset(users_df['id'], products_df['id'], user_tokens, item_tokens)
 
-    user_features = dataset.build_user_features(
-        (row['id'], [f"{row['gender']}_{row['age_group']}_{row['location']}"])
-        for index, row in users_df.iterrows()
-    )
+    (interactions_matrix, weights_matrix) = matrix_builder.build_interactions(
+        dataset, filtered_events['user_id'], filtered_events['product_id'], filtered_events['event_weight'])
 
-    item_features = dataset.build_item_features(
-        (row['id'], [f"{row['product_category']}_{row['product_Brand']}_{row['department']}"])
-        for index, row in products_df.iterrows()
-    )
+    user_features = matrix_builder.build_user_features(dataset, users_df['id'], user_tokens)
+    item_features = matrix_builder.build_item_features(dataset, products_df['id'], item_tokens)
 
     return dataset, user_features, item_features, interactions_matrix, weights_matrix
 
 @router.get("/recommend/{user_id}", response_model=List[dict])
 async def recommend_products(user_id: str):
+    # Pin one model version for the whole request; results are cached per user and version
+    loaded = await model_registry.get_async('recommender')
+    return await recommendation_cache.get('hybrid', user_id, loaded.version,
+                                          lambda: compute_recommendations(user_id, loaded.model))
+
+async def compute_recommendations(user_id: str, model):
     async with get_db_connection() as conn:
         # Fetch data
         user_data = await get_user_data(conn, user_id)
@@ -150,6 +117,7 @@ async def recommend_products(user_id: str):
         user_df = pd.DataFrame(user_data)
         all_users_data = await get_all_users_data(conn)  # Fetch all users
         users_df = pd.DataFrame(all_users_data)
+        out_of_stock = await fetch_out_of_stock(conn)
 
         # Preprocess data
         dataset, user_features, item_features, interactions_matrix, weights_matrix = preprocess_data(users_df, products_df, events_df)
@@ -164,16 +132,14 @@ async def recommend_products(user_id: str):
         user_x = dataset.mapping()[0][user_id_int]
 
         scores = model.predict(user_x, np.arange(dataset.interactions_shape()[1]), user_features=user_features, item_features=item_features)
-        top_items_indices = np.argsort(-scores)[:20]
-        top_item_ids = [dataset.mapping()[2][i] for i in top_items_indices]
-        
-        # Filter products based on user's gender
-        user_gender = 'men' if user_data[0]['gender'].lower() == 'm' else 'women'
-        filtered_top_item_ids = [id for id in top_item_ids if products_df.loc[products_df['id'] == id, 'department'].values[0].lower() == user_gender]
-
-        top_items_details = [{'id': id, 'product_name': products_df.loc[products_df['id'] == id, 'product_name'].values[0]} for id in filtered_top_item_ids]
 
-        return top_items_details
+        # Only in-stock products of the user's gender's department are ranked, so the top 20 are all servable;
+        # business rules then re-rank them
+        metadata = ProductMetadata.from_frame(list(dataset.mapping()[2]), products_df, out_of_stock)
+        available = metadata.available(gender_department(user_data[0]['gender']))
+        top = reranker.rerank(scores, metadata, 20, available, exclude_ids=await seen_items.get(user_id),
+                              promoted=await promoted_mask(metadata), trending=trending.signal(metadata))
+        return metadata.hydrate(top)
 
 @router.get("/similar_items/{item_id}", response_model=List[int])
 async def get_similar_items(item_id: int):
@@ -183,7 +149,8 @@ async def get_similar_items(item_id: int):
         
         item_features = dataset.build_item_features([(item_id, [])])
 
-        similar_ids = similar_items(item_id, model, item_features)
+        loaded = await model_registry.get_async('recommender')
+        similar_ids = similar_items(item_id, loaded.model, item_features)
         return similar_ids.tolist()
 
 @router.get("/similar_users/{user_id}", response_model=List[int])
@@ -199,7 +166,8 @@ async def get_similar_users(user_id: str):
 
         user_features = dataset.build_user_features([(user_id_int, [])])
 
-        similar_ids = similar_users(user_id_int, model, user_features)
+        loaded = await model_registry.get_async('recommender')
+        similar_ids = similar_users(user_id_int, loaded.model, user_features)
         return similar_ids.tolist()
 
 def similar_items(item_id, model, item_features, N=10):
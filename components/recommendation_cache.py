@@ -0,0 +1,69 @@
+"""Per-user recommendation results, cached by user and model version.
+
+Entries live in the 'recommendations' namespace of the shared cache under
+``<route>:<model version>:<user id>`` and are tagged with the user, so:
+
+- a new model version is served from fresh keys as soon as it is swapped in;
+- a tracked event or click from the user drops all of that user's entries;
+- an entry older than RECOMMENDATION_FRESH_SECONDS is still returned, while
+  one background task per entry recomputes it (stale-while-revalidate);
+- RECOMMENDATION_CACHE_TTL bounds how long an entry is kept at all.
+"""
+import asyncio
+import logging
+import os
+import time
+
+from .cache import Cache
+
+logger = logging.getLogger(__name__)
+
+RECOMMENDATION_CACHE_TTL = float(os.getenv("RECOMMENDATION_CACHE_TTL", "86400"))
+RECOMMENDATION_FRESH_SECONDS = float(os.getenv("RECOMMENDATION_FRESH_SECONDS", "900"))
+
+
+def user_tag(user_id) -> str:
+    return f"user:{user_id}"
+
+
+class RecommendationCache:
+    def __init__(self, ttl: float = RECOMMENDATION_CACHE_TTL, fresh_seconds: float = RECOMMENDATION_FRESH_SECONDS):
+        self.cache = Cache('recommendations', ttl=ttl)
+        self.cache.metrics.update({'stale_served': 0, 'revalidations': 0})
+        self.fresh_seconds = fresh_seconds
+        self._revalidating = {}
+
+    async def get(self, route: str, user_id, version: str, compute):
+        """Cached top-N for the user under `version`, else `compute()`'s result (which is cached)."""
+        key = f"{route}:{version}:{user_id}"
+        tags = (user_tag(user_id),)
+
+        async def load():
+            return time.time(), await compute()
+
+        computed_at, recommendations = await self.cache.get_or_load(key, load, tags=tags)
+        if time.time() - computed_at > self.fresh_seconds:
+            self.cache.metrics['stale_served'] += 1
+            self._revalidate(key, load, tags)
+        return recommendations
+
+    def _revalidate(self, key: str, load, tags):
+        if key in self._revalidating:
+            return
+        # Keep a reference so the task is not collected mid-flight
+        self._revalidating[key] = asyncio.create_task(self._refresh(key, load, tags))
+
+    async def _refresh(self, key: str, load, tags):
+        try:
+            self.cache.metrics['revalidations'] += 1
+            await self.cache.refresh(key, load, tags=tags)
+        except Exception:
+            logger.exception(f"Background refresh of {key} failed; serving the stale entry until it expires")
+        finally:
+            self._revalidating.pop(key, None)
+
+    async def invalidate_user(self, user_id):
+        await self.cache.invalidate_tag(user_tag(user_id))
+
+
+recommendation_cache = RecommendationCache()
@@ -1,40 +1,53 @@
+import asyncio
+import logging
 import os
+import time
+
 import pandas as pd
 import numpy as np
 from fastapi import APIRouter, HTTPException
 from fastapi import FastAPI, Depends
 from pydantic import BaseModel
-import joblib
 from lightfm import LightFM
-from lightfm.data import Dataset
-import aiomysql
 from .database import get_db_connection
+from .model_registry import model_registry
+from .analytics_store import read_product_events, store_available
+from .user_profiles import profile_service
+from .cache import single_flight
+from .user_features import UserFeatureEncoder
+from .cold_start_segments import _representations
+from . import matrix_builder
+from .product_metadata import ProductMetadata, fetch_out_of_stock
+from .reranking import reranker, promoted_mask
+from .seen_items import seen_items
+from .trending import trending
 from fastapi.exceptions import HTTPException
 
 
 router = APIRouter()
 
-model = None
+logger = logging.getLogger(__name__)
+
+# Upper bound on how long one in-memory index is served before it is rebuilt from MySQL
+INDEX_TTL_SECONDS = int(os.getenv("RECOMMENDATION_INDEX_TTL", "3600"))
+
+EVENT_TYPE_WEIGHTS = {
+    'purchase': 3.0, 'cart': 2.5, 'product': 2.0, 'department': 1.0, 'cancel': 0.5, 'home': 0.5
+}
 
 def is_model_initialized(model):
     return hasattr(model, 'item_embeddings') and model.item_embeddings is not None
 
-def get_model():
-    global model
-    if model is None:
-        model_path = os.path.join('recommendation-model', 'recommendation_hybrid_model.joblib')
-        try:
-            model = joblib.load(model_path)
-            if not hasattr(model, 'item_embeddings'):
-                print("Model loaded but not properly initialized.")
-                raise HTTPException(status_code=500, detail="Model not properly initialized")
-        except FileNotFoundError:
-            print("Model file not found")
-            raise HTTPException(status_code=500, detail="Model file not found")
-        except Exception as e:
-            print(f"An unexpected error occurred: {str(e)}")
-            raise HTTPException(status_code=500, detail=str(e))
-    return model
+async def get_model():
+    """The active recommender from the model registry, loaded off the event loop on first use."""
+    try:
+        loaded = await model_registry.get_async('recommender')
+    except Exception as e:
+        logger.exception("Recommender model is not available")
+        raise HTTPException(status_code=503, detail=f"Model is not available: {e}")
+    if not is_model_initialized(loaded.model):
+        raise HTTPException(status_code=500, detail="Model not properly initialized")
+    return loaded.model
 
 class UserDemo(BaseModel):
     user_id: int
@@ -44,135 +57,174 @@ class UserDemo(BaseModel):
 async def get_recommendations(user_input: UserDemo, model: LightFM = Depends(get_model)):
     if model is None:
         raise HTTPException(status_code=503, detail="Model is not available")
+    if user_input.num_recommendations <= 0:
+        raise HTTPException(status_code=400, detail="num_recommendations must be positive")
     return await recommendation(user_input.user_id, user_input.num_recommendations, model)
 
+# Concurrent requests for the same user share one scoring pass
+@single_flight()
 async def recommendation(user_id: int, num_recommendations: int, model: LightFM):
-    conn = await get_db_connection()
-    
-                              
-  
+    await recommendation_index.ensure_fresh(model)
+    index = recommendation_index
+    user_id = str(user_id)
 
+    if user_id in index.user_rows:
+        user_vector = index.user_embeddings[index.user_rows[user_id]]
+    else:
+        # Cold start: score from the user's demographic features alone
+        profile = await profile_service.get(user_id)
+        if profile is None:
+            raise HTTPException(status_code=404, detail="User not found")
+        features = index.encoder.encode(profile.demo_rows() or [(profile.age, profile.gender, profile.location, None)])
+        _, user_vector = _representations(features, index.model.user_embeddings, index.model.user_biases)
+        user_vector = np.asarray(user_vector).ravel()
 
-async def fetch_known_positives(user_id, conn):
-    async with conn.cursor(aiomysql.DictCursor) as cursor:
-        await cursor.execute("""
-            SELECT e.product_id
-            FROM events e
-            WHERE e.user_id = %s;
-        """, (user_id,))
-        result = await cursor.fetchall()
-        print("Known positives for user:", result)
-        return result
-
-
-async def fetch_users(user_id, conn):
-    async with conn.cursor(aiomysql.DictCursor) as cursor:
-        await cursor.execute("""
-            SELECT u.user_id, u.age, u.gender, u.location, b.brand
-            FROM users u
-            JOIN brands b ON b.user_id = u.user_id
-            WHERE u.user_id = %s;
-        """, (user_id,))
-        result = await cursor.fetchall()
-        print("User data:", result)
-        return result
+    return index.recommend(user_vector, num_recommendations, exclude_ids=await seen_items.get(user_id),
+                           promoted=await promoted_mask(index.metadata), trending=trending.signal(index.metadata))
 
 
 async def fetch_products(conn):
-    async with conn.cursor(aiomysql.DictCursor) as cursor:
+    async with conn.cursor() as cursor:
         await cursor.execute("""
-            SELECT p.product_id, p.product_name, p.product_category, p.product_brand
+            SELECT p.id, p.product_id, p.product_name, p.product_category, p.product_Brand,
+                   p.selling_price, p.max_margin
             FROM products p;
         """)
-        result = await cursor.fetchall()
-        # print("Products data:", result)
-        return result
+        rows = await cursor.fetchall()
+        return pd.DataFrame(rows, columns=['id', 'product_id', 'product_name', 'product_category', 'product_brand',
+                                           'selling_price', 'max_margin'])
 
 async def fetch_events(conn):
-    async with conn.cursor(aiomysql.DictCursor) as cursor:
+    if store_available():
+        events = await asyncio.to_thread(read_product_events)
+        return events.select(['user_id', 'event_type', 'product_id']).to_pandas()
+    # events.product_id is the stored column parsed from the '/product/<id>' uri
+    async with conn.cursor() as cursor:
         await cursor.execute("""
-            SELECT e.user_id, e.uri, e.event_type
-            FROM events e;
+            SELECT e.user_id, e.event_type, e.product_id
+            FROM events e
+            WHERE e.product_id IS NOT NULL;
         """)
-        result = await cursor.fetchall()
-        # print("Events data:", result)
-        return result
-    
+        rows = await cursor.fetchall()
+        return pd.DataFrame(rows, columns=['user_id', 'event_type', 'product_id'])
+
 async def fetch_all_users(conn):
-    async with conn.cursor(aiomysql.DictCursor) as cursor:
+    async with conn.cursor() as cursor:
         await cursor.execute("""
-            SELECT u.user_id, u.age, u.gender, u.location, b.brand
-            FROM users u
-            JOIN brands b ON b.user_id = u.user_id;
+            SELECT u.user_id, u.age, u.gender, u.location
+            FROM users u;
         """)
-        return await cursor.fetchall()
-    
-
-def fit_dataset(users_df, products_df, events_df):
-    dataset = Dataset()
-
-    # Ensure all user IDs and product IDs are considered as strings to prevent type mismatch issues
-    user_ids = users_df['user_id'].astype(str)._append(events_df['user_id'].astype(str)).unique()
-    item_ids = products_df['product_id'].astype(str)._append(events_df['product_id'].astype(str)).unique()
-
-    dataset.fit(
-        users=user_ids,
-        items=item_ids
-    )
-
-    print("Number of users:", dataset.model_dimensions()[0])
-    return dataset
-
-
-
-
-async def load_data(conn: aiomysql.Connection = Depends(get_db_connection)):
-    try:
-        # Fetch data from database
-        users = await fetch_all_users(conn)
-        products = await fetch_products(conn)
-        events = await fetch_events(conn)
-
-        # Convert fetched data to pandas DataFrames
-        users_df = pd.DataFrame(users)
-        products_df = pd.DataFrame(products)
-        events_df = pd.DataFrame(events)
-
-        # Preprocess events
-        event_type_weights = {
-            'purchase': 3.0, 'cart': 2.5, 'product': 2.0, 'department': 1.0, 'cancel': 0.5, 'home': 0.5
-        }
-        events_df['event_weight'] = events_df['event_type'].map(event_type_weights)
-        events_df['product_id'] = events_df['uri'].apply(
-            lambda uri: int(uri.split('/')[-1]) if '/product/' in uri else np.nan)
-
-        events_df = events_df.dropna(subset=['product_id', 'user_id'])
-
-        # Preprocess users
-        users_df['age_group'] = pd.cut(users_df['age'], bins=[0, 18, 25, 35, 45, 55, 65, 100], labels=[
-            '0-18', '19-25', '26-35', '36-45', '46-55', '56-65', '65+'])
-
-        # Convert product_id to integer
-        products_df['product_id'] = products_df['product_id'].astype(int)
-
-        # For the events dataframe, ensure there's no missing product_id, then convert
-        events_df.dropna(subset=['product_id'], inplace=True)
-        events_df['product_id'] = events_df['product_id'].astype(int)
-
-        # Fit dataset
-        dataset = fit_dataset(users_df, products_df, events_df)
-
-        # Build interaction data
-        (interactions_matrix, weights_matrix) = dataset.build_interactions(
-            ((row['user_id'], row['product_id'], row['event_weight']) for index, row in events_df.iterrows())
-        )
-
-        # Build user and item features
-        user_features = dataset.build_user_features(
-            (row['user_id'], [f"{row['gender']}_{row['age_group']}_{row['location']}"]) for index, row in users_df.iterrows())
-        item_features = dataset.build_item_features(
-            (row['product_id'], [f"{row['product_category']}_{row['product_brand']}"]) for index, row in products_df.iterrows())
-
-        return dataset, interactions_matrix, weights_matrix, user_features, item_features
-    finally:
-        conn.close()
+        rows = await cursor.fetchall()
+        return pd.DataFrame(rows, columns=['user_id', 'age', 'gender', 'location'])
+
+
+def build_dataset(users_df, products_df, events_df):
+    """Fit the LightFM dataset and build its matrices with column operations only."""
+    users_df = users_df.assign(user_id=users_df['user_id'].astype(str))
+    products_df = products_df.assign(id=products_df['id'].astype(np.int64))
+    user_tokens = matrix_builder.user_feature_tokens(users_df)
+    item_tokens = matrix_builder.join_tokens(products_df, ['product_category', 'product_brand'])
+
+    events_df = events_df.assign(
+        user_id=events_df['user_id'].astype(str),
+        event_weight=events_df['event_type'].map(EVENT_TYPE_WEIGHTS),
+    ).dropna(subset=['user_id', 'product_id', 'event_weight'])
+    events_df['product_id'] = events_df['product_id'].astype(np.int64)
+
+    # Events may reference users/products missing from their tables; they still get ids
+    dataset = matrix_builder.fit_dataset(
+        pd.concat([users_df['user_id'], events_df['user_id']], ignore_index=True),
+        pd.concat([products_df['id'], events_df['product_id']], ignore_index=True),
+        user_tokens, item_tokens)
+
+    interactions, weights = matrix_builder.build_interactions(
+        dataset, events_df['user_id'], events_df['product_id'], events_df['event_weight'])
+    user_features = matrix_builder.build_user_features(dataset, users_df['user_id'], user_tokens)
+    item_features = matrix_builder.build_item_features(dataset, products_df['id'], item_tokens)
+
+    return dataset, interactions, weights, user_features, item_features
+
+
+class RecommendationIndex:
+    """Long-lived scoring state for the cold-start recommendation route.
+
+    Built once from MySQL (or the analytics extract) and reused across
+    requests: user and item representations are precomputed, so a request
+    is one dot product, a mask of the user's seen products and an
+    argpartition.
+    """
+
+    def __init__(self, ttl: int = INDEX_TTL_SECONDS):
+        self.ttl = ttl
+        self.model = None
+        self.encoder = None
+        self.user_rows = {}
+        self.user_embeddings = None
+        self.item_biases = None
+        self.item_embeddings = None
+        self.product_ids = None
+        self.metadata = None
+        self.loaded_at = 0.0
+        self.stale = True
+        self._lock = asyncio.Lock()
+
+    def mark_stale(self):
+        self.stale = True
+
+    def needs_refresh(self, model) -> bool:
+        return self.stale or self.model is not model or time.monotonic() - self.loaded_at > self.ttl
+
+    async def ensure_fresh(self, model):
+        if not self.needs_refresh(model):
+            return
+        async with self._lock:
+            if self.needs_refresh(model):
+                await self.refresh(model)
+
+    async def refresh(self, model):
+        started = time.monotonic()
+        self.stale = False
+        async with get_db_connection() as conn:
+            users_df = await fetch_all_users(conn)
+            products_df = await fetch_products(conn)
+            events_df = await fetch_events(conn)
+            out_of_stock = await fetch_out_of_stock(conn)
+
+        dataset, _, _, user_features, item_features = await asyncio.to_thread(
+            build_dataset, users_df, products_df, events_df)
+
+        user_mapping, _, item_mapping, _ = dataset.mapping()
+        item_ids = np.fromiter(item_mapping, dtype=np.int64, count=len(item_mapping))  # ordered by internal index
+        details = products_df.assign(id=products_df['id'].astype(np.int64)).set_index('id').reindex(item_ids)
+        try:
+            _, user_embeddings = _representations(user_features, model.user_embeddings, model.user_biases)
+            item_biases, item_embeddings = _representations(item_features, model.item_embeddings, model.item_biases)
+        except ValueError as e:
+            # The catalog has features the model was not trained on; its scores would be wrong
+            logger.error(f"Recommendation index not built: {e}")
+            raise HTTPException(status_code=503, detail="Model does not match the current catalog; retrain it")
+
+        self.model = model
+        self.encoder = UserFeatureEncoder.from_dataset(dataset)
+        self.user_rows = user_mapping
+        self.user_embeddings = np.ascontiguousarray(user_embeddings)
+        self.item_biases = np.ascontiguousarray(item_biases)
+        self.item_embeddings = np.ascontiguousarray(item_embeddings)
+        self.product_ids = details['product_id'].to_numpy(dtype=object)
+        self.metadata = ProductMetadata.from_frame(item_ids, products_df, out_of_stock, columns={'brand': 'product_brand'})
+        self.loaded_at = time.monotonic()
+        logger.info(f"Recommendation index built for {len(user_mapping)} users and {len(item_ids)} items "
+                    f"in {time.monotonic() - started:.1f}s")
+
+    def recommend(self, user_vector, num_recommendations: int, exclude_ids=None, promoted=None, trending=None):
+        scores = self.item_embeddings @ user_vector + self.item_biases
+        # Seen products are masked out before top-k; business rules re-rank the rest
+        top = reranker.rerank(scores, self.metadata, num_recommendations, exclude_ids=exclude_ids,
+                              promoted=promoted, trending=trending)
+        return [
+            {'product_id': self.product_ids[i], 'product_name': self.metadata.name(i), 'score': float(scores[i])}
+            for i in top
+        ]
+
+
+recommendation_index = RecommendationIndex()
@@ -0,0 +1,106 @@
+"""Business-rule re-ranking of scored recommendation candidates.
+
+After the model scores every item, the best RERANK_CANDIDATES available items
+are re-ranked with array operations over that candidate set only:
+
+    exclude     products the user has already seen (seen_items) never appear
+    boosts      candidate scores are standardised, then margin (max_margin /
+                selling_price), promotion (products with an inventory item the
+                promotion model selects) and trending popularity (scaled to [0, 1])
+                add RERANK_MARGIN_WEIGHT, RERANK_PROMOTION_WEIGHT and
+                RERANK_TRENDING_WEIGHT standard deviations at most
+    diversity   at most RERANK_BRAND_CAP items per brand (0 disables the cap)
+
+Setting the weights and the cap to 0 returns the model's own top k.
+"""
+import asyncio
+import logging
+import os
+
+import numpy as np
+
+from .product_metadata import ProductMetadata, top_k
+
+logger = logging.getLogger(__name__)
+
+RERANK_CANDIDATES = int(os.getenv("RERANK_CANDIDATES", "200"))
+RERANK_BRAND_CAP = int(os.getenv("RERANK_BRAND_CAP", "3"))
+RERANK_MARGIN_WEIGHT = float(os.getenv("RERANK_MARGIN_WEIGHT", "0.3"))
+RERANK_PROMOTION_WEIGHT = float(os.getenv("RERANK_PROMOTION_WEIGHT", "0.2"))
+RERANK_TRENDING_WEIGHT = float(os.getenv("RERANK_TRENDING_WEIGHT", "0.2"))
+# Bounds how long a request waits for promotion predictions; later requests use them once cached
+PROMOTION_LOOKUP_TIMEOUT = float(os.getenv("RERANK_PROMOTION_TIMEOUT", "0.05"))
+
+async def promoted_mask(metadata: ProductMetadata):
+    """Boolean mask of promoted items, or None when promotions are off or not available yet."""
+    if RERANK_PROMOTION_WEIGHT <= 0:
+        return None
+    from .promotion import promoted_product_ids
+    try:
+        # shield: a timed-out request leaves the load running for the next one
+        product_ids = await asyncio.wait_for(asyncio.shield(promoted_product_ids()), PROMOTION_LOOKUP_TIMEOUT)
+    except asyncio.TimeoutError:
+        return None
+    except Exception:
+        logger.exception("Promotion predictions unavailable; re-ranking without them")
+        return None
+    mask = np.zeros(len(metadata), dtype=bool)
+    mask[metadata.indices(product_ids)] = True
+    return mask
+
+
+def brand_ranks(brand_codes: np.ndarray) -> np.ndarray:
+    """Position of each entry among the earlier entries of the same brand (0 for the first)."""
+    order = np.argsort(brand_codes, kind='stable')
+    sorted_codes = brand_codes[order]
+    group_starts = np.flatnonzero(np.r_[True, sorted_codes[1:] != sorted_codes[:-1]])
+    group_sizes = np.diff(np.r_[group_starts, len(sorted_codes)])
+    ranks = np.empty(len(brand_codes), dtype=np.int64)
+    ranks[order] = np.arange(len(brand_codes)) - np.repeat(group_starts, group_sizes)
+    return ranks
+
+
+class ReRanker:
+    def __init__(self, candidates: int = RERANK_CANDIDATES, brand_cap: int = RERANK_BRAND_CAP,
+                 margin_weight: float = RERANK_MARGIN_WEIGHT, promotion_weight: float = RERANK_PROMOTION_WEIGHT,
+                 trending_weight: float = RERANK_TRENDING_WEIGHT):
+        self.candidates = candidates
+        self.brand_cap = brand_cap
+        self.margin_weight = margin_weight
+        self.promotion_weight = promotion_weight
+        self.trending_weight = trending_weight
+
+    def rerank(self, scores: np.ndarray, metadata: ProductMetadata, k: int, available: np.ndarray = None,
+               exclude_ids: np.ndarray = None, promoted: np.ndarray = None, trending: np.ndarray = None) -> np.ndarray:
+        """Item indices of the final top k, best first.
+
+        `available` masks the items that may be served at all, `exclude_ids`
+        are product ids (e.g. seen products) to drop, `promoted` is a mask of
+        promoted items and `trending` their popularity in [0, 1].
+        """
+        mask = metadata.available() if available is None else available
+        if exclude_ids is not None and len(exclude_ids):
+            mask = mask.copy()
+            mask[metadata.indices(exclude_ids)] = False
+        candidates = top_k(scores, max(k, self.candidates), mask)
+        if len(candidates) == 0:
+            return candidates
+
+        candidate_scores = scores[candidates]
+        adjusted = (candidate_scores - candidate_scores.mean()) / (candidate_scores.std() or 1.0)
+        if self.margin_weight:
+            adjusted = adjusted + self.margin_weight * metadata.margin[candidates]
+        if self.promotion_weight and promoted is not None:
+            adjusted = adjusted + self.promotion_weight * promoted[candidates]
+        if self.trending_weight and trending is not None:
+            adjusted = adjusted + self.trending_weight * trending[candidates]
+        ordered = candidates[np.argsort(-adjusted, kind='stable')]
+
+        if self.brand_cap > 0:
+            brands = metadata.codes['brand'][ordered]
+            # Items without a known brand are not capped
+            ordered = ordered[(brand_ranks(brands) < self.brand_cap) | (brands < 0)]
+        return ordered[:k]
+
+
+reranker = ReRanker()
@@ -3,6 +3,7 @@ from typing import List, Optional, Dict, Any
 import aiomysql
 from pydantic import BaseModel, Field 
 from .database import DB_CONFIG, get_db_connection
+from .cache import single_flight
 from fastapi import HTTPException
 import httpx  # httpx is used for making asynchronous HTTP requests
 import requests
@@ -10,8 +11,13 @@ import json
 import numpy as np
 from decimal import Decimal
 from datetime import datetime, timedelta
+import os
 
 router = APIRouter()
+
+# Dashboard aggregates scan the whole sales table; identical requests within this window share one result
+SALES_CACHE_TTL = float(os.getenv("SALES_CACHE_TTL", "60"))
+
 # Router for sales forecasting
 sales_forecasting_router = APIRouter()
 
@@ -24,8 +30,9 @@ class MonthlySales(BaseModel):
     total_sales: float
 
 @sales_forecasting_router.get("/monthly-sales")
+@single_flight(ttl=SALES_CACHE_TTL, namespace='sales')
 async def get_monthly_sales() -> List[Dict[str, Any]]:
-    async with await get_db_connection() as conn:
+    async with get_db_connection() as conn:
         async with conn.cursor(aiomysql.DictCursor) as cursor:
             query = """
             SELECT 
@@ -114,8 +121,9 @@ class CategorySales(BaseModel):
 
 # Endpoint for fetching sales by product category
 @sales_forecasting_router.get("/category-sales", response_model=List[CategorySales])
+@single_flight(ttl=SALES_CACHE_TTL, namespace='sales')
 async def get_sales_by_category() -> List[Dict[str, Any]]:
-    async with await get_db_connection() as conn:
+    async with get_db_connection() as conn:
         async with conn.cursor(aiomysql.DictCursor) as cursor:
             query = """
             SELECT 
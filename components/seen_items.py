@@ -0,0 +1,318 @@
+"""Per-user seen products, held in memory so scoring excludes them without a query.
+
+Products a user purchased, carted or viewed (SEEN_EVENT_TYPES) or clicked are
+kept as CSR-style arrays over the users who have any:
+
+    users    sorted int64 user ids (events.user_id / clicks.user_id)
+    indptr   int64 offsets into items, one per user plus one
+    items    uint32 product ids (events.product_id is INT UNSIGNED), each
+             user's oldest first
+
+That is 16 bytes per user plus 4 per (user, product) pair, and only each
+user's newest SEEN_ITEMS_PER_USER products are kept, so the footprint stays
+bounded however long histories grow. Product ids rather than item indices are
+stored, so every recommender maps them onto its own dataset's items.
+
+Interactions ingested by this worker go to a small dict of recent additions,
+merged into the arrays (vectorized, off the event loop) once it holds
+SEEN_DELTA_MAX products. The arrays are loaded from MySQL at startup (warm-up
+step seen_items), compacting to the per-user bound while the rows stream in,
+and reloaded every SEEN_ITEMS_TTL seconds, which also picks up what other
+workers ingested; until the first load completes, lookups query
+the user's rows instead.
+"""
+import asyncio
+import itertools
+import logging
+import os
+import time
+
+import aiomysql
+import numpy as np
+import pandas as pd
+
+from .database import get_db_connection
+
+logger = logging.getLogger(__name__)
+
+SEEN_EVENT_TYPES = tuple(
+    event_type.strip() for event_type in os.getenv("SEEN_EVENT_TYPES", "purchase,cart,product").split(',')
+    if event_type.strip())
+SEEN_ITEMS_PER_USER = int(os.getenv("SEEN_ITEMS_PER_USER", "500"))
+SEEN_DELTA_MAX = int(os.getenv("SEEN_DELTA_MAX", "100000"))
+SEEN_ITEMS_TTL = float(os.getenv("SEEN_ITEMS_TTL", "3600"))
+# Rows per round trip while streaming the load
+SEEN_FETCH_SIZE = int(os.getenv("SEEN_FETCH_SIZE", "100000"))
+
+_EVENT_TYPES_PARAMS = ', '.join(['%s'] * len(SEEN_EVENT_TYPES))
+
+SEEN_QUERY = f"""
+    SELECT user_id, product_id, UNIX_TIMESTAMP(MAX(event_time))
+    FROM events
+    WHERE product_id IS NOT NULL AND event_type IN ({_EVENT_TYPES_PARAMS})
+    GROUP BY user_id, product_id
+    UNION ALL
+    SELECT user_id, product_id, UNIX_TIMESTAMP(MAX(click_time))
+    FROM clicks
+    WHERE product_id IS NOT NULL
+    GROUP BY user_id, product_id
+"""
+
+USER_SEEN_QUERY = f"""
+    SELECT product_id, MAX(seen_at) AS last_seen
+    FROM (
+        SELECT product_id, event_time AS seen_at
+        FROM events
+        WHERE user_id = %s AND product_id IS NOT NULL AND event_type IN ({_EVENT_TYPES_PARAMS})
+        UNION ALL
+        SELECT product_id, click_time
+        FROM clicks
+        WHERE user_id = %s AND product_id IS NOT NULL
+    ) seen
+    GROUP BY product_id
+    ORDER BY last_seen DESC
+    LIMIT %s
+"""
+
+
+def _user_key(user_id):
+    # Ids are numeric strings in the VARCHAR columns; anything else has no entry
+    try:
+        return int(user_id)
+    except (TypeError, ValueError):
+        return None
+
+
+def _empty():
+    return np.empty(0, dtype=np.int64), np.zeros(1, dtype=np.int64), np.empty(0, dtype=np.uint32)
+
+
+def _csr(users: np.ndarray, items: np.ndarray):
+    """(users, indptr, items) from pairs sorted by user."""
+    starts = np.flatnonzero(np.r_[True, users[1:] != users[:-1]]) if len(users) else np.empty(0, dtype=np.int64)
+    indptr = np.r_[starts, len(users)].astype(np.int64)
+    return users[starts], indptr, items.astype(np.uint32)
+
+
+def _pair_order(users: np.ndarray, items: np.ndarray) -> np.ndarray:
+    # Stable sort by (user, item); one 64-bit key when user ids fit in 32 bits
+    if len(users) and users.min() >= 0 and users.max() < 2 ** 32:
+        return np.argsort((users.astype(np.uint64) << np.uint64(32)) | items.astype(np.uint64), kind='stable')
+    return np.lexsort((items, users))
+
+
+def _newest(users: np.ndarray, items: np.ndarray, order: np.ndarray, per_user: int) -> np.ndarray:
+    """Positions of each user's newest `per_user` distinct items, grouped by user, oldest first."""
+    by_age = np.argsort(order, kind='stable')
+    users, items = users[by_age], items[by_age]
+
+    # Keep the newest occurrence of every (user, item) pair: the last of its group
+    by_pair = _pair_order(users, items)
+    pair_users, pair_items = users[by_pair], items[by_pair]
+    last = np.r_[(pair_users[1:] != pair_users[:-1]) | (pair_items[1:] != pair_items[:-1]), True]
+    newest = np.zeros(len(users), dtype=bool)
+    newest[by_pair[last]] = True
+    positions, users = by_age[newest], users[newest]
+
+    # Then each user's newest per_user of them, oldest first
+    by_user = np.argsort(users, kind='stable')
+    positions, users = positions[by_user], users[by_user]
+    starts = np.flatnonzero(np.r_[True, users[1:] != users[:-1]])
+    ends = np.r_[starts[1:], len(users)]
+    keep = np.repeat(ends, ends - starts) - np.arange(len(users)) <= per_user
+    return positions[keep]
+
+
+def compact(users: np.ndarray, items: np.ndarray, order: np.ndarray, per_user: int):
+    """(users, indptr, items) of each user's newest `per_user` distinct items; `order` ranks pairs oldest first."""
+    if len(users) == 0:
+        return _empty()
+    keep = _newest(users, items, order, per_user)
+    return _csr(users[keep], items[keep])
+
+
+def merge_pairs(users: np.ndarray, indptr: np.ndarray, items: np.ndarray, new_users: np.ndarray,
+          new_items: np.ndarray, per_user: int):
+    """Arrays with newer (new_users, new_items) pairs added; only the users they touch are re-compacted."""
+    counts = np.diff(indptr)
+    row_users = np.repeat(users, counts)
+    row_touched = np.repeat(np.isin(users, new_users), counts)
+    touched = compact(np.concatenate([row_users[row_touched], new_users]),
+                      np.concatenate([items[row_touched], new_items]),
+                      np.arange(row_touched.sum() + len(new_users)), per_user)
+
+    # Two runs, each grouped by user: a stable sort by user interleaves them without reordering a user's items
+    users = np.concatenate([row_users[~row_touched], np.repeat(touched[0], np.diff(touched[1]))])
+    items = np.concatenate([items[~row_touched], touched[2]])
+    by_user = np.argsort(users, kind='stable')
+    return _csr(users[by_user], items[by_user])
+
+
+async def fetch_seen(conn, per_user: int):
+    """(user ids, product ids, last seen unix time) of each user's newest `per_user` seen pairs, streamed in chunks.
+
+    Streamed rows are buffered until they outnumber the pairs kept so far, then
+    folded into them in a worker thread, so memory stays within a small multiple
+    of the per-user-bounded result however long the histories in MySQL are.
+    """
+    kept = (np.empty(0, dtype=np.int64), np.empty(0, dtype=np.uint32), np.empty(0, dtype=np.float64))
+    users, items, seen_at, buffered = [], [], [], 0
+
+    async def fold():
+        arrays = tuple(np.concatenate([part, *chunks]) for part, chunks in zip(kept, (users, items, seen_at)))
+        keep = await asyncio.to_thread(_newest, *arrays, per_user)
+        for chunks in (users, items, seen_at):
+            chunks.clear()
+        return tuple(array[keep] for array in arrays)
+
+    async with conn.cursor(aiomysql.SSCursor) as cur:
+        await cur.execute(SEEN_QUERY, SEEN_EVENT_TYPES)
+        while True:
+            rows = await cur.fetchmany(SEEN_FETCH_SIZE)
+            if not rows:
+                break
+            chunk = pd.DataFrame(rows, columns=['user_id', 'product_id', 'seen_at'])
+            chunk['user_id'] = pd.to_numeric(chunk['user_id'], errors='coerce')
+            chunk = chunk.dropna()
+            users.append(chunk['user_id'].to_numpy(dtype=np.int64))
+            items.append(chunk['product_id'].to_numpy(dtype=np.uint32))
+            seen_at.append(chunk['seen_at'].to_numpy(dtype=np.float64))
+            buffered += len(chunk)
+            # Folding once the buffer outgrows the kept pairs keeps the total sorting work at O(n log n)
+            if buffered >= max(len(kept[0]), SEEN_FETCH_SIZE):
+                kept, buffered = await fold(), 0
+    return await fold() if users else kept
+
+
+def _pairs(recent: dict):
+    users = np.repeat(np.fromiter(recent, dtype=np.int64, count=len(recent)),
+                      [len(items) for items in recent.values()])
+    items = np.fromiter(itertools.chain.from_iterable(recent.values()), dtype=np.uint32, count=len(users))
+    return users, items
+
+
+class SeenItemsIndex:
+    def __init__(self, per_user: int = SEEN_ITEMS_PER_USER, delta_max: int = SEEN_DELTA_MAX,
+                 ttl: float = SEEN_ITEMS_TTL):
+        self.per_user = per_user
+        self.delta_max = delta_max
+        self.ttl = ttl
+        self.users, self.indptr, self.items = _empty()
+        # user -> product ids ingested since the last merge, oldest first
+        self.delta = {}
+        self._delta_size = 0
+        # Additions taken by a running merge or load, still served until it lands
+        self._merging = {}
+        self.loaded_at = None
+        self._task = None
+
+    def __len__(self) -> int:
+        return len(self.users)
+
+    @property
+    def nbytes(self) -> int:
+        return self.users.nbytes + self.indptr.nbytes + self.items.nbytes
+
+    def record(self, user_id, product_id):
+        """Add one ingested interaction; the additions are merged into the arrays once there are enough."""
+        user_id = _user_key(user_id)
+        if user_id is None:
+            return
+        product_id = int(product_id)
+        recent = self.delta.setdefault(user_id, [])
+        if product_id in recent:
+            recent.remove(product_id)
+        else:
+            self._delta_size += 1
+        recent.append(product_id)
+        if len(recent) > self.per_user:
+            recent.pop(0)
+            self._delta_size -= 1
+        if self._delta_size >= self.delta_max:
+            self._schedule(self.merge)
+
+    def lookup(self, user_id) -> np.ndarray:
+        """Product ids the user has seen, from memory only; may repeat ids across recent additions."""
+        user_id = _user_key(user_id)
+        if user_id is None:
+            return self.items[:0]
+        position = np.searchsorted(self.users, user_id)
+        if position < len(self.users) and self.users[position] == user_id:
+            parts = [self.items[self.indptr[position]:self.indptr[position + 1]]]
+        else:
+            parts = [self.items[:0]]
+        for recent in (self._merging.get(user_id), self.delta.get(user_id)):
+            if recent:
+                parts.append(np.asarray(recent, dtype=np.uint32))
+        return parts[0] if len(parts) == 1 else np.concatenate(parts)
+
+    async def get(self, user_id) -> np.ndarray:
+        """Product ids the user has seen; queries MySQL for the user until the index is loaded."""
+        if self.loaded_at is None:
+            self._schedule(self.load)
+            return await self.fetch_user(user_id)
+        if time.monotonic() - self.loaded_at > self.ttl:
+            self._schedule(self.load)
+        return self.lookup(user_id)
+
+    async def fetch_user(self, user_id) -> np.ndarray:
+        async with get_db_connection() as conn:
+            async with conn.cursor() as cur:
+                await cur.execute(USER_SEEN_QUERY, (user_id, *SEEN_EVENT_TYPES, user_id, self.per_user))
+                rows = await cur.fetchall()
+        fetched = np.array([row[0] for row in reversed(rows)], dtype=np.uint32)
+        return np.concatenate([fetched, self.lookup(user_id)])
+
+    def _take_delta(self):
+        # Later additions go to a fresh delta; the taken ones stay visible in _merging until they land
+        for user_id, recent in self.delta.items():
+            self._merging.setdefault(user_id, []).extend(recent)
+        self.delta, self._delta_size = {}, 0
+        return _pairs(self._merging)
+
+    async def merge(self):
+        """Fold the recent additions into the arrays."""
+        delta_users, delta_items = self._take_delta()
+        self.users, self.indptr, self.items = await asyncio.to_thread(
+            merge_pairs, self.users, self.indptr, self.items, delta_users, delta_items, self.per_user)
+        self._merging = {}
+
+    async def load(self):
+        """Rebuild the arrays from MySQL, keeping the additions ingested meanwhile."""
+        started = time.monotonic()
+        delta_users, delta_items = self._take_delta()
+        async with get_db_connection() as conn:
+            users, items, seen_at = await fetch_seen(conn, self.per_user)
+        order = np.concatenate([seen_at, seen_at.max(initial=0) + 1 + np.arange(len(delta_users))])
+        self.users, self.indptr, self.items = await asyncio.to_thread(
+            compact, np.concatenate([users, delta_users]), np.concatenate([items, delta_items]),
+            order, self.per_user)
+        self._merging = {}
+        self.loaded_at = time.monotonic()
+        logger.info(f"Seen items loaded for {len(self.users)} users, {len(self.items)} products "
+                    f"({self.nbytes / 2 ** 20:.1f} MiB) in {time.monotonic() - started:.1f}s")
+
+    async def ensure_loaded(self):
+        """Load the arrays unless they are loaded, sharing a load already running."""
+        for _ in range(2):
+            if self.loaded_at is not None:
+                return
+            # A merge may be running; the load is scheduled once it finishes
+            self._schedule(self.load)
+            await asyncio.shield(self._task)
+        if self.loaded_at is None:
+            raise RuntimeError("seen items index not loaded")
+
+    def _schedule(self, job):
+        # One merge or load at a time; a skipped merge happens on a later addition
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run(job))
+
+    async def _run(self, job):
+        try:
+            await job()
+        except Exception:
+            logger.exception("Updating the seen items index failed; serving the current arrays")
+
+
+seen_items = SeenItemsIndex()
@@ -1,16 +1,28 @@
 from fastapi import APIRouter, HTTPException, BackgroundTasks
 import aiomysql
+import asyncio
+import os
+import pandas as pd
 from typing import Optional
 from models import UserInput, Metrics, Event
 
 
 # Assuming DB_CONFIG and get_db_connection() are defined as shown earlier
 from .database import DB_CONFIG, get_db_connection
+from .analytics_store import analytics_store, store_available
+from .cache import single_flight
+from .recommendation_cache import recommendation_cache
+from .seen_items import seen_items, SEEN_EVENT_TYPES
+from .trending import trending, IMPRESSIONS, CLICKS
+from .ctr import ctr_estimator, validate_source
 
 router = APIRouter()
 
+# Identical conversion-rate requests within this window share one aggregation
+CONVERSION_RATES_CACHE_TTL = float(os.getenv("CONVERSION_RATES_CACHE_TTL", "60"))
+
 async def record_impression(user_id: int, product_id: int):
-    async with await get_db_connection() as conn:
+    async with get_db_connection() as conn:
         async with conn.cursor() as cur:
             await cur.execute(
                 "INSERT INTO impressions (user_id, product_id, impression_time) VALUES (%s, %s, NOW())",
@@ -19,7 +31,7 @@ async def record_impression(user_id: int, product_id: int):
             await conn.commit()
 
 async def record_click(user_id: int, product_id: int):
-    async with await get_db_connection() as conn:
+    async with get_db_connection() as conn:
         async with conn.cursor() as cur:
             await cur.execute(
                 "INSERT INTO clicks (user_id, product_id, click_time) VALUES (%s, %s, NOW())",
@@ -28,13 +40,26 @@ async def record_click(user_id: int, product_id: int):
             await conn.commit()
 
 @router.post("/impression/{user_id}/{product_id}")
-async def track_impression(background_tasks: BackgroundTasks, user_id: int, product_id: int):
+async def track_impression(background_tasks: BackgroundTasks, user_id: int, product_id: int,
+                           source: Optional[str] = None, slot: Optional[int] = None):
+    try:
+        validate_source(source, slot)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
     background_tasks.add_task(record_impression, user_id, product_id)
+    # source / slot: where the product was shown (e.g. the recommending route and position), for CTR by source
+    ctr_estimator.record_impression(user_id, product_id, source, slot)
+    background_tasks.add_task(trending.record, user_id, product_id, IMPRESSIONS)
     return {"message": "Impression recorded"}
 
 @router.post("/click/{user_id}/{product_id}")
 async def track_click(background_tasks: BackgroundTasks, user_id: int, product_id: int):
     background_tasks.add_task(record_click, user_id, product_id)
+    ctr_estimator.record_click(user_id, product_id)
+    background_tasks.add_task(trending.record, user_id, product_id, CLICKS)
+    seen_items.record(user_id, product_id)
+    # The user's cached recommendations no longer reflect their behaviour
+    await recommendation_cache.invalidate_user(user_id)
     return {"message": "Click recorded"}
 
 
@@ -45,7 +70,7 @@ async def get_metrics(metric: str):
     if metric not in ["impressions", "clicks"]:
         raise HTTPException(status_code=404, detail="Metric not found")
 
-    async with await get_db_connection() as conn:
+    async with get_db_connection() as conn:
         async with conn.cursor() as cur:
             if metric == "impressions":
                 await cur.execute("SELECT COUNT(*) FROM impressions")
@@ -56,9 +81,31 @@ async def get_metrics(metric: str):
     return {metric: total}
 
 
+def conversion_rates_from_store():
+    events = analytics_store.to_pandas(columns=['event_type', 'event_time'])
+    if events.empty:
+        return []
+    events['month'] = events['event_time'].dt.strftime('%Y-%m')
+    events['month_name'] = events['event_time'].dt.month_name()
+    events['trial'] = events['event_type'].isin(['view', 'cart'])
+    events['conversion'] = events['event_type'] == 'purchase'
+    rates = events.groupby(['month', 'month_name'], sort=False).agg(
+        total_trials=('trial', 'sum'), total_conversions=('conversion', 'sum')
+    ).reset_index().sort_values('month')
+    rates['conversion_rate'] = (rates['total_conversions'] / rates['total_trials'].where(rates['total_trials'] > 0)) * 100
+    # Same shape as the SQL version; NULL rate when a month has no trials
+    return [
+        {**row, 'conversion_rate': None if pd.isna(row['conversion_rate']) else row['conversion_rate']}
+        for row in rates.to_dict(orient='records')
+    ]
+
 @router.get("/conversion-rates/")
+@single_flight(ttl=CONVERSION_RATES_CACHE_TTL, namespace='analytics')
 async def get_conversion_rates():
-    async with await get_db_connection() as conn:
+    if store_available():
+        return await asyncio.to_thread(conversion_rates_from_store)
+
+    async with get_db_connection() as conn:
         async with conn.cursor(aiomysql.DictCursor) as cur:
            await cur.execute("""
                 SELECT 
@@ -78,20 +125,22 @@ async def get_conversion_rates():
     return rates
 
 # Function to insert event data into the events table
+# events.product_id is generated from the URI, so the product is recorded as its URI
 async def add_event(event: Event):
-    conn = await get_db_connection()
-    try:
+    async with get_db_connection() as conn:
         async with conn.cursor() as cur:
             await cur.execute(
-                "INSERT INTO events (user_id, product_id, event_type) VALUES (%s, %s, %s)",
-                (event.user_id, event.product_id, event.event_type)
+                "INSERT INTO events (user_id, event_type, uri) VALUES (%s, %s, %s)",
+                (event.user_id, event.event_type, f"/product/{event.product_id}")
             )
             await conn.commit()
-    finally:
-        conn.close()
 
 # API endpoint to add events
 @router.post("/events/add")
-async def add_event_route(event: Event):
+async def add_event_route(event: Event, background_tasks: BackgroundTasks):
     await add_event(event)
+    background_tasks.add_task(trending.record_event, event.user_id, event.product_id, event.event_type)
+    if event.event_type in SEEN_EVENT_TYPES:
+        seen_items.record(event.user_id, event.product_id)
+    await recommendation_cache.invalidate_user(event.user_id)
     return {"message": "Event added successfully"}
\ No newline at end of file
@@ -0,0 +1,430 @@
+"""Offline training of the hybrid LightFM recommender.
+
+Pulls users, products and product events from MySQL (or events from the
+local analytics extract), builds the matrices with ``matrix_builder``,
+trains with ``fit_partial`` on every core and stops early on the train/test
+AUC gap, as the original notebook did. Each run writes a versioned
+directory and, unless told otherwise, promotes it to the paths the API
+loads:
+
+    recommendation-model/versions/<version>/recommendation_hybrid_model.pkl
+    recommendation-model/versions/<version>/dataset_mapping.pkl
+    recommendation-model/versions/<version>/metadata.json
+    recommendation-model/versions/<version>/embeddings/*.npy  (memory-mapped by the API)
+    recommendation-model/recommendation_hybrid_model.pkl   (promoted)
+    recommendation-model/dataset_mapping.pkl               (promoted)
+
+Incremental runs warm-start from the promoted model: the saved mapping is
+extended with new users/items/features, the embeddings are grown to match,
+and only events after the model's ``last_event_id`` are trained on. The
+result is promoted only if it scores no worse than the previous model on
+held-out new events; every FULL_RETRAIN_DAYS an incremental run falls back
+to a full retrain.
+
+Usage:
+    python -m components.training
+    python -m components.training --source store --epochs 100 --no-promote
+    python -m components.training --mode incremental     # e.g. hourly from cron
+    python -m components.training --params recommendation-model/best_params.json
+"""
+import argparse
+import asyncio
+import copy
+import json
+import logging
+import os
+import shutil
+import time
+from datetime import datetime, timezone
+
+import joblib
+import numpy as np
+import pandas as pd
+from lightfm import LightFM
+from lightfm.cross_validation import random_train_test_split
+from lightfm.evaluation import auc_score, precision_at_k
+
+from .analytics_store import analytics_store
+from .database import get_db_connection
+from .model_registry import file_sha256, set_pointer
+from . import embedding_store, matrix_builder
+
+logger = logging.getLogger(__name__)
+
+MODEL_DIR = os.getenv("RECOMMENDATION_MODEL_DIR", "recommendation-model")
+MODEL_FILE = 'recommendation_hybrid_model.pkl'
+MAPPING_FILE = 'dataset_mapping.pkl'
+METADATA_FILE = 'metadata.json'
+
+# The hand-tuned notebook configuration
+DEFAULT_PARAMS = {
+    'loss': 'warp',
+    'no_components': 30,
+    'learning_schedule': 'adagrad',
+    'learning_rate': 0.03,
+    'user_alpha': 1e-4,
+    'item_alpha': 1e-4,
+    'random_state': 1616,
+}
+
+EVENT_TYPE_WEIGHTS = {
+    'purchase': 3.0, 'cart': 2.5, 'product': 2.0, 'department': 1.0, 'cancel': 0.5, 'home': 0.5
+}
+
+TEST_PERCENTAGE = 0.2
+SPLIT_SEED = 779
+MAX_EPOCHS = 50
+EVALUATION_INTERVAL = 5
+MAX_GAP = 0.05
+PATIENCE = 3
+PRECISION_K = 10
+
+INCREMENTAL_EPOCHS = int(os.getenv("INCREMENTAL_EPOCHS", "5"))
+FULL_RETRAIN_DAYS = float(os.getenv("FULL_RETRAIN_DAYS", "7"))
+# Largest drop in held-out AUC an incremental update may cause and still be promoted
+QUALITY_GATE_TOLERANCE = float(os.getenv("QUALITY_GATE_TOLERANCE", "0.01"))
+
+
+# --- Data ---
+
+async def fetch_training_frames(source: str = 'db', since_event_id: int = 0):
+    """users, products and product events (with events.id) newer than since_event_id, as DataFrames."""
+    async with get_db_connection() as conn:
+        async with conn.cursor() as cur:
+            await cur.execute("SELECT id, age, gender, location FROM users")
+            users = await cur.fetchall()
+            await cur.execute("SELECT id, product_category, product_Brand, department FROM products")
+            products = await cur.fetchall()
+            if source == 'db':
+                await cur.execute("""
+                    SELECT e.id, e.user_id, e.event_type, e.product_id
+                    FROM events e
+                    WHERE e.product_id IS NOT NULL AND e.id > %s
+                """, (since_event_id,))
+                events = pd.DataFrame(await cur.fetchall(), columns=['event_id', 'user_id', 'event_type', 'product_id'])
+
+    if source == 'store':
+        import pyarrow.dataset as ds
+        events = (await asyncio.to_thread(
+            analytics_store.scan,
+            columns=['event_id', 'user_id', 'event_type', 'product_id'],
+            filter=ds.field('product_id').is_valid() & (ds.field('event_id') > since_event_id),
+        )).to_pandas()
+
+    users_df = pd.DataFrame(users, columns=['id', 'age', 'gender', 'location'])
+    products_df = pd.DataFrame(products, columns=['id', 'product_category', 'product_Brand', 'department'])
+    return users_df, products_df, events
+
+
+def clean_events(events_df, users_df, products_df):
+    # Same rules as the serving preprocessing: events.user_id refers to users.id
+    events_df = events_df.assign(event_weight=events_df['event_type'].map(EVENT_TYPE_WEIGHTS))
+    events_df = events_df.dropna(subset=['product_id', 'user_id', 'event_weight'])
+    events_df = events_df[pd.to_numeric(events_df['user_id'], errors='coerce').notna()]
+    events_df = events_df.assign(user_id=events_df['user_id'].astype(np.int64),
+                                 product_id=events_df['product_id'].astype(np.int64))
+    return events_df[events_df['user_id'].isin(users_df['id']) & events_df['product_id'].isin(products_df['id'])]
+
+
+def build_matrices(users_df, products_df, events_df, dataset=None):
+    """(dataset, interactions, weights, user_features, item_features) for training."""
+    user_tokens = matrix_builder.user_feature_tokens(users_df)
+    item_tokens = matrix_builder.join_tokens(products_df, ['product_category', 'product_Brand', 'department'])
+    dataset = matrix_builder.fit_dataset(users_df['id'], products_df['id'], user_tokens, item_tokens, dataset=dataset)
+    interactions, weights = matrix_builder.build_interactions(
+        dataset, events_df['user_id'], events_df['product_id'], events_df['event_weight'])
+    user_features = matrix_builder.build_user_features(dataset, users_df['id'], user_tokens)
+    item_features = matrix_builder.build_item_features(dataset, products_df['id'], item_tokens)
+    return dataset, interactions, weights, user_features, item_features
+
+
+# --- Training ---
+
+def evaluate(model, train, test, user_features, item_features, k: int = PRECISION_K, num_threads: int = 1):
+    kwargs = {'user_features': user_features, 'item_features': item_features, 'num_threads': num_threads}
+    metrics = {
+        'train_auc': float(auc_score(model, train, **kwargs).mean()),
+        'test_auc': float(auc_score(model, test, **kwargs).mean()),
+        f'train_precision_at_{k}': float(precision_at_k(model, train, k=k, **kwargs).mean()),
+        f'test_precision_at_{k}': float(precision_at_k(model, test, k=k, **kwargs).mean()),
+    }
+    metrics['gap'] = metrics['train_auc'] - metrics['test_auc']
+    return metrics
+
+
+def train_model(train, test, user_features, item_features, params: dict = None, model: LightFM = None,
+                max_epochs: int = MAX_EPOCHS, evaluation_interval: int = EVALUATION_INTERVAL,
+                max_gap: float = MAX_GAP, patience: int = PATIENCE, k: int = PRECISION_K,
+                num_threads: int = None):
+    """Train until the AUC gap exceeds max_gap or stops improving for `patience` evaluations.
+
+    Returns (model, metrics, history); the model is the last snapshot whose gap was
+    under max_gap, or the final one if none was. An existing model is trained further.
+    """
+    num_threads = num_threads or os.cpu_count() or 1
+    if model is None:
+        model = LightFM(**{**DEFAULT_PARAMS, **(params or {})})
+
+    best_model, patience_counter = None, 0
+    history = []
+    for epoch in range(max_epochs):
+        model.fit_partial(train, user_features=user_features, item_features=item_features,
+                          epochs=1, num_threads=num_threads)
+        if (epoch + 1) % evaluation_interval:
+            continue
+
+        metrics = evaluate(model, train, test, user_features, item_features, k, num_threads)
+        history.append({'epoch': epoch + 1, **metrics})
+        logger.info(f"Epoch {epoch + 1}: train AUC {metrics['train_auc']:.4f}, test AUC {metrics['test_auc']:.4f}, "
+                    f"gap {metrics['gap']:.4f}, test p@{k} {metrics[f'test_precision_at_{k}']:.4f}")
+
+        # The notebook's criterion: keep snapshots while the gap stays under max_gap
+        if metrics['gap'] < max_gap:
+            best_model, patience_counter = copy.deepcopy(model), 0
+        else:
+            patience_counter += 1
+            if patience_counter >= patience or metrics['gap'] > max_gap:
+                logger.info(f"Early stopping at epoch {epoch + 1}")
+                break
+
+    model = best_model or model
+    return model, evaluate(model, train, test, user_features, item_features, k, num_threads), history
+
+
+def _grow(array, rows, fill=None, random_state=None, no_components=None):
+    if rows <= array.shape[0]:
+        return array
+    shape = (rows - array.shape[0],) + array.shape[1:]
+    if fill is None:
+        # LightFM._initialize's embedding initialisation
+        extra = ((random_state.rand(*shape) - 0.5) / no_components).astype(np.float32)
+    else:
+        extra = np.full(shape, fill, dtype=np.float32)
+    return np.concatenate([array, extra])
+
+
+def resize_model(model: LightFM, n_user_features: int, n_item_features: int) -> LightFM:
+    """Copy of model with embedding rows for newly added user/item features."""
+    model = copy.deepcopy(model)
+    # New rows start as LightFM._initialize would start them
+    gradient_fill = 1.0 if model.learning_schedule == 'adagrad' else 0.0
+    for prefix, rows in (('user', n_user_features), ('item', n_item_features)):
+        setattr(model, f'{prefix}_embeddings', _grow(getattr(model, f'{prefix}_embeddings'), rows,
+                                                      random_state=model.random_state,
+                                                      no_components=model.no_components))
+        setattr(model, f'{prefix}_embedding_gradients', _grow(getattr(model, f'{prefix}_embedding_gradients'), rows, gradient_fill))
+        setattr(model, f'{prefix}_embedding_momentum', _grow(getattr(model, f'{prefix}_embedding_momentum'), rows, 0.0))
+        setattr(model, f'{prefix}_biases', _grow(getattr(model, f'{prefix}_biases'), rows, 0.0))
+        setattr(model, f'{prefix}_bias_gradients', _grow(getattr(model, f'{prefix}_bias_gradients'), rows, gradient_fill))
+        setattr(model, f'{prefix}_bias_momentum', _grow(getattr(model, f'{prefix}_bias_momentum'), rows, 0.0))
+    return model
+
+
+def passes_quality_gate(candidate: dict, baseline: dict, tolerance: float = QUALITY_GATE_TOLERANCE) -> bool:
+    # AUC is NaN when the test split has no interactions to rank: no improvement is shown, keep the current model
+    if np.isnan(candidate['test_auc']) or np.isnan(baseline['test_auc']):
+        logger.warning(f"Test AUC undefined (candidate {candidate['test_auc']}, baseline {baseline['test_auc']})")
+        return False
+    return candidate['test_auc'] >= baseline['test_auc'] - tolerance
+
+
+# --- Artifacts ---
+
+def new_version() -> str:
+    return datetime.now(timezone.utc).strftime('%Y%m%dT%H%M%SZ')
+
+
+def _atomic_copy(source: str, target: str):
+    tmp_path = os.path.join(os.path.dirname(target), f".{os.path.basename(target)}.tmp")
+    shutil.copyfile(source, tmp_path)
+    os.replace(tmp_path, target)
+
+
+def write_artifacts(model, dataset, metadata: dict, model_dir: str = MODEL_DIR) -> str:
+    """Write model, dataset mapping and metadata into a new version directory."""
+    version_dir = os.path.join(model_dir, 'versions', metadata['version'])
+    tmp_dir = os.path.join(model_dir, 'versions', f".{metadata['version']}.tmp")
+    os.makedirs(tmp_dir, exist_ok=True)
+    joblib.dump(model, os.path.join(tmp_dir, MODEL_FILE))
+    # Dataset.mapping(): (user ids, user features, item ids, item features), read by user_features
+    joblib.dump(dataset.mapping(), os.path.join(tmp_dir, MAPPING_FILE))
+    embedding_files = embedding_store.export(model, dataset.mapping(), os.path.join(tmp_dir, embedding_store.EMBEDDINGS_DIR))
+    files = [MODEL_FILE, MAPPING_FILE] + [f"{embedding_store.EMBEDDINGS_DIR}/{name}" for name in embedding_files]
+    # Verified by the model registry before it loads the version
+    metadata = {**metadata, 'files': {name: file_sha256(os.path.join(tmp_dir, name)) for name in files}}
+    with open(os.path.join(tmp_dir, METADATA_FILE), 'w') as f:
+        json.dump(metadata, f, indent=2)
+    os.replace(tmp_dir, version_dir)
+    return version_dir
+
+
+def read_metadata(version_dir: str) -> dict:
+    with open(os.path.join(version_dir, METADATA_FILE)) as f:
+        return json.load(f)
+
+
+def advance_watermark(model_dir: str, metadata: dict, last_event_id: int):
+    """Move the promoted model's last_event_id past events that left nothing to train on."""
+    path = os.path.join(model_dir, METADATA_FILE)
+    tmp_path = os.path.join(model_dir, f".{METADATA_FILE}.tmp")
+    with open(tmp_path, 'w') as f:
+        json.dump({**metadata, 'last_event_id': last_event_id}, f, indent=2)
+    os.replace(tmp_path, path)
+
+
+def promote(version_dir: str, model_dir: str = MODEL_DIR):
+    # Mapping first: a reader that sees the new model also finds its vocabulary
+    _atomic_copy(os.path.join(version_dir, MAPPING_FILE), os.path.join(model_dir, MAPPING_FILE))
+    _atomic_copy(os.path.join(version_dir, MODEL_FILE), os.path.join(model_dir, MODEL_FILE))
+    _atomic_copy(os.path.join(version_dir, METADATA_FILE), os.path.join(model_dir, METADATA_FILE))
+    # Running API workers hot-swap to it when they see the registry pointer move
+    set_pointer(os.path.dirname(version_dir), os.path.basename(version_dir))
+    logger.info(f"Promoted {version_dir}")
+
+
+async def run(source: str = 'db', params: dict = None, max_epochs: int = MAX_EPOCHS, num_threads: int = None,
+              promote_model: bool = True, model_dir: str = MODEL_DIR) -> str:
+    started = time.monotonic()
+    users_df, products_df, events_df = await fetch_training_frames(source)
+    last_event_id = int(events_df['event_id'].max()) if len(events_df) else 0
+    events_df = clean_events(events_df, users_df, products_df)
+
+    dataset, interactions, weights, user_features, item_features = build_matrices(users_df, products_df, events_df)
+    train, test = random_train_test_split(interactions, test_percentage=TEST_PERCENTAGE,
+                                          random_state=np.random.RandomState(SPLIT_SEED))
+    model, metrics, history = train_model(train, test, user_features, item_features, params,
+                                          max_epochs=max_epochs, num_threads=num_threads)
+
+    trained_at = datetime.now(timezone.utc).isoformat()
+    metadata = {
+        'version': new_version(),
+        'mode': 'full',
+        'trained_at': trained_at,
+        'last_full_at': trained_at,
+        'source': source,
+        'params': {**DEFAULT_PARAMS, **(params or {})},
+        'last_event_id': last_event_id,
+        'n_users': interactions.shape[0],
+        'n_items': interactions.shape[1],
+        'n_interactions': int(interactions.nnz),
+        'metrics': metrics,
+        'history': history,
+        'training_seconds': round(time.monotonic() - started, 1),
+    }
+    version_dir = write_artifacts(model, dataset, metadata, model_dir)
+    logger.info(f"Trained model {metadata['version']}: {metrics}")
+    if promote_model:
+        promote(version_dir, model_dir)
+    return version_dir
+
+
+def load_params(path: str) -> dict:
+    """LightFM params from a JSON file: a plain dict or a hyperparameter_search result."""
+    with open(path) as f:
+        params = json.load(f)
+    return params.get('params', params)
+
+
+def _full_retrain_due(metadata: dict, full_retrain_days: float) -> bool:
+    last_full_at = datetime.fromisoformat(metadata['last_full_at'])
+    return (datetime.now(timezone.utc) - last_full_at).total_seconds() > full_retrain_days * 86400
+
+
+async def run_incremental(source: str = 'db', max_epochs: int = INCREMENTAL_EPOCHS, num_threads: int = None,
+                          promote_model: bool = True, model_dir: str = MODEL_DIR,
+                          full_retrain_days: float = FULL_RETRAIN_DAYS):
+    """Warm-start the promoted model on events since its watermark; returns the new version dir or None."""
+    try:
+        current = read_metadata(model_dir)
+    except FileNotFoundError:
+        logger.info("No promoted model metadata; running a full retrain")
+        return await run(source, num_threads=num_threads, promote_model=promote_model, model_dir=model_dir)
+    if _full_retrain_due(current, full_retrain_days):
+        logger.info(f"Last full retrain at {current['last_full_at']}; running a full retrain")
+        return await run(source, current['params'], num_threads=num_threads,
+                         promote_model=promote_model, model_dir=model_dir)
+
+    started = time.monotonic()
+    users_df, products_df, events_df = await fetch_training_frames(source, current['last_event_id'])
+    if events_df.empty:
+        logger.info(f"No events after id {current['last_event_id']}; model {current['version']} is current")
+        return None
+    last_event_id = int(events_df['event_id'].max())
+    events_df = clean_events(events_df, users_df, products_df)
+    if events_df.empty:
+        # Only events of unknown users/products or of ignored types: skip them next time
+        logger.info(f"No usable events up to id {last_event_id}; model {current['version']} is current")
+        if promote_model:
+            advance_watermark(model_dir, current, last_event_id)
+        return None
+
+    previous = joblib.load(os.path.join(model_dir, MODEL_FILE))
+    dataset = matrix_builder.dataset_from_mapping(joblib.load(os.path.join(model_dir, MAPPING_FILE)))
+    dataset, interactions, weights, user_features, item_features = build_matrices(
+        users_df, products_df, events_df, dataset=dataset)
+    baseline_model = resize_model(previous, user_features.shape[1], item_features.shape[1])
+
+    train, test = random_train_test_split(interactions, test_percentage=TEST_PERCENTAGE,
+                                          random_state=np.random.RandomState(SPLIT_SEED))
+    num_threads = num_threads or os.cpu_count() or 1
+    baseline = evaluate(baseline_model, train, test, user_features, item_features, num_threads=num_threads)
+    model, metrics, history = train_model(train, test, user_features, item_features,
+                                          model=copy.deepcopy(baseline_model), max_epochs=max_epochs,
+                                          evaluation_interval=1, num_threads=num_threads)
+    passed = passes_quality_gate(metrics, baseline)
+
+    metadata = {
+        **current,
+        'version': new_version(),
+        'mode': 'incremental',
+        'parent_version': current['version'],
+        'trained_at': datetime.now(timezone.utc).isoformat(),
+        'source': source,
+        'last_event_id': last_event_id,
+        'n_users': interactions.shape[0],
+        'n_items': interactions.shape[1],
+        'n_interactions': int(interactions.nnz),
+        'metrics': metrics,
+        'baseline_metrics': baseline,
+        'quality_gate_passed': passed,
+        'history': history,
+        'training_seconds': round(time.monotonic() - started, 1),
+    }
+    version_dir = write_artifacts(model, dataset, metadata, model_dir)
+    logger.info(f"Incremental model {metadata['version']} on {interactions.nnz} new interactions: "
+                f"test AUC {metrics['test_auc']:.4f} vs {baseline['test_auc']:.4f} before")
+    if not passed:
+        logger.warning(f"Quality gate failed; keeping model {current['version']}")
+    elif promote_model:
+        promote(version_dir, model_dir)
+    return version_dir
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Train the hybrid LightFM recommender")
+    parser.add_argument('--source', choices=['db', 'store'], default='db',
+                        help="read events from MySQL or the local analytics extract")
+    parser.add_argument('--mode', choices=['full', 'incremental'], default='full')
+    parser.add_argument('--epochs', type=int, default=None,
+                        help=f"default {MAX_EPOCHS} (full) or {INCREMENTAL_EPOCHS} (incremental)")
+    parser.add_argument('--threads', type=int, default=None, help="defaults to all cores")
+    parser.add_argument('--params', default=None, help="JSON file of LightFM params (full mode)")
+    parser.add_argument('--model-dir', default=MODEL_DIR)
+    parser.add_argument('--no-promote', action='store_true', help="only write the versioned artifacts")
+    parser.add_argument('--full-every-days', type=float, default=FULL_RETRAIN_DAYS,
+                        help="incremental runs fall back to a full retrain after this long")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    if args.mode == 'incremental':
+        asyncio.run(run_incremental(args.source, max_epochs=args.epochs or INCREMENTAL_EPOCHS,
+                                    num_threads=args.threads, promote_model=not args.no_promote,
+                                    model_dir=args.model_dir, full_retrain_days=args.full_every_days))
+    else:
+        params = load_params(args.params) if args.params else None
+        asyncio.run(run(args.source, params, max_epochs=args.epochs or MAX_EPOCHS, num_threads=args.threads,
+                        promote_model=not args.no_promote, model_dir=args.model_dir))
+
+
+if __name__ == "__main__":
+    main()
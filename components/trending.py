@@ -0,0 +1,402 @@
+"""Real-time product popularity and CTR, fed by the tracking write path.
+
+Every impression, click and event /tracking records also increments
+in-memory counters, so trending products never scan events, impressions or
+clicks:
+
+    RingCounters    one row per key of TRENDING_BUCKETS time buckets of
+                    TRENDING_BUCKET_SECONDS, per signal (impressions, clicks,
+                    engagement); an update is one array increment, and moving to a
+                    new bucket clears the oldest one and frees rows left empty
+    TrendingEngine  keeps counters per product and per (segment, product), with
+                    segments being (gender, age group); reads decay the buckets
+                    with TRENDING_HALF_LIFE into popularity (weighted engagement
+                    plus clicks) and a smoothed CTR, per product, category or segment
+
+Counters are per worker, so with several workers each ranks the share of
+traffic it serves. They are checkpointed every TRENDING_CHECKPOINT_SECONDS and
+on shutdown, and reloaded at startup, to a per-worker slot of
+TRENDING_CHECKPOINT_PATH (trending.pkl, trending.1.pkl, ...; see
+``claim_checkpoint_slot``), so workers never overwrite each other's counters.
+Popularity is also a re-ranking signal for the recommenders (RERANK_TRENDING_WEIGHT).
+"""
+import asyncio
+import fcntl
+import logging
+import os
+import pickle
+import time
+from typing import Optional
+
+import numpy as np
+import pandas as pd
+from fastapi import APIRouter, HTTPException
+
+from .cache import AsyncLRUCache
+from .database import get_db_connection
+from .product_metadata import ProductMetadata, fetch_out_of_stock
+from .user_features import age_group
+from .user_profiles import profile_service
+
+logger = logging.getLogger(__name__)
+
+TRENDING_BUCKET_SECONDS = int(os.getenv("TRENDING_BUCKET_SECONDS", "600"))
+TRENDING_BUCKETS = int(os.getenv("TRENDING_BUCKETS", "36"))
+TRENDING_HALF_LIFE = float(os.getenv("TRENDING_HALF_LIFE", "3600"))
+# Rows per counter set; keys first seen while it is full are not counted until rows free up
+TRENDING_MAX_ROWS = int(os.getenv("TRENDING_MAX_ROWS", "100000"))
+# Decayed scores are recomputed at most this often
+TRENDING_REFRESH_SECONDS = float(os.getenv("TRENDING_REFRESH_SECONDS", "5"))
+TRENDING_CATALOG_TTL = int(os.getenv("TRENDING_CATALOG_TTL", "300"))
+TRENDING_CHECKPOINT_PATH = os.getenv("TRENDING_CHECKPOINT_PATH", "recommendation-model/trending.pkl")
+TRENDING_CHECKPOINT_SECONDS = float(os.getenv("TRENDING_CHECKPOINT_SECONDS", "300"))
+# Upper bound on the workers that checkpoint side by side
+CHECKPOINT_SLOTS = int(os.getenv("CHECKPOINT_SLOTS", "64"))
+TRENDING_SEGMENT_CACHE_SIZE = int(os.getenv("TRENDING_SEGMENT_CACHE_SIZE", "100000"))
+# Beta prior of the CTR: TRENDING_CTR_PRIOR_CLICKS clicks in TRENDING_CTR_PRIOR_IMPRESSIONS impressions
+TRENDING_CTR_PRIOR_CLICKS = float(os.getenv("TRENDING_CTR_PRIOR_CLICKS", "1"))
+TRENDING_CTR_PRIOR_IMPRESSIONS = float(os.getenv("TRENDING_CTR_PRIOR_IMPRESSIONS", "50"))
+
+IMPRESSIONS, CLICKS, ENGAGEMENT = range(3)
+# Engagement weight per event type, as the recommender weighs them
+EVENT_WEIGHTS = {'purchase': 3.0, 'cart': 2.5, 'product': 2.0, 'view': 2.0}
+
+CATALOG_QUERY = """
+    SELECT id, product_name, product_category, product_Brand, department, selling_price, max_margin
+    FROM products
+"""
+
+router = APIRouter()
+
+
+# checkpoint path -> (slot path, open lock file held for the life of the process)
+_checkpoint_slots = {}
+
+
+def claim_checkpoint_slot(path: str) -> str:
+    """This process's checkpoint file for `path`: slot 0 is `path` itself, slot n is <name>.<n><ext>.
+
+    A slot is held through an flock on its .lock file, which the OS releases when the worker
+    exits, so concurrent workers always get different slots and a restarted worker takes
+    over (and restores) a slot whose owner is gone.
+    """
+    if path in _checkpoint_slots:
+        return _checkpoint_slots[path][0]
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    base, ext = os.path.splitext(path)
+    for slot in range(CHECKPOINT_SLOTS):
+        slot_path = path if slot == 0 else f"{base}.{slot}{ext}"
+        lock_file = open(f"{slot_path}.lock", 'a')
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            lock_file.close()
+            continue
+        _checkpoint_slots[path] = (slot_path, lock_file)
+        return slot_path
+    raise RuntimeError(f"All {CHECKPOINT_SLOTS} checkpoint slots of {path} are in use; raise CHECKPOINT_SLOTS")
+
+
+def segment_of(profile) -> Optional[str]:
+    if profile is None:
+        return None
+    return f"{str(profile.gender).lower()}|{age_group(profile.age)}"
+
+
+class RingCounters:
+    """Time-bucketed counters: counts[bucket, row, signal], buckets used as a ring."""
+
+    def __init__(self, buckets: int = TRENDING_BUCKETS, bucket_seconds: int = TRENDING_BUCKET_SECONDS,
+                 signals: int = 3, max_rows: int = TRENDING_MAX_ROWS, capacity: int = 1024):
+        self.buckets = buckets
+        self.bucket_seconds = bucket_seconds
+        self.max_rows = max_rows
+        self.counts = np.zeros((buckets, min(capacity, max_rows), signals), dtype=np.float32)
+        self.rows = {}
+        self.keys = []
+        self.free = []
+        self.current = None
+        self.dropped = 0
+
+    def __len__(self) -> int:
+        return len(self.rows)
+
+    def advance(self, now: float):
+        """Make `now`'s bucket the current one, clearing the buckets it skipped over."""
+        bucket = int(now // self.bucket_seconds)
+        if self.current is None:
+            self.current = bucket
+        if bucket <= self.current:
+            return
+        for skipped in range(max(self.current + 1, bucket - self.buckets + 1), bucket + 1):
+            self.counts[skipped % self.buckets] = 0
+        self.current = bucket
+        self._free_empty_rows()
+
+    def _free_empty_rows(self):
+        used = len(self.keys)
+        empty = np.flatnonzero(~self.counts[:, :used].any(axis=(0, 2)))
+        for row in empty:
+            key = self.keys[row]
+            if key is not None:
+                del self.rows[key]
+                self.keys[row] = None
+                self.free.append(int(row))
+
+    def _row(self, key):
+        row = self.rows.get(key)
+        if row is not None:
+            return row
+        if self.free:
+            row = self.free.pop()
+            self.keys[row] = key
+        elif len(self.keys) < self.max_rows:
+            row = len(self.keys)
+            if row == self.counts.shape[1]:
+                # Grow by doubling so appends stay amortised O(1)
+                grown = np.zeros((self.buckets, min(2 * row, self.max_rows), self.counts.shape[2]), dtype=np.float32)
+                grown[:, :row] = self.counts
+                self.counts = grown
+            self.keys.append(key)
+        else:
+            self.dropped += 1
+            return None
+        self.rows[key] = row
+        return row
+
+    def add(self, key, signal: int, amount: float = 1.0, now: float = None):
+        self.advance(time.time() if now is None else now)
+        row = self._row(key)
+        if row is not None:
+            self.counts[self.current % self.buckets, row, signal] += amount
+
+    def decayed(self, half_life: float, now: float = None) -> np.ndarray:
+        """(rows, signals) totals, each bucket weighted 0.5 ** (its age / half_life)."""
+        used = len(self.keys)
+        if self.current is None:
+            return np.zeros((used, self.counts.shape[2]), dtype=np.float32)
+        self.advance(time.time() if now is None else now)
+        ages = (self.current - np.arange(self.buckets)) % self.buckets
+        weights = (0.5 ** (ages * self.bucket_seconds / half_life)).astype(np.float32)
+        return np.tensordot(weights, self.counts[:, :used], axes=1)
+
+    def state(self) -> dict:
+        return {'buckets': self.buckets, 'bucket_seconds': self.bucket_seconds, 'current': self.current,
+                'keys': list(self.keys), 'counts': self.counts[:, :len(self.keys)].copy()}
+
+    def restore(self, state: dict) -> bool:
+        if (state['buckets'], state['bucket_seconds']) != (self.buckets, self.bucket_seconds):
+            return False
+        keys = state['keys'][:self.max_rows]
+        self.counts = np.zeros((self.buckets, max(len(keys), 1), self.counts.shape[2]), dtype=np.float32)
+        self.counts[:, :len(keys)] = state['counts'][:, :len(keys)]
+        self.keys = list(keys)
+        self.rows = {key: row for row, key in enumerate(keys) if key is not None}
+        self.free = [row for row, key in enumerate(keys) if key is None]
+        self.current = state['current']
+        # Catch up with the time that passed while the service was down
+        self.advance(time.time())
+        return True
+
+
+class TrendingEngine:
+    def __init__(self, half_life: float = TRENDING_HALF_LIFE, refresh_seconds: float = TRENDING_REFRESH_SECONDS,
+                 checkpoint_path: str = TRENDING_CHECKPOINT_PATH):
+        self.half_life = half_life
+        self.refresh_seconds = refresh_seconds
+        self.checkpoint_path = checkpoint_path
+        self._worker_checkpoint_path = None
+        self.products = RingCounters()
+        self.segments = RingCounters()
+        self.segment_cache = AsyncLRUCache(maxsize=TRENDING_SEGMENT_CACHE_SIZE, ttl=3600)
+        self.catalog = None
+        self.catalog_loaded_at = 0.0
+        self._catalog_lock = asyncio.Lock()
+        self._snapshots = {}
+        self._signal = (None, None, None)
+
+    # --- Write path ---
+
+    async def record(self, user_id, product_id, signal: int, amount: float = 1.0):
+        """Count one tracked interaction for the product and for the user's segment."""
+        product_id = int(product_id)
+        self.products.add(product_id, signal, amount)
+        try:
+            segment = await self.segment_cache.get_or_load(
+                str(user_id), lambda: self._load_segment(user_id))
+        except Exception:
+            logger.exception(f"Segment lookup for user {user_id} failed; counted for the product only")
+            return
+        if segment is not None:
+            self.segments.add((segment, product_id), signal, amount)
+
+    async def _load_segment(self, user_id):
+        return segment_of(await profile_service.get(user_id))
+
+    async def record_event(self, user_id, product_id, event_type: str):
+        weight = EVENT_WEIGHTS.get(event_type)
+        if weight:
+            await self.record(user_id, product_id, ENGAGEMENT, weight)
+
+    # --- Read path ---
+
+    def snapshot(self, counters: RingCounters) -> np.ndarray:
+        """Decayed (rows, signals) totals, recomputed at most every refresh_seconds."""
+        computed_at, totals = self._snapshots.get(id(counters), (0.0, None))
+        if totals is None or time.monotonic() - computed_at > self.refresh_seconds or len(totals) != len(counters.keys):
+            totals = counters.decayed(self.half_life)
+            self._snapshots[id(counters)] = (time.monotonic(), totals)
+        return totals
+
+    @staticmethod
+    def scores(totals: np.ndarray):
+        popularity = totals[:, ENGAGEMENT] + totals[:, CLICKS]
+        ctr = ((totals[:, CLICKS] + TRENDING_CTR_PRIOR_CLICKS)
+               / (totals[:, IMPRESSIONS] + TRENDING_CTR_PRIOR_IMPRESSIONS))
+        return popularity, ctr
+
+    def product_totals(self, segment: str = None):
+        """(product ids, decayed totals) overall or within one segment."""
+        if segment is None:
+            keys, totals = self.products.keys, self.snapshot(self.products)
+            used = np.array([key is not None for key in keys], dtype=bool)
+            product_ids = np.array([key if key is not None else -1 for key in keys], dtype=np.int64)
+        else:
+            keys, totals = self.segments.keys, self.snapshot(self.segments)
+            used = np.array([key is not None and key[0] == segment for key in keys], dtype=bool)
+            product_ids = np.array([key[1] if key is not None else -1 for key in keys], dtype=np.int64)
+        return product_ids[used], totals[used]
+
+    def signal(self, metadata: ProductMetadata):
+        """Popularity aligned to `metadata`'s items, scaled to [0, 1]; None before any traffic."""
+        totals = self.snapshot(self.products)
+        cached_metadata, cached_totals, values = self._signal
+        if cached_metadata is metadata and cached_totals is totals:
+            return values
+        values = None
+        if len(totals):
+            product_ids, product_totals = self.product_totals()
+            popularity, _ = self.scores(product_totals)
+            top = popularity.max(initial=0)
+            if top > 0:
+                values = np.zeros(len(metadata), dtype=np.float32)
+                items, found = metadata.indices(product_ids, return_found=True)
+                values[items] = popularity[found] / top
+        self._signal = (metadata, totals, values)
+        return values
+
+    async def ensure_catalog(self) -> ProductMetadata:
+        if self.catalog is None or time.monotonic() - self.catalog_loaded_at > TRENDING_CATALOG_TTL:
+            async with self._catalog_lock:
+                if self.catalog is None or time.monotonic() - self.catalog_loaded_at > TRENDING_CATALOG_TTL:
+                    async with get_db_connection() as conn:
+                        async with conn.cursor() as cur:
+                            await cur.execute(CATALOG_QUERY)
+                            rows = await cur.fetchall()
+                        out_of_stock = await fetch_out_of_stock(conn)
+                    products_df = pd.DataFrame(rows, columns=['id', 'product_name', 'product_category',
+                                                              'product_Brand', 'department', 'selling_price',
+                                                              'max_margin'])
+                    self.catalog = ProductMetadata.from_frame(products_df['id'], products_df, out_of_stock)
+                    self.catalog_loaded_at = time.monotonic()
+        return self.catalog
+
+    async def trending_products(self, limit: int, segment: str = None, category: str = None,
+                                department: str = None) -> list:
+        catalog = await self.ensure_catalog()
+        product_ids, totals = self.product_totals(segment)
+        popularity, ctr = self.scores(totals)
+        # Only products still in the catalog, in stock and matching the filters
+        items, found = catalog.indices(product_ids, return_found=True)
+        popularity, ctr = popularity[found], ctr[found]
+        mask = catalog.available(department)[items]
+        if category is not None:
+            mask &= catalog.mask('category', category)[items]
+        mask &= popularity > 0
+        order = np.flatnonzero(mask)
+        order = order[np.argsort(-popularity[order], kind='stable')][:limit]
+        return [{**catalog.hydrate([items[i]])[0], 'popularity': round(float(popularity[i]), 4),
+                 'ctr': round(float(ctr[i]), 6)} for i in order]
+
+    async def trending_categories(self, limit: int, segment: str = None) -> list:
+        catalog = await self.ensure_catalog()
+        product_ids, totals = self.product_totals(segment)
+        items, found = catalog.indices(product_ids, return_found=True)
+        totals = totals[found]
+        codes = catalog.codes['category'][items]
+        known = codes >= 0
+        by_category = np.stack([
+            np.bincount(codes[known], weights=totals[known, signal], minlength=len(catalog.vocabularies['category']))
+            for signal in range(totals.shape[1])], axis=1)
+        popularity, ctr = self.scores(by_category)
+        order = np.flatnonzero(popularity > 0)
+        order = order[np.argsort(-popularity[order], kind='stable')][:limit]
+        return [{'category': catalog.vocabularies['category'][i], 'popularity': round(float(popularity[i]), 4),
+                 'ctr': round(float(ctr[i]), 6)} for i in order]
+
+    # --- Checkpoints ---
+
+    @property
+    def worker_checkpoint_path(self) -> str:
+        # Claimed on first use, i.e. at startup in the worker process rather than at import
+        if self._worker_checkpoint_path is None:
+            self._worker_checkpoint_path = claim_checkpoint_slot(self.checkpoint_path)
+        return self._worker_checkpoint_path
+
+    def state(self) -> dict:
+        return {'products': self.products.state(), 'segments': self.segments.state(), 'saved_at': time.time()}
+
+    def save(self, state: dict = None):
+        state = self.state() if state is None else state
+        path = self.worker_checkpoint_path
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, 'wb') as f:
+            pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, path)
+
+    def load(self) -> bool:
+        path = self.worker_checkpoint_path
+        if not os.path.exists(path):
+            return False
+        try:
+            with open(path, 'rb') as f:
+                state = pickle.load(f)
+        except Exception:
+            logger.exception(f"Could not read trending checkpoint {path}; starting empty")
+            return False
+        if not (self.products.restore(state['products']) and self.segments.restore(state['segments'])):
+            logger.warning("Trending checkpoint has another bucket layout; starting empty")
+            self.products, self.segments = RingCounters(), RingCounters()
+            return False
+        logger.info(f"Trending counters restored for {len(self.products)} products "
+                    f"from {path}, a checkpoint {time.time() - state['saved_at']:.0f}s old")
+        return True
+
+    async def checkpoint_periodically(self, interval: float = TRENDING_CHECKPOINT_SECONDS):
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                # Snapshot on the event loop, write in a thread
+                await asyncio.to_thread(self.save, self.state())
+            except Exception:
+                logger.exception("Trending checkpoint failed")
+
+
+trending = TrendingEngine()
+
+
+@router.get("/")
+async def get_trending(by: str = 'product', limit: int = 20, user_id: Optional[str] = None,
+                       category: Optional[str] = None, department: Optional[str] = None):
+    if limit <= 0:
+        raise HTTPException(status_code=400, detail="limit must be positive")
+    segment = None
+    if user_id is not None:
+        segment = segment_of(await profile_service.get(user_id))
+        if segment is None:
+            raise HTTPException(status_code=404, detail="User not found")
+    if by == 'product':
+        return await trending.trending_products(limit, segment, category, department)
+    if by == 'category':
+        return await trending.trending_categories(limit, segment)
+    raise HTTPException(status_code=400, detail="by must be 'product' or 'category'")
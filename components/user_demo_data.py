@@ -6,61 +6,86 @@ from models import UserDemographic, UserUpdate
 
 # Assuming DB_CONFIG and get_db_connection() are defined in your database module
 from .database import get_db_connection
+from .user_profiles import profile_service
+from .recommendation_cache import recommendation_cache
 
 router = APIRouter()
 
 async def fetch_user_demographic(user_id: str):
-    query = """
-        SELECT user_id, age, gender, location
-        FROM users
-        WHERE user_id = %s
-    """
-    async with await get_db_connection() as conn:
-        async with conn.cursor(aiomysql.DictCursor) as cur:
-            await cur.execute(query, (user_id,))
-            user_row = await cur.fetchone()
-            if user_row:
-                # Ensure that we are returning data with fields set to None if they are missing
-                return UserDemographic(**user_row)
-            else:
-                # Return a UserDemographic instance with all fields set to None
-                return UserDemographic()
+    profile = await profile_service.get(user_id)
+    if profile:
+        return profile.demographic()
+    # Return a UserDemographic instance with all fields set to None
+    return UserDemographic()
 
 @router.get("/demographics/{user_id}/", response_model=UserDemographic)
 async def get_user_demographics(user_id: str):
     user_data = await fetch_user_demographic(user_id)
     return user_data
 
-async def insert_brands(user_id: str, brands: list):
-    query = "INSERT INTO brands (user_id, brand) VALUES (%s, %s)"
-    async with await get_db_connection() as conn:
-        async with conn.cursor() as cur:
-            for brand in brands:
-                await cur.execute(query, (user_id, brand))
+# Both statements rely on the unique keys added by migration 0004
+UPSERT_USER_QUERY = """
+    INSERT INTO users (user_id, age, gender, location)
+    VALUES (%s, %s, %s, %s)
+    ON DUPLICATE KEY UPDATE age = VALUES(age), gender = VALUES(gender), location = VALUES(location)
+"""
+# Brands the user already has are left untouched
+INSERT_BRANDS_QUERY = """
+    INSERT INTO brands (user_id, brand)
+    VALUES (%s, %s)
+    ON DUPLICATE KEY UPDATE brand = VALUES(brand)
+"""
+
+
+def dedupe_brands(brands: list) -> list:
+    return list(dict.fromkeys(brand for brand in brands if brand))
+
+
+async def insert_brands(cur, user_id: str, brands: list):
+    rows = [(user_id, brand) for brand in dedupe_brands(brands)]
+    if rows:
+        # executemany sends a single multi-row INSERT
+        await cur.executemany(INSERT_BRANDS_QUERY, rows)
+    return True
+
+
+async def upsert_users(cur, updates: list):
+    """Upsert ``(user_id, UserUpdate)`` pairs and their brands on one cursor."""
+    # Consistent lock order so concurrent bulk updates do not deadlock
+    updates = sorted(updates, key=lambda update: str(update[0]))
+    await cur.executemany(
+        UPSERT_USER_QUERY,
+        [(user_id, update.age, update.gender, update.location) for user_id, update in updates]
+    )
+    brand_rows = [(user_id, brand) for user_id, update in updates for brand in dedupe_brands(update.brands)]
+    if brand_rows:
+        await cur.executemany(INSERT_BRANDS_QUERY, brand_rows)
+
+
+async def save_user_demographics(updates: list):
+    async with get_db_connection() as conn:
+        await conn.begin()
+        try:
+            async with conn.cursor() as cur:
+                await upsert_users(cur, updates)
             await conn.commit()
-            return True
+        except Exception:
+            await conn.rollback()
+            raise
+    for user_id, _ in updates:
+        await profile_service.invalidate(user_id)
+        await recommendation_cache.invalidate_user(user_id)
 
 
 @router.put("/demographics/update/{user_id}/")
 async def update_user_demographics(user_id: str, user_update: UserUpdate):
-    async with await get_db_connection() as conn:
-        async with conn.cursor() as cur:
-            # Check if the user already exists
-            await cur.execute("SELECT COUNT(*) FROM users WHERE user_id = %s", (user_id,))
-            (count,) = await cur.fetchone()
-            if count == 0:
-                # Insert new user
-                await cur.execute("INSERT INTO users (user_id, age, gender, location) VALUES (%s, %s, %s, %s)",
-                                  (user_id, user_update.age, user_update.gender, user_update.location))
-            else:
-                # Update existing user
-                await cur.execute("UPDATE users SET age = %s, gender = %s, location = %s WHERE user_id = %s",
-                                  (user_update.age, user_update.gender, user_update.location, user_id))
-
-            await insert_brands(user_id, user_update.brands)
-            await conn.commit()
-            
+    await save_user_demographics([(user_id, user_update)])
     return {"message": "User and brands updated successfully"}
 
 
-
+@router.put("/demographics/bulk-update/")
+async def bulk_update_user_demographics(user_updates: List[UserUpdate]):
+    if not user_updates:
+        raise HTTPException(status_code=400, detail="No users to update")
+    await save_user_demographics([(str(update.user_id), update) for update in user_updates])
+    return {"message": "Users and brands updated successfully", "users": len(user_updates)}
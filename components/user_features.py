@@ -0,0 +1,137 @@
+"""Cold-start user feature encoding against the trained LightFM vocabulary.
+
+The user feature vocabulary (token -> column) comes from the LightFM
+``Dataset`` mapping the model was trained with: either the mapping artifact
+written next to the model, or the Dataset the API builds in preprocessing.
+Users are encoded with the same tokens and l1 row normalisation as
+``Dataset.build_user_features``, straight into CSR index arrays.
+"""
+import logging
+import os
+from bisect import bisect_left
+from collections import OrderedDict
+
+import joblib
+import numpy as np
+from scipy.sparse import csr_matrix
+
+logger = logging.getLogger(__name__)
+
+USER_FEATURE_VOCABULARY = os.getenv("USER_FEATURE_VOCABULARY", "recommendation-model/dataset_mapping.pkl")
+ENCODER_CACHE_SIZE = int(os.getenv("USER_FEATURE_CACHE_SIZE", "100000"))
+
+AGE_BINS = [0, 18, 25, 35, 45, 55, 65, 100]
+AGE_LABELS = ['0-18', '19-25', '26-35', '36-45', '46-55', '56-65', '65+']
+
+
+def age_group(age) -> str:
+    # Same right-closed bins as the pd.cut used in preprocessing; out-of-range ages become 'nan'
+    if age is None:
+        return 'nan'
+    index = bisect_left(AGE_BINS, age)
+    return AGE_LABELS[index - 1] if 1 <= index < len(AGE_BINS) else 'nan'
+
+
+def profile_key(user_demo_details) -> tuple:
+    """Hashable key of everything the encoding depends on."""
+    # Brands are not part of the trained vocabulary, so users differing only in brands encode the same
+    age, gender, location, _ = user_demo_details[0]
+    return (gender, age_group(age), location)
+
+
+def profile_tokens(key: tuple) -> list:
+    gender, group, location = key
+    # Training declares one combined "<gender>_<age group>_<location>" token per user
+    return [f"{gender}_{group}_{location}"]
+
+
+class UserFeatureEncoder:
+    def __init__(self, feature_mapping: dict, cache_size: int = ENCODER_CACHE_SIZE):
+        self.feature_mapping = feature_mapping
+        self.n_features = len(feature_mapping)
+        self.cache_size = cache_size
+        self._cache = OrderedDict()
+
+    @classmethod
+    def from_dataset(cls, dataset):
+        return cls(dataset.mapping()[1])
+
+    @classmethod
+    def from_file(cls, path: str):
+        # Artifact holds Dataset.mapping(): (user ids, user features, item ids, item features)
+        return cls(joblib.load(path)[1])
+
+    def _encode_key(self, key: tuple):
+        row = self._cache.get(key)
+        if row is not None:
+            self._cache.move_to_end(key)
+            return row
+
+        columns = sorted({self.feature_mapping[token] for token in profile_tokens(key) if token in self.feature_mapping})
+        indices = np.asarray(columns, dtype=np.int32)
+        # l1-normalised like Dataset.build_user_features(normalize=True)
+        data = np.full(len(indices), 1.0 / len(indices) if len(indices) else 0.0, dtype=np.float32)
+        row = (indices, data)
+        self._cache[key] = row
+        if len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+        return row
+
+    def encode_batch(self, users: list) -> csr_matrix:
+        """Encode a list of users' (age, gender, location, brand) rows into one CSR matrix."""
+        rows = [self._encode_key(profile_key(user_demo_details)) for user_demo_details in users]
+        lengths = np.fromiter((len(indices) for indices, _ in rows), dtype=np.int64, count=len(rows))
+        indptr = np.zeros(len(rows) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=indptr[1:])
+        indices = np.concatenate([indices for indices, _ in rows]) if rows else np.empty(0, dtype=np.int32)
+        data = np.concatenate([data for _, data in rows]) if rows else np.empty(0, dtype=np.float32)
+        return csr_matrix((data, indices, indptr), shape=(len(rows), self.n_features))
+
+    def encode(self, user_demo_details) -> csr_matrix:
+        return self.encode_batch([user_demo_details])
+
+
+encoder = None
+
+
+def set_encoder(new_encoder: UserFeatureEncoder, model=None):
+    global encoder
+    if model is not None and model.user_embeddings.shape[0] != new_encoder.n_features:
+        logger.warning(f"User feature vocabulary has {new_encoder.n_features} features "
+                       f"but the model has {model.user_embeddings.shape[0]} user embeddings")
+    encoder = new_encoder
+
+
+def clear_encoder():
+    # Until a vocabulary is loaded again, preprocessing registers one from its Dataset
+    global encoder
+    encoder = None
+
+
+def load_vocabulary(path: str = USER_FEATURE_VOCABULARY, model=None) -> bool:
+    if not os.path.exists(path):
+        return False
+    set_encoder(UserFeatureEncoder.from_file(path), model)
+    logger.info(f"Loaded user feature vocabulary from {path}")
+    return True
+
+
+def load_version_vocabulary(version_path: str, model=None) -> bool:
+    """Vocabulary of a registry version: its memory-mapped store if exported, else the pickled mapping."""
+    from . import embedding_store
+
+    if embedding_store.has_store(version_path):
+        directory = os.path.join(version_path, embedding_store.EMBEDDINGS_DIR)
+        set_encoder(UserFeatureEncoder(embedding_store.load_vocabulary(directory)), model)
+        return True
+    return load_vocabulary(os.path.join(version_path, 'dataset_mapping.pkl'), model)
+
+
+def encode_users(users: list) -> csr_matrix:
+    if encoder is None:
+        raise RuntimeError("User feature vocabulary is not loaded")
+    return encoder.encode_batch(users)
+
+
+def create_feature_vector(user_demo_details):
+    return encode_users([user_demo_details])
@@ -0,0 +1,92 @@
+import logging
+import os
+from typing import List, Optional
+
+import aiomysql
+from pydantic import BaseModel
+
+from models import UserDemographic
+from .cache import Cache
+from .database import get_db_connection
+from . import user_features
+
+logger = logging.getLogger(__name__)
+
+PROFILE_CACHE_TTL = int(os.getenv("PROFILE_CACHE_TTL", "300"))
+
+PROFILE_QUERY = """
+    SELECT u.id, u.user_id, u.age, u.gender, u.location, b.brand
+    FROM users u
+    LEFT JOIN brands b ON b.user_id = u.user_id
+    WHERE u.user_id = %s
+    ORDER BY b.id
+"""
+
+
+class UserProfile(BaseModel):
+    id: int
+    user_id: str
+    age: Optional[int] = None
+    gender: Optional[str] = None
+    location: Optional[str] = None
+    brands: List[str] = []
+
+    @property
+    def feature_vector(self):
+        # Cold-start user feature row (CSR); the encoder caches it per profile hash
+        if user_features.encoder is None:
+            return None
+        return user_features.create_feature_vector(self.demo_rows() or [(self.age, self.gender, self.location, None)])
+
+    def demo_rows(self):
+        # One (age, gender, location, brand) tuple per brand, as users JOIN brands returns
+        return [(self.age, self.gender, self.location, brand) for brand in self.brands]
+
+    def rows(self):
+        return [
+            {'id': self.id, 'user_id': self.user_id, 'age': self.age, 'gender': self.gender,
+             'location': self.location, 'brand': brand}
+            for brand in self.brands
+        ]
+
+    def demographic(self) -> UserDemographic:
+        return UserDemographic(user_id=self.user_id, age=self.age, gender=self.gender, location=self.location)
+
+
+class UserProfileService:
+    """Per-user demographic profile shared by the recommendation and demo-data routes.
+
+    Profiles are cached in the 'profiles' namespace; concurrent misses for one
+    user share a single query, and update_user_demographics invalidates the entry.
+    """
+
+    def __init__(self, ttl: int = PROFILE_CACHE_TTL):
+        self.cache = Cache('profiles', ttl=ttl)
+
+    async def get(self, user_id) -> Optional[UserProfile]:
+        user_id = str(user_id)
+        return await self.cache.get_or_load(user_id, lambda: self._load(user_id))
+
+    async def invalidate(self, user_id):
+        await self.cache.delete(str(user_id))
+
+    async def _load(self, user_id: str) -> Optional[UserProfile]:
+        async with get_db_connection() as conn:
+            async with conn.cursor(aiomysql.DictCursor) as cur:
+                await cur.execute(PROFILE_QUERY, (user_id,))
+                rows = await cur.fetchall()
+        if not rows:
+            return None
+
+        first = rows[0]
+        return UserProfile(
+            id=first['id'],
+            user_id=first['user_id'],
+            age=first['age'],
+            gender=first['gender'],
+            location=first['location'],
+            brands=list(dict.fromkeys(row['brand'] for row in rows if row['brand'] is not None)),
+        )
+
+
+profile_service = UserProfileService()
@@ -0,0 +1,115 @@
+"""Startup warm-up, run by main.py's lifespan before /readyz reports ready.
+
+Steps, each timed and logged; a failed step is logged and skipped, the
+caches it would have filled then load on first use as before:
+
+    db_pool               open the aiomysql pool and run a query on each of its connections
+    models                load every model the enabled routers serve and run synthetic
+                          inference through it (the registry's warm-up hooks); the
+                          recommender's swap callback also loads its cold-start segments
+    price_data            read the price optimization dataset
+    product_sampler       build the category / top products sampling index
+    recommendation_index  build the cold-start recommendation index and its embeddings
+    seen_items            load every user's seen products, excluded from recommendations
+
+WARMUP_STEPS limits the run to a comma-separated subset; WARMUP_ENABLED=false
+skips warm-up entirely (models then load in the background and caches lazily).
+"""
+import asyncio
+import logging
+import os
+import time
+
+from .model_registry import model_registry
+
+logger = logging.getLogger(__name__)
+
+WARMUP_ENABLED = os.getenv("WARMUP_ENABLED", "true").lower() == "true"
+WARMUP_STEPS = os.getenv("WARMUP_STEPS", "")
+# Bounds every step but model loading, whose progress /readyz reports per model
+WARMUP_STEP_TIMEOUT = float(os.getenv("WARMUP_STEP_TIMEOUT", "60"))
+
+
+async def warm_db_pool():
+    from .database import init_pool
+    pool = await init_pool()
+
+    async def ping():
+        async with pool.acquire() as conn:
+            async with conn.cursor() as cur:
+                await cur.execute("SELECT 1")
+            await conn.rollback()
+
+    # Acquire them all at once so every pooled connection is opened and authenticated
+    await asyncio.gather(*(ping() for _ in range(pool.minsize)))
+
+
+async def warm_models(models: list):
+    await model_registry.preload(models)
+    failed = [name for name, status in model_registry.status(models).items() if status['state'] != 'loaded']
+    if failed:
+        raise RuntimeError(f"models not loaded: {failed}")
+
+
+async def warm_price_data():
+    from .price_optimization import price_data
+    await asyncio.to_thread(price_data)
+
+
+async def warm_product_sampler():
+    from .product_sampler import product_sampler
+    await product_sampler.ensure_fresh()
+
+
+async def warm_recommendation_index():
+    from .recommendations import get_model, recommendation_index
+    model = await get_model()
+    await recommendation_index.ensure_fresh(model)
+
+
+async def warm_seen_items():
+    from .seen_items import seen_items
+    await seen_items.ensure_loaded()
+
+
+# step -> (coroutine function, routers it warms; None for every configuration)
+STEPS = {
+    'db_pool': (warm_db_pool, None),
+    'models': (warm_models, None),
+    'price_data': (warm_price_data, {'optimize'}),
+    'product_sampler': (warm_product_sampler, {'combined_data'}),
+    'recommendation_index': (warm_recommendation_index, {'cold_start_recommendations'}),
+    'seen_items': (warm_seen_items, {'recommendations', 'cold_start', 'cold_start_recommendations'}),
+}
+
+
+def selected_steps(routers: list) -> list:
+    names = [name.strip() for name in WARMUP_STEPS.split(',') if name.strip()] or list(STEPS)
+    unknown = sorted(set(names) - set(STEPS))
+    if unknown:
+        raise ValueError(f"Unknown WARMUP_STEPS {unknown}; choose from {sorted(STEPS)}")
+    return [name for name in names if STEPS[name][1] is None or STEPS[name][1] & set(routers)]
+
+
+async def run(routers: list, models: list, state: dict):
+    """Run the warm-up steps in order, recording each step's timing and outcome in `state`."""
+    state['state'] = 'running'
+    started = time.monotonic()
+    for name in selected_steps(routers):
+        state['steps'][name] = {'state': 'running'}
+        step_started = time.monotonic()
+        try:
+            if name == 'models':
+                await warm_models(models)
+            else:
+                await asyncio.wait_for(STEPS[name][0](), WARMUP_STEP_TIMEOUT)
+            result = {'state': 'done'}
+        except Exception as e:
+            result = {'state': 'failed', 'error': str(e) or type(e).__name__}
+            logger.exception(f"Warm-up step {name} failed")
+        result['seconds'] = round(time.monotonic() - step_started, 3)
+        state['steps'][name] = result
+        logger.info(f"Warm-up {name}: {result['state']} in {result['seconds']}s")
+    state['state'] = 'done'
+    state['seconds'] = round(time.monotonic() - started, 3)
+    logger.info(f"Warm-up finished in {state['seconds']}s")
@@ -1,19 +1,124 @@
-from fastapi import FastAPI
-# Assuming the components directory contains recommendations and tracking modules.
-# If your project structure is different, you may need to adjust these import paths.
-from components.recommend_products import router as recommendations_router
-from components.cold_start_solution import router as recommendations
-from components.tracking import router as tracking_router
-
-from components.price_optimization import router as price_router
-from components.products import router as products_router
-from components.sales_forecasting    import sales_forecasting_router
-from components.promotion    import router as promotion
-from components.combined_data import router as combined_data_router
-from components.user_demo_data import router as user_demo_data_router
+import asyncio
+import importlib
+import logging
+import os
+from contextlib import asynccontextmanager
 
+from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
-app = FastAPI(title="Product Recommendation Service", version="1.0")
+from fastapi.responses import JSONResponse
+
+from components.model_registry import model_registry, MODEL_WATCH_INTERVAL
+from components.database import close_pool
+from components import warmup
+
+logger = logging.getLogger(__name__)
+
+# name -> (module, router attribute, models its routes serve). Modules are imported
+# only for enabled routers, so e.g. a tracking-only worker never imports LightFM or Keras.
+ROUTERS = {
+    'recommendations': ('components.recommend_products', 'router', ['recommender']),
+    'cold_start': ('components.cold_start_solution', 'router', ['recommender']),
+    'cold_start_recommendations': ('components.recommendations', 'router', ['recommender']),
+    'tracking': ('components.tracking', 'router', []),
+    'optimize': ('components.price_optimization', 'router', ['price_optimization']),
+    'products': ('components.products', 'router', []),
+    'sales_forecasting': ('components.sales_forecasting', 'sales_forecasting_router', []),
+    'promotion': ('components.promotion', 'router', ['promotion']),
+    'user_demo_data': ('components.user_demo_data', 'router', []),
+    'combined_data': ('components.combined_data', 'router', []),
+    'model_registry': ('components.model_registry', 'router', []),
+    'cache': ('components.cache', 'router', []),
+    'trending': ('components.trending', 'router', []),
+    'ctr': ('components.ctr', 'router', []),
+}
+
+# Mount order matters where prefixes overlap
+MOUNTS = [
+    ('recommendations', "/api/v1/recommendations", ["Recommendations"]),
+    ('cold_start', "/api/v1/cold-start-recommendations", ["ColdStartRecommendations"]),
+    ('cold_start_recommendations', "/api/v1/cold-start-recommendations", ["ColdStartRecommendations"]),
+    ('tracking', "/api/v1/tracking", ["Tracking"]),
+    ('optimize', "/api/v1/optimize", ["Optimize"]),
+    ('products', "/api/v1/products", ["Products"]),
+    ('sales_forecasting', "/api/v1/sales-forecasting", ["Sales Forecasting"]),
+    ('promotion', "/api/v1/promotion", ["Promotion"]),
+    ('user_demo_data', "/api/v1/user-demo-data", ["User Demo Data"]),
+    ('combined_data', "/api/v1", ["Combined Data"]),
+    ('model_registry', "/api/v1/admin/models", ["Model Registry"]),
+    ('cache', "/api/v1/admin/cache", ["Cache"]),
+    ('trending', "/api/v1/trending", ["Trending"]),
+    ('ctr', "/api/v1/ctr", ["CTR"]),
+    # The metrics endpoints
+    ('tracking', "/api/v1", ["Tracking"]),
+]
+
+# Comma-separated ROUTERS names to serve; empty serves all of them
+ENABLED_ROUTERS = os.getenv("ENABLED_ROUTERS", "")
+
+
+def enabled_routers() -> list:
+    names = [name.strip() for name in ENABLED_ROUTERS.split(',') if name.strip()]
+    unknown = sorted(set(names) - set(ROUTERS))
+    if unknown:
+        raise ValueError(f"Unknown ENABLED_ROUTERS {unknown}; choose from {sorted(ROUTERS)}")
+    return names or list(ROUTERS)
+
+
+def checkpointed_engines(routers: list) -> list:
+    # In-memory stream aggregates fed by tracking, restored from and saved to their checkpoints
+    engines = []
+    # Every recommender blends in the trending counters
+    if {'tracking', 'trending', 'recommendations', 'cold_start', 'cold_start_recommendations'} & set(routers):
+        from components.trending import trending
+        engines.append(trending)
+    if {'tracking', 'ctr'} & set(routers):
+        from components.ctr import ctr_estimator
+        engines.append(ctr_estimator)
+    return engines
+
+
+def required_models(routers: list) -> list:
+    models = []
+    for name in routers:
+        models.extend(model for model in ROUTERS[name][2] if model not in models)
+    return models
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Accept requests immediately; warm-up (or, without it, model loading) runs in the background
+    # and /readyz reports ready once it is done
+    app.state.warmup = {'state': 'pending', 'steps': {}}
+    if warmup.WARMUP_ENABLED:
+        app.state.model_loader = asyncio.create_task(
+            warmup.run(app.state.routers, app.state.models, app.state.warmup))
+    else:
+        app.state.warmup['state'] = 'disabled'
+        app.state.model_loader = asyncio.create_task(model_registry.preload(app.state.models))
+    # Hot-swap models when a new version is activated by training or another worker
+    app.state.model_watcher = None
+    if MODEL_WATCH_INTERVAL > 0:
+        app.state.model_watcher = asyncio.create_task(model_registry.watch(MODEL_WATCH_INTERVAL))
+    # Stream aggregates resume from their last checkpoint and are checkpointed periodically and on shutdown
+    engines = checkpointed_engines(app.state.routers)
+    app.state.checkpointers = []
+    for engine in engines:
+        engine.load()
+        app.state.checkpointers.append(asyncio.create_task(engine.checkpoint_periodically()))
+    yield
+    for task in (app.state.model_loader, app.state.model_watcher, *app.state.checkpointers):
+        if task is not None:
+            task.cancel()
+    for engine in engines:
+        try:
+            engine.save()
+        except Exception:
+            logger.exception(f"Final checkpoint of {type(engine).__name__} failed")
+    await close_pool()
+
+
+app = FastAPI(title="Product Recommendation Service", version="1.0", lifespan=lifespan)
 
 origins = [
     # any
@@ -30,24 +135,32 @@ app.add_middleware(
 
 
 # Include routers from different components
+app.state.routers = enabled_routers()
+app.state.models = required_models(app.state.routers)
+for router_name, prefix, tags in MOUNTS:
+    if router_name in app.state.routers:
+        module_name, attribute, _ = ROUTERS[router_name]
+        app.include_router(getattr(importlib.import_module(module_name), attribute), prefix=prefix, tags=tags)
 
-app.include_router(recommendations_router, prefix="/api/v1/recommendations", tags=["Recommendations"])
-app.include_router(recommendations, prefix="/api/v1/cold-start-recommendations", tags=["ColdStartRecommendations"])
-app.include_router(tracking_router, prefix="/api/v1/tracking", tags=["Tracking"])
-app.include_router(price_router, prefix="/api/v1/optimize", tags=["Optimize"])
-app.include_router(products_router, prefix="/api/v1/products", tags=["Products"])
-app.include_router(sales_forecasting_router, prefix="/api/v1/sales-forecasting", tags=["Sales Forecasting"])
-app.include_router(promotion, prefix="/api/v1/promotion", tags=["Promotion"])
 
-app.include_router(user_demo_data_router, prefix="/api/v1/user-demo-data", tags=["User Demo Data"])
-app.include_router(combined_data_router, prefix="/api/v1", tags=["Combined Data"])
+@app.get("/healthz")
+async def healthz():
+    # Liveness: the process is up and serving, whatever the models are doing
+    return {"status": "ok"}
 
 
-# Include the router that has the metrics endpoints
-app.include_router(tracking_router, prefix="/api/v1", tags=["Tracking"])
+@app.get("/readyz")
+async def readyz():
+    # Readiness: warm-up has finished and every model the enabled routers serve is loaded
+    models = model_registry.status(app.state.models)
+    ready = (app.state.warmup['state'] in ('done', 'disabled')
+             and all(model['state'] == 'loaded' for model in models.values()))
+    return JSONResponse(status_code=200 if ready else 503,
+                        content={"status": "ready" if ready else "not_ready", "routers": app.state.routers,
+                                 "models": models, "warmup": app.state.warmup})
 
 
 # You can also define root-level endpoints directly in this file
 @app.get("/")
 async def root():
-    return {"message": "Welcome to the Product Recommendation Service API!"}
\ No newline at end of file
+    return {"message": "Welcome to the Product Recommendation Service API!"}
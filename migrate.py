@@ -0,0 +1,261 @@
+"""Versioned schema migrations for the service database.
+
+Migrations live in ``migrations/`` and are applied in version order:
+
+    NNNN_description.sql   plain SQL, statements separated by ";"
+    NNNN_description.py    defines ``async def upgrade(cur)``
+
+Applied versions are recorded in the ``schema_migrations`` table.
+
+Usage:
+    python migrate.py                        # apply pending migrations
+    python migrate.py status                 # show applied / pending migrations
+    python migrate.py add-partitions         # roll monthly partitions forward
+"""
+import argparse
+import asyncio
+import hashlib
+import importlib.util
+import os
+import re
+from datetime import date
+
+import aiomysql
+
+from components.database import DB_CONFIG
+
+MIGRATIONS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'migrations')
+MIGRATION_FILE = re.compile(r'^(\d{4})_(\w+)\.(sql|py)$')
+
+# Tables partitioned by month on their timestamp column (see 0003)
+PARTITIONED_TABLES = {
+    'events': 'event_time',
+    'impressions': 'impression_time',
+    'clicks': 'click_time',
+}
+PARTITION_MONTHS_AHEAD = 3
+
+
+def discover_migrations():
+    migrations = []
+    for name in sorted(os.listdir(MIGRATIONS_DIR)):
+        match = MIGRATION_FILE.match(name)
+        if not match:
+            continue
+        path = os.path.join(MIGRATIONS_DIR, name)
+        with open(path, 'rb') as f:
+            checksum = hashlib.sha256(f.read()).hexdigest()
+        migrations.append({
+            'version': match.group(1),
+            'name': match.group(2),
+            'kind': match.group(3),
+            'path': path,
+            'checksum': checksum,
+        })
+    return migrations
+
+
+def split_sql(script: str):
+    lines = [line for line in script.splitlines() if not line.strip().startswith('--')]
+    return [statement.strip() for statement in '\n'.join(lines).split(';') if statement.strip()]
+
+
+async def ensure_migrations_table(cur):
+    await cur.execute("""
+        CREATE TABLE IF NOT EXISTS schema_migrations (
+            version VARCHAR(16) PRIMARY KEY,
+            name VARCHAR(255),
+            checksum CHAR(64),
+            applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+
+
+async def fetch_applied(cur):
+    await cur.execute("SELECT version, name, checksum, applied_at FROM schema_migrations ORDER BY version")
+    return {row['version']: row for row in await cur.fetchall()}
+
+
+async def apply_migration(cur, migration):
+    if migration['kind'] == 'sql':
+        with open(migration['path']) as f:
+            for statement in split_sql(f.read()):
+                await cur.execute(statement)
+    else:
+        spec = importlib.util.spec_from_file_location(f"migration_{migration['version']}", migration['path'])
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+        await module.upgrade(cur)
+
+    await cur.execute(
+        "INSERT INTO schema_migrations (version, name, checksum) VALUES (%s, %s, %s)",
+        (migration['version'], migration['name'], migration['checksum'])
+    )
+
+
+# --- Monthly range partitioning helpers ---
+
+def month_start(day: date) -> date:
+    return day.replace(day=1)
+
+
+def add_months(day: date, months: int) -> date:
+    month = day.month - 1 + months
+    return date(day.year + month // 12, month % 12 + 1, 1)
+
+
+def partition_clause(month: date) -> str:
+    upper = add_months(month, 1)
+    return f"PARTITION p{month:%Y%m} VALUES LESS THAN (UNIX_TIMESTAMP('{upper:%Y-%m-%d} 00:00:00'))"
+
+
+def monthly_partitions(first: date, last: date):
+    months = []
+    month = month_start(first)
+    while month <= last:
+        months.append(month)
+        month = add_months(month, 1)
+    return months
+
+
+async def existing_partitions(cur, table: str):
+    await cur.execute("""
+        SELECT PARTITION_NAME AS name
+        FROM information_schema.PARTITIONS
+        WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s AND PARTITION_NAME IS NOT NULL
+        ORDER BY PARTITION_ORDINAL_POSITION
+    """, (table,))
+    return [row['name'] for row in await cur.fetchall()]
+
+
+async def partition_table_by_month(cur, table: str, column: str, months_ahead: int = PARTITION_MONTHS_AHEAD):
+    """Convert ``table`` to RANGE partitioning with one partition per month.
+
+    Partitions cover the oldest row's month up to ``months_ahead`` months from
+    now, plus a catch-all ``pmax`` that ``add-partitions`` later splits.
+    """
+    if await existing_partitions(cur, table):
+        return
+
+    await cur.execute(f"SELECT MIN({column}) AS oldest FROM {table}")
+    oldest = (await cur.fetchone())['oldest']
+    today = date.today()
+    first = oldest.date() if oldest else today
+    months = monthly_partitions(first, add_months(month_start(today), months_ahead))
+    clauses = [partition_clause(month) for month in months]
+    clauses.append("PARTITION pmax VALUES LESS THAN MAXVALUE")
+
+    # MySQL requires the partitioning column in every unique key, so the
+    # auto-increment primary key becomes (id, <time column>).
+    await cur.execute(f"SHOW KEYS FROM {table} WHERE Key_name = 'PRIMARY'")
+    pk_column = (await cur.fetchone())['Column_name']
+    await cur.execute(
+        f"ALTER TABLE {table} "
+        f"MODIFY {column} TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP, "
+        f"DROP PRIMARY KEY, ADD PRIMARY KEY ({pk_column}, {column})"
+    )
+    await cur.execute(
+        f"ALTER TABLE {table} PARTITION BY RANGE (UNIX_TIMESTAMP({column})) ({', '.join(clauses)})"
+    )
+
+
+async def add_monthly_partitions(cur, table: str, months_ahead: int = PARTITION_MONTHS_AHEAD):
+    """Split ``pmax`` so that partitions exist up to ``months_ahead`` months from now."""
+    names = [name for name in await existing_partitions(cur, table) if name != 'pmax']
+    if not names:
+        return []
+
+    last = date(int(names[-1][1:5]), int(names[-1][5:7]), 1)
+    months = monthly_partitions(add_months(last, 1), add_months(month_start(date.today()), months_ahead))
+    if not months:
+        return []
+
+    clauses = [partition_clause(month) for month in months]
+    clauses.append("PARTITION pmax VALUES LESS THAN MAXVALUE")
+    await cur.execute(f"ALTER TABLE {table} REORGANIZE PARTITION pmax INTO ({', '.join(clauses)})")
+    return [f"p{month:%Y%m}" for month in months]
+
+
+# --- Commands ---
+
+async def connect():
+    conn = await aiomysql.connect(**DB_CONFIG, autocommit=True)
+    async with conn.cursor() as cur:
+        # Partition bounds are computed with UNIX_TIMESTAMP(), keep them in UTC
+        await cur.execute("SET time_zone = '+00:00'")
+    return conn
+
+
+async def migrate():
+    conn = await connect()
+    try:
+        async with conn.cursor(aiomysql.DictCursor) as cur:
+            # Guard against two deployments migrating at the same time
+            await cur.execute("SELECT GET_LOCK('schema_migrations', 60) AS locked")
+            if not (await cur.fetchone())['locked']:
+                raise SystemExit("Could not acquire the schema_migrations lock")
+            try:
+                await ensure_migrations_table(cur)
+                applied = await fetch_applied(cur)
+                for migration in discover_migrations():
+                    if migration['version'] in applied:
+                        continue
+                    print(f"Applying {migration['version']}_{migration['name']}")
+                    await apply_migration(cur, migration)
+                print("Schema is up to date")
+            finally:
+                await cur.execute("SELECT RELEASE_LOCK('schema_migrations')")
+    finally:
+        conn.close()
+
+
+async def status():
+    conn = await connect()
+    try:
+        async with conn.cursor(aiomysql.DictCursor) as cur:
+            await ensure_migrations_table(cur)
+            applied = await fetch_applied(cur)
+    finally:
+        conn.close()
+
+    for migration in discover_migrations():
+        row = applied.get(migration['version'])
+        if row is None:
+            state = 'pending'
+        elif row['checksum'] != migration['checksum']:
+            state = f"applied {row['applied_at']} (file changed since)"
+        else:
+            state = f"applied {row['applied_at']}"
+        print(f"{migration['version']}_{migration['name']}: {state}")
+
+
+async def add_partitions(months_ahead: int):
+    conn = await connect()
+    try:
+        async with conn.cursor(aiomysql.DictCursor) as cur:
+            for table in PARTITIONED_TABLES:
+                added = await add_monthly_partitions(cur, table, months_ahead)
+                print(f"{table}: {', '.join(added) if added else 'nothing to add'}")
+    finally:
+        conn.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Apply database schema migrations")
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.add_parser('migrate', help="apply pending migrations (default)")
+    subparsers.add_parser('status', help="list applied and pending migrations")
+    partitions = subparsers.add_parser('add-partitions', help="create upcoming monthly partitions")
+    partitions.add_argument('--months', type=int, default=PARTITION_MONTHS_AHEAD)
+    args = parser.parse_args()
+
+    if args.command == 'status':
+        asyncio.run(status())
+    elif args.command == 'add-partitions':
+        asyncio.run(add_partitions(args.months))
+    else:
+        asyncio.run(migrate())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,24 @@
+-- Secondary indexes for the lookups, joins and aggregations the API runs.
+
+-- Per-user lookups (demographics, brands, preferences, event history)
+CREATE INDEX idx_users_user_id ON users (user_id);
+CREATE INDEX idx_brands_user_id ON brands (user_id);
+CREATE INDEX idx_user_preferences_user_id ON user_preferences (user_id);
+CREATE INDEX idx_events_user_id ON events (user_id);
+
+-- Product lookups by external id and category
+CREATE INDEX idx_products_product_id ON products (product_id);
+CREATE INDEX idx_products_category ON products (product_category);
+
+-- Monthly conversion rates group events by month and count event types
+CREATE INDEX idx_events_time_type ON events (event_time, event_type);
+
+-- Monthly / per-category sales aggregates (covering the summed amount)
+CREATE INDEX idx_sales_order_date ON sales (order_date, amount);
+CREATE INDEX idx_sales_category ON sales (product_category, amount);
+
+-- Impression / click lookups per product and per user
+CREATE INDEX idx_impressions_product_id ON impressions (product_id);
+CREATE INDEX idx_impressions_user_product ON impressions (user_id, product_id);
+CREATE INDEX idx_clicks_product_id ON clicks (product_id);
+CREATE INDEX idx_clicks_user_product ON clicks (user_id, product_id);
@@ -0,0 +1,10 @@
+-- Materialise the product id embedded in event URIs ("/product/<id>") so the
+-- events -> products join can use an index instead of evaluating
+-- CAST(SUBSTRING_INDEX(uri, '/', -1) AS UNSIGNED) for every row.
+-- Non-product URIs ("/home", "/department/men", ...) get NULL.
+ALTER TABLE events
+    ADD COLUMN product_id INT UNSIGNED
+        GENERATED ALWAYS AS (
+            IF(uri REGEXP '/product/[0-9]+$', CAST(SUBSTRING_INDEX(uri, '/', -1) AS UNSIGNED), NULL)
+        ) STORED,
+    ADD INDEX idx_events_product_id (product_id);
@@ -0,0 +1,12 @@
+"""Partition events / impressions / clicks by month on their timestamp column.
+
+Date-bounded scans (conversion rates, combined-data exports) then only touch
+the partitions for the requested months, and old months can be dropped with
+ALTER TABLE ... DROP PARTITION instead of a long DELETE.
+"""
+from migrate import PARTITIONED_TABLES, partition_table_by_month
+
+
+async def upgrade(cur):
+    for table, column in PARTITIONED_TABLES.items():
+        await partition_table_by_month(cur, table, column)
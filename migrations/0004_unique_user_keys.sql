@@ -0,0 +1,9 @@
+-- Upserts on users / brands need unique keys: one users row per user_id and
+-- one brands row per (user_id, brand). Existing duplicates keep their newest row.
+DELETE older FROM users older
+    JOIN users newer ON older.user_id = newer.user_id AND older.id < newer.id;
+DELETE older FROM brands older
+    JOIN brands newer ON older.user_id = newer.user_id AND older.brand = newer.brand AND older.id < newer.id;
+
+ALTER TABLE users DROP INDEX idx_users_user_id, ADD UNIQUE INDEX uq_users_user_id (user_id);
+ALTER TABLE brands DROP INDEX idx_brands_user_id, ADD UNIQUE INDEX uq_brands_user_brand (user_id, brand);
@@ -58,7 +58,7 @@ class Product(BaseModel):
     id: int
     name: str
     category: str
-    image_url: str
+    image_url: Optional[str] = None
 
 class UserProductPreference(BaseModel):
     user_id: int
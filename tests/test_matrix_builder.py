@@ -0,0 +1,115 @@
+"""The vectorized builders must produce exactly what LightFM's Dataset.build_* loops produce."""
+import numpy as np
+import pandas as pd
+import pytest
+from lightfm.data import Dataset
+
+from components import matrix_builder
+
+
+def same(actual, expected):
+    actual, expected = actual.tocsr(), expected.tocsr()
+    assert actual.shape == expected.shape
+    assert actual.dtype == expected.dtype
+    assert (actual != expected).nnz == 0
+
+
+@pytest.fixture
+def frames():
+    users = pd.DataFrame({
+        'user_id': ['u1', 'u2', 'u3', 'u4'],
+        'age': [17, 30, None, 70],
+        'gender': ['M', 'F', 'F', None],
+        'location': ['Paris', 'Lyon', 'Paris', 'Nice'],
+    })
+    items = pd.DataFrame({
+        'id': [10, 11, 12],
+        'product_category': ['Tops', 'Jeans', 'Tops'],
+        'product_brand': ['A', 'B', None],
+    })
+    # u1 / 10 twice: duplicate events must add up the same way
+    events = pd.DataFrame({
+        'user_id': ['u1', 'u1', 'u2', 'u3', 'u1', 'u4'],
+        'product_id': [10, 10, 11, 12, 12, 11],
+        'weight': [3.0, 2.0, 2.5, 1.0, 0.5, 2.0],
+    })
+    return users, items, events
+
+
+def fitted(users, items, user_tokens, item_tokens, identity: bool) -> Dataset:
+    dataset = Dataset(user_identity_features=identity, item_identity_features=identity)
+    flatten = lambda tokens: [token for row in tokens for token in (row if isinstance(row, list) else [row])]
+    dataset.fit(users['user_id'], items['id'], flatten(user_tokens), flatten(item_tokens))
+    return dataset
+
+
+@pytest.mark.parametrize('identity', [True, False])
+def test_build_interactions_matches_lightfm(frames, identity):
+    users, items, events = frames
+    dataset = fitted(users, items, [], [], identity)
+
+    interactions, weights = matrix_builder.build_interactions(
+        dataset, events['user_id'], events['product_id'], events['weight'])
+    expected_interactions, expected_weights = dataset.build_interactions(
+        zip(events['user_id'], events['product_id'], events['weight']))
+
+    same(interactions, expected_interactions)
+    same(weights, expected_weights)
+
+
+def test_build_interactions_rejects_unknown_ids(frames):
+    users, items, _ = frames
+    dataset = fitted(users, items, [], [], True)
+    with pytest.raises(ValueError):
+        matrix_builder.build_interactions(dataset, ['u1', 'nobody'], [10, 10])
+
+
+@pytest.mark.parametrize('identity', [True, False])
+def test_build_user_features_matches_lightfm(frames, identity):
+    users, items, _ = frames
+    tokens = matrix_builder.user_feature_tokens(users).tolist()
+    dataset = fitted(users, items, tokens, [], identity)
+
+    features = matrix_builder.build_user_features(dataset, users['user_id'], tokens)
+    expected = dataset.build_user_features(zip(users['user_id'], [[token] for token in tokens]))
+
+    same(features, expected)
+
+
+@pytest.mark.parametrize('identity', [True, False])
+@pytest.mark.parametrize('normalize', [True, False])
+def test_build_item_features_with_several_tokens_per_row(frames, identity, normalize):
+    users, items, _ = frames
+    tokens = [[f"category_{category}", f"brand_{brand}"]
+              for category, brand in zip(items['product_category'], items['product_brand'])]
+    # Same token twice in one row, as LightFM accumulates it
+    tokens[0] = tokens[0] + [tokens[0][0]]
+    dataset = fitted(users, items, [], tokens, identity)
+
+    features = matrix_builder.build_item_features(dataset, items['id'], tokens, normalize=normalize)
+    expected = dataset.build_item_features(zip(items['id'], tokens), normalize=normalize)
+
+    same(features, expected)
+
+
+def test_joined_item_tokens_match_lightfm(frames):
+    users, items, _ = frames
+    tokens = matrix_builder.join_tokens(items, ['product_category', 'product_brand']).tolist()
+    dataset = matrix_builder.fit_dataset(users['user_id'], items['id'], item_features=tokens)
+
+    features = matrix_builder.build_item_features(dataset, items['id'], tokens)
+    expected = dataset.build_item_features(zip(items['id'], [[token] for token in tokens]))
+
+    same(features, expected)
+    assert np.allclose(features.sum(axis=1), 1)
+
+
+def test_unnormalizable_rows_raise_like_lightfm(frames):
+    users, items, _ = frames
+    tokens = matrix_builder.user_feature_tokens(users).tolist()
+    dataset = fitted(users, items, tokens, [], identity=False)
+    # Only two of the four users get a feature row, so the others have zero norm
+    with pytest.raises(ValueError):
+        dataset.build_user_features(zip(users['user_id'][:2], [[token] for token in tokens[:2]]))
+    with pytest.raises(ValueError):
+        matrix_builder.build_user_features(dataset, users['user_id'][:2], tokens[:2])